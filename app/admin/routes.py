@@ -1,10 +1,8 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, Response
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, Response, send_file
 from functools import wraps
+from markupsafe import escape
 from app.admin.services import *
 from core.scheduler_service import scheduler, update_job_for_design
-from app.reports.generator_service import generate_report
-from app.utils.email_sender import send_email
-from app.admin.services import log_email_sent
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -47,6 +45,24 @@ def settings():
         if 'update_smtp_settings' in request.form:
             update_settings(request.form)
             flash('Configuración de correo guardada.', 'success')
+        elif 'update_log_settings' in request.form:
+            try:
+                update_log_settings(request.form)
+                flash('Configuración del historial guardada.', 'success')
+            except ValueError as e:
+                flash(str(e), 'danger')
+        elif 'update_email_settings' in request.form:
+            try:
+                update_email_settings(request.form)
+                flash('Configuración de correos HTML guardada.', 'success')
+            except ValueError as e:
+                flash(str(e), 'danger')
+        elif 'update_scheduler_settings' in request.form:
+            try:
+                update_scheduler_settings(request.form)
+                flash('Configuración del programador guardada. Se aplicará en la próxima sincronización (1 min).', 'success')
+            except ValueError as e:
+                flash(str(e), 'danger')
         elif 'update_password' in request.form:
             if verify_user(session['username'], request.form['current_password']):
                 update_password(session['username'], request.form['new_password'])
@@ -86,8 +102,11 @@ def repositories():
     if request.method == 'POST':
         action = request.form.get('action')
         if action == 'save':
-            save_repository(request.form)
-            flash('Repositorio guardado correctamente.', 'success')
+            try:
+                save_repository(request.form)
+                flash('Repositorio guardado correctamente.', 'success')
+            except ValueError as e:
+                flash(str(e), 'danger')
         elif action == 'delete':
             delete_repository(request.form.get('id'))
             flash('Repositorio eliminado.', 'info')
@@ -117,14 +136,19 @@ def designs():
             flash('Diseño y su tarea programada han sido eliminados.', 'info')
         return redirect(url_for('admin.designs'))
     all_designs = get_all_designs()
-    return render_template('admin/designs.html', designs=all_designs)
+    return render_template('admin/designs.html', designs=all_designs, pdf_stats=get_pdf_render_stats())
 
 @admin_bp.route('/designer', methods=['GET', 'POST'])
 @admin_bp.route('/designer/<int:design_id>', methods=['GET', 'POST'])
 @login_required
 def designer(design_id=None):
     if request.method == 'POST':
-        saved_design_id = save_design(request.form, request.files)
+        try:
+            saved_design_id = save_design(request.form, request.files)
+        except ValueError as e: # Configuración no válida: volver al diseñador con lo editado
+            flash(f'No se guardó el diseño. {e}', 'danger')
+            return render_template('admin/designer.html', design=unsaved_design_from_form(request.form),
+                                   repositories=get_all_repositories())
         full_design = get_design_by_id(saved_design_id)
         if full_design:
             update_job_for_design(full_design)
@@ -134,6 +158,28 @@ def designer(design_id=None):
     all_repos = get_all_repositories()
     return render_template('admin/designer.html', design=design_data, repositories=all_repos)
 
+@admin_bp.route('/designer/preview', methods=['POST'])
+@login_required
+def designer_preview():
+    """Vista previa rápida del diseño sin guardar: muestra acotada de filas renderizada en HTML."""
+    try:
+        from app.reports.generator_service import generate_sample_preview, PREVIEW_SAMPLE_ROWS # Carga diferida
+        form = request.form
+        repo, conn_details = get_repository_with_connection(form.get('repository_id'))
+        if not repo: raise ValueError("Selecciona un repositorio de datos.")
+        design = dict(unsaved_design_from_form(form), repository_id=repo['id'], repository=repo, connection=conn_details)
+        design['name'] = design['name'] or 'Vista previa'
+        config = design['config']
+        filter_values = {f['name']: (f.get('sample') or None) for f in config['filters']}
+        try:
+            max_rows = min(5000, max(1, int(form.get('preview_rows') or PREVIEW_SAMPLE_ROWS)))
+        except ValueError:
+            max_rows = PREVIEW_SAMPLE_ROWS
+        return Response(generate_sample_preview(design, filter_values, max_rows), mimetype='text/html')
+    except Exception as e:
+        return Response(f"<p style='font-family: sans-serif; color: #b02a37;'>Error en la vista previa: {escape(str(e))}</p>",
+                        mimetype='text/html', status=400)
+
 # --- Rutas de API y Ejecución de Reportes ---
 @admin_bp.route('/api/repository-columns/<int:repository_id>')
 @login_required
@@ -145,10 +191,31 @@ def get_repo_columns(repository_id):
 @login_required
 def execute_report(design_id):
     try:
-        filter_values = request.form.to_dict()
-        output, mimetype, filename = generate_report(design_id, filter_values)
-        headers = {'Content-Disposition': f'inline;filename={filename}'}
-        return Response(output, mimetype=mimetype, headers=headers)
+        from app.reports.generator_service import generate_report # Carga diferida (pandas/WeasyPrint)
+        from app.reports import preview_cache, download_cache
+        filter_values = request.values.to_dict() # El formulario usa GET: la URL se puede reabrir y revalidar
+        # '_refresh' no puede ser un filtro (design_plan.validate_config rechaza los nombres con '_')
+        force = filter_values.pop('_refresh', None) is not None
+        design = get_design_with_source(design_id)
+        if not design: raise ValueError("Diseño no encontrado")
+        data_fingerprint = get_data_fingerprint(design['repository'], design['connection'])
+        key = download_cache.download_key(design, filter_values, data_fingerprint)
+        # Con consulta de control y datos sin cambios se sirve el archivo ya generado
+        artifact = download_cache.find_artifact(key) if data_fingerprint and not force else None
+        cache_status = 'file' if artifact else None
+        if not artifact:
+            # Peticiones simultáneas con el mismo diseño y filtros comparten una sola generación
+            (output, mimetype, filename), shared = preview_cache.get_preview(
+                preview_cache.report_preview_key(design, filter_values),
+                lambda: generate_report(design_id, filter_values), force=force)
+            artifact = download_cache.store_artifact(key, output, mimetype, filename, content_etag=not data_fingerprint)
+            cache_status = 'hit' if shared else 'miss'
+        response = send_file(artifact['path'], mimetype=artifact['mimetype'], download_name=artifact['filename'],
+                             conditional=True, etag=artifact['etag'], max_age=0)
+        response.cache_control.private = True # Revalidar siempre (If-None-Match -> 304)
+        response.cache_control.no_cache = True
+        response.headers['X-Preview-Cache'] = cache_status
+        return response
     except Exception as e:
         flash(f'Error al generar el reporte: {str(e)}', 'danger')
         return redirect(url_for('admin.designs'))
@@ -157,12 +224,43 @@ def execute_report(design_id):
 
 # ... (otras rutas)
 
+@admin_bp.route('/startup-report')
+@login_required
+def startup_report():
+    from core.startup_profile import startup_profile
+    return Response(startup_profile.report(), mimetype='text/plain')
+
 # --- NUEVO: Ruta para el Historial de Envíos ---
 @admin_bp.route('/email-log')
 @login_required
 def email_log():
-    logs = get_email_logs()
-    return render_template('admin/email_log.html', logs=logs)
+    filters = {
+        'report_name': request.args.get('report_name') or None,
+        'status': request.args.get('status') or None,
+        'date_from': request.args.get('date_from') or None,
+        'date_to': request.args.get('date_to') or None
+    }
+    logs, next_cursor = get_email_logs(before=request.args.get('before'), **filters)
+    stats = get_email_log_stats(days=30, report_name=filters['report_name'])
+    return render_template('admin/email_log.html', logs=logs, next_cursor=next_cursor, filters=filters,
+                           stats=stats, report_names=get_email_log_report_names(), statuses=LOG_STATUSES)
+
+# --- Consultas en curso (cancelación de consultas largas al ERP) ---
+@admin_bp.route('/running-queries')
+@login_required
+def running_queries_page():
+    if request.args.get('format') == 'json':
+        return jsonify({'queries': get_running_queries()})
+    return render_template('admin/running_queries.html', queries=get_running_queries())
+
+@admin_bp.route('/running-queries/<token>/cancel', methods=['POST'])
+@login_required
+def cancel_running_query(token):
+    try:
+        request_query_cancel(token)
+        return jsonify({'success': True, 'message': 'Cancelación solicitada. La consulta se detendrá en unos segundos.'})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
 
 # ... (resto de las rutas)
 # --- NUEVO: Ruta para la lista de reportes (Emisión) ---
@@ -176,61 +274,42 @@ def report_list():
 @admin_bp.route('/send-report-email', methods=['POST'])
 @login_required
 def send_report_email():
-    design_id = request.form.get('design_id')
-    email_to = request.form.get('email_to')
-    email_cc = request.form.get('email_cc')
-    subject = request.form.get('subject')
-    body_extra = request.form.get('body', '') # Cuerpo adicional opcional
+    from app.reports.manual_send import send_manual_report, filter_values_for
+    design = get_design_by_id(request.form.get('design_id'))
+    # Recolectar valores de los filtros del formulario
+    filter_values = filter_values_for(design, request.form) if design else {}
+    success, message = send_manual_report(design, filter_values, request.form.get('email_to'),
+                                          request.form.get('email_cc'), request.form.get('subject'),
+                                          request.form.get('body', '')) # Cuerpo adicional opcional
+    if success:
+        flash(message, 'success')
+    else:
+        flash(f"Error al enviar el email: {message}", 'danger')
+    return redirect(url_for('admin.report_list'))
 
-    try:
-        design = get_design_by_id(design_id)
-        if not design:
-            raise ValueError("Diseño no encontrado")
-        
-        smtp_config = get_settings()
-        if not smtp_config.get('smtp_server'):
-            raise ValueError("Servidor SMTP no configurado.")
-
-        # Recolectar valores de los filtros del formulario
-        filter_values = {}
-        if design['config'].get('filters'):
-            for f in design['config']['filters']:
-                filter_values[f['name']] = request.form.get(f['name'])
-
-        # Generar el reporte
-        output, mimetype, filename = generate_report(design_id, filter_values)
-
-        # Preparar datos del email
-        recipients = [e.strip() for e in email_to.split(',') if e.strip()]
-        cc = [e.strip() for e in email_cc.split(',') if e.strip()]
-        
-        body = f"{body_extra}\n\n" if body_extra else ""
-        if design['output_format'] == 'html_email':
-             body += output # El reporte es el cuerpo principal
-             is_html_body = True
-             attachment = None
-        else:
-             body += "Adjunto encontrará el reporte solicitado."
-             is_html_body = False
-             attachment = (filename, mimetype, output)
-
-        # Enviar email (usando la utilidad que ya tenemos)
-        send_email(
-            smtp_config=smtp_config,
-            recipients=recipients,
-            cc=cc,
-            subject=subject,
-            body=body,
-            is_html=is_html_body,
-            attachment=attachment
-        )
-        
-        # Registrar el envío manual
-        log_email_sent(design['name'], f"Manual a: {email_to} | CC: {email_cc}", "Enviado")
-        flash(f"Reporte '{design['name']}' enviado correctamente.", 'success')
+# --- Envío masivo (cierre de mes): varios reportes en segundo plano con avance por elemento ---
+@admin_bp.route('/api/bulk-send', methods=['POST'])
+@login_required
+def bulk_send_reports():
+    """JSON: {"items": [{"design_id", "filters": {...}, "email_to", "email_cc", "subject", "body"}, ...]}.
 
-    except Exception as e:
-        log_email_sent(design.get('name', f'ID {design_id}'), f"Manual a: {email_to} | CC: {email_cc}", "Fallido", str(e))
-        flash(f"Error al enviar el email: {str(e)}", 'danger')
+    Destinatarios y asunto son opcionales (por defecto, los del diseño).
+    """
+    from flask import current_app
+    from app.reports.manual_send import start_bulk_send
+    payload = request.get_json(silent=True) or {}
+    try:
+        run = start_bulk_send(current_app._get_current_object(), payload.get('items'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({'success': True, 'run_id': run.id,
+                    'progress_url': url_for('admin.bulk_send_progress', run_id=run.id)}), 202
 
-    return redirect(url_for('admin.report_list'))
\ No newline at end of file
+@admin_bp.route('/api/bulk-send/<run_id>')
+@login_required
+def bulk_send_progress(run_id):
+    from app.reports.manual_send import get_bulk_run
+    run = get_bulk_run(run_id)
+    if not run:
+        return jsonify({'success': False, 'message': 'Envío masivo no encontrado o ya expirado.'}), 404
+    return jsonify({'success': True, **run.to_dict()})
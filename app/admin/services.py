@@ -1,21 +1,111 @@
 # -*- coding: utf-8 -*-
 import sqlite3
+import hashlib
 import json
 import os
+import csv
+import gzip
+import io
+import sys
+import threading
+import shutil
+from decimal import Decimal
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import pyodbc
+import time
+from core import metrics
+from core.query_registry import running_queries, STALE_AFTER_SECONDS
+from app.reports import design_plan
 
-DB_PATH = 'settings.db'
+# Raíz del proyecto: junto al ejecutable si la app está empaquetada con PyInstaller
+if getattr(sys, 'frozen', False):
+    PROJECT_ROOT = os.path.dirname(sys.executable)
+else:
+    PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DB_PATH = os.path.join(PROJECT_ROOT, 'settings.db')
+SQLITE_BUSY_TIMEOUT_MS = 5000
+DESCRIBE_TIMEOUT_SECONDS = 30 # Análisis de columnas desde el diseñador
 
 # --- Conexión a la BBDD de Configuración ---
+class _ConfigConnection(sqlite3.Connection):
+    """Conexión SQLite de larga duración (una por hilo).
+
+    close() no cierra la conexión física: solo descarta la transacción pendiente,
+    así el código existente puede seguir llamando a close() sin coste.
+    """
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+    def really_close(self):
+        super().close()
+
+_local = threading.local()
+
 def get_db():
-    """Establece conexión con la base de datos SQLite."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row # Permite acceder a las columnas por nombre
+    """Devuelve la conexión SQLite del hilo actual (la crea si no existe)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, factory=_ConfigConnection, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                               cached_statements=256) # Caché de sentencias preparadas
+        conn.row_factory = sqlite3.Row # Permite acceder a las columnas por nombre
+        conn.execute("PRAGMA journal_mode=WAL") # Lectores no bloquean al escritor
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        _local.conn = conn
     return conn
 
+def close_db():
+    """Cierra físicamente la conexión del hilo actual (p. ej. al terminar un worker)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.really_close()
+        _local.conn = None
+
+# --- Caché en memoria de filas poco cambiantes (settings, conexiones) ---
+# Se invalida al escribir, pero solo en el proceso que escribe: el programador y los
+# trabajadores (otros procesos) la vacían en cada sincronización y antes de cada trabajo.
+_cache = {}
+_cache_lock = threading.Lock()
+_cache_generation = 0 # Sube en cada invalidación: una carga que la cruzó no se guarda
+
+def _cached(key, loader):
+    """Devuelve el valor cacheado para 'key' o lo carga con loader()."""
+    with _cache_lock:
+        if key in _cache:
+            metrics.inc('hsp_cache_hits_total', cache='settings')
+            return _cache[key]
+        generation = _cache_generation
+    metrics.inc('hsp_cache_misses_total', cache='settings')
+    value = loader()
+    with _cache_lock:
+        if generation == _cache_generation: # Si se invalidó durante la carga, el valor puede ser viejo
+            _cache[key] = value
+    return value
+
+def invalidate_cache(*keys):
+    """Invalida entradas de la caché (todas si no se indican claves)."""
+    global _cache_generation
+    with _cache_lock:
+        _cache_generation += 1
+        if not keys:
+            _cache.clear()
+        for key in keys:
+            _cache.pop(key, None)
+
+def build_connection_string(conn_details):
+    """Cadena ODBC para una fila de db_connections."""
+    return f"DRIVER={conn_details['driver']};SERVER={conn_details['server']};DATABASE={conn_details['database']};UID={conn_details['username']};PWD={conn_details['password']};TrustServerCertificate=yes;"
+
 # --- Inicialización de la Base de Datos ---
+def _ensure_columns(cursor, table, columns):
+    """Añade a 'table' las columnas que falten (migración simple para BBDD existentes)."""
+    existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()}
+    for column, ddl in columns.items():
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
 def init_db():
     """Crea/actualiza todas las tablas y datos por defecto si no existen."""
     conn = get_db()
@@ -96,6 +186,127 @@ def init_db():
         )
     ''')
 
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_log_stats (
+            day TEXT NOT NULL,
+            report_name TEXT NOT NULL,
+            status TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, report_name, status)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            design_id INTEGER NOT NULL,
+            started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            duration_seconds REAL NOT NULL,
+            status TEXT NOT NULL
+        )
+    ''')
+
+    # Agregados parciales por día para el modo incremental (app.reports.incremental)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS report_partials (
+            design_id INTEGER NOT NULL,
+            plan_hash TEXT NOT NULL,
+            day TEXT NOT NULL,
+            group_key TEXT NOT NULL,
+            totals_json TEXT NOT NULL,
+            row_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (design_id, plan_hash, day, group_key)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS report_partial_days (
+            design_id INTEGER NOT NULL,
+            plan_hash TEXT NOT NULL,
+            day TEXT NOT NULL,
+            PRIMARY KEY (design_id, plan_hash, day)
+        )
+    ''')
+
+    # Última huella de datos enviada por diseño (omitir/reutilizar si no hubo cambios)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS design_run_state (
+            design_id INTEGER PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Tamaño y tiempo de render de los PDF por diseño (último y acumulado, ver record_pdf_render)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pdf_render_stats (
+            design_id INTEGER PRIMARY KEY,
+            renders INTEGER NOT NULL DEFAULT 0,
+            last_bytes INTEGER NOT NULL,
+            last_seconds REAL NOT NULL,
+            total_bytes INTEGER NOT NULL DEFAULT 0,
+            total_seconds REAL NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Consultas al ERP en curso (ver core.query_registry); cancel_requested lo marca la web
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS running_queries (
+            token TEXT PRIMARY KEY,
+            pid INTEGER NOT NULL,
+            label TEXT NOT NULL,
+            design_id INTEGER,
+            started_at REAL NOT NULL,
+            heartbeat REAL NOT NULL,
+            cancel_requested INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # Turnos de trabajos en curso de todos los procesos (ver core.job_gate.SharedSlots)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_slots (
+            token TEXT PRIMARY KEY,
+            pid INTEGER NOT NULL,
+            acquired_at REAL NOT NULL,
+            heartbeat REAL NOT NULL
+        )
+    ''')
+
+    # --- Migraciones de columnas e índices ---
+    _ensure_columns(cursor, 'settings', {
+        'log_retention_days': 'INTEGER DEFAULT 180', # 0 = conservar siempre
+        'log_archive_enabled': 'INTEGER DEFAULT 1',
+        'schedule_spread_minutes': 'INTEGER DEFAULT 0', # Ventana para repartir trabajos de la misma hora
+        'max_concurrent_jobs': 'INTEGER DEFAULT 4',
+        'email_size_budget_kb': 'INTEGER DEFAULT 100' # Tamaño máximo del cuerpo HTML de correo (0 = sin límite)
+    })
+    _ensure_columns(cursor, 'data_repositories', {
+        'fingerprint_query': 'TEXT', # Consulta de control barata para detectar cambios en los datos
+        'query_timeout': 'INTEGER DEFAULT 0' # Segundos máximos por consulta (0 = sin límite)
+    })
+    _ensure_columns(cursor, 'daily_summary_config', {
+        'query_timeout': 'INTEGER DEFAULT 0' # Segundos máximos de la consulta del resumen (0 = sin límite)
+    })
+    _ensure_columns(cursor, 'report_designs', {
+        'priority': 'INTEGER DEFAULT 3' # 1 = más prioritario
+    })
+    _ensure_columns(cursor, 'job_slots', {
+        'priority': 'INTEGER DEFAULT 3',
+        'state': "TEXT DEFAULT 'running'" # 'waiting' = en cola por un turno, 'running' = lo ocupa
+    })
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_job_runs_design ON job_runs (design_id, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_logs_timestamp ON email_logs (timestamp, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_logs_report ON email_logs (report_name, timestamp, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_logs_status ON email_logs (status, timestamp, id)")
+
+    # Contadores agregados: reconstruir desde el historial si la tabla es nueva
+    cursor.execute("SELECT COUNT(*) FROM email_log_stats")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute('''
+            INSERT INTO email_log_stats (day, report_name, status, count)
+            SELECT date(timestamp), report_name, status, COUNT(*) FROM email_logs GROUP BY date(timestamp), report_name, status
+        ''')
+
     # --- Inicialización de Datos por Defecto ---
     cursor.execute("SELECT * FROM users WHERE username = 'admin'")
     if cursor.fetchone() is None:
@@ -143,22 +354,64 @@ SELECT FORMAT(FechaE, 'yyyy-MM') AS MesAno, SUM(CASE WHEN TipoFac = 'A' THEN Mto
 
 # --- Gestión de Configuración Global (SMTP) ---
 def get_settings():
-    conn = get_db()
-    settings = conn.execute("SELECT * FROM settings WHERE id = 1").fetchone()
-    conn.close()
-    return dict(settings) if settings else {}
+    def load():
+        conn = get_db()
+        settings = conn.execute("SELECT * FROM settings WHERE id = 1").fetchone()
+        conn.close()
+        return dict(settings) if settings else {}
+    return dict(_cached('settings', load)) # Copia para que el llamador no altere la caché
 
 def update_settings(data):
     """Actualiza la configuración SMTP."""
     conn = get_db()
-    conn.execute('''
-        UPDATE settings SET smtp_server = ?, smtp_port = ?, smtp_user = ?, smtp_password = ? WHERE id = 1
-    ''', (
-        data.get('smtp_server'), data.get('smtp_port'),
-        data.get('smtp_user'), data.get('smtp_password')
-    ))
-    conn.commit()
+    with conn:
+        conn.execute('''
+            UPDATE settings SET smtp_server = ?, smtp_port = ?, smtp_user = ?, smtp_password = ? WHERE id = 1
+        ''', (
+            data.get('smtp_server'), data.get('smtp_port'),
+            data.get('smtp_user'), data.get('smtp_password')
+        ))
+    conn.close()
+    invalidate_cache('settings')
+
+def update_log_settings(data):
+    """Actualiza la retención/archivado del historial de envíos."""
+    try:
+        retention_days = max(0, int(data.get('log_retention_days') or 0))
+    except (TypeError, ValueError):
+        raise ValueError("Los días de retención deben ser un número entero.")
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE settings SET log_retention_days = ?, log_archive_enabled = ? WHERE id = 1",
+                     (retention_days, 1 if 'log_archive_enabled' in data else 0))
     conn.close()
+    invalidate_cache('settings')
+
+def update_email_settings(data):
+    """Actualiza el tamaño máximo del cuerpo de los correos HTML."""
+    try:
+        budget_kb = max(0, int(data.get('email_size_budget_kb') or 0))
+    except (TypeError, ValueError):
+        raise ValueError("El tamaño máximo del correo debe ser un número entero (KB).")
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE settings SET email_size_budget_kb = ? WHERE id = 1", (budget_kb,))
+    conn.close()
+    invalidate_cache('settings')
+
+def update_scheduler_settings(data):
+    """Actualiza la ventana de reparto y el máximo de trabajos simultáneos."""
+    try:
+        spread_minutes = max(0, int(data.get('schedule_spread_minutes') or 0))
+        max_jobs = max(1, int(data.get('max_concurrent_jobs') or 1))
+    except (TypeError, ValueError):
+        raise ValueError("La ventana de reparto y el máximo de trabajos deben ser números enteros.")
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE settings SET schedule_spread_minutes = ?, max_concurrent_jobs = ? WHERE id = 1",
+                     (spread_minutes, max_jobs))
+    conn.close()
+    invalidate_cache('settings')
 
 # --- Gestión de Usuarios ---
 def verify_user(username, password):
@@ -170,38 +423,46 @@ def verify_user(username, password):
 def update_password(username, new_password):
     hashed_password = generate_password_hash(new_password)
     conn = get_db()
-    conn.execute("UPDATE users SET password_hash = ? WHERE username = ?", (hashed_password, username))
-    conn.commit()
+    with conn:
+        conn.execute("UPDATE users SET password_hash = ? WHERE username = ?", (hashed_password, username))
     conn.close()
 
 # --- Gestión de Conexiones a BBDD ---
 def get_all_connections():
-    conn = get_db()
-    connections_rows = conn.execute("SELECT * FROM db_connections ORDER BY name").fetchall()
-    conn.close()
-    return [dict(row) for row in connections_rows]
+    def load():
+        conn = get_db()
+        connections_rows = conn.execute("SELECT * FROM db_connections ORDER BY name").fetchall()
+        conn.close()
+        return [dict(row) for row in connections_rows]
+    return [dict(row) for row in _cached('connections', load)]
+
+def get_connection_by_id(conn_id):
+    """Devuelve una conexión desde la caché (None si no existe)."""
+    for row in get_all_connections():
+        if str(row['id']) == str(conn_id):
+            return row
+    return None
 
 def save_connection(data):
     conn_id = data.get('id')
     password = data.get('password') # Obtener la contraseña
+    if not (conn_id and conn_id.isdigit()) and not password:
+        raise ValueError("La contraseña es requerida para nuevas conexiones.")
     conn = get_db()
-
-    # Solo actualizar contraseña si se proporciona una nueva
-    if conn_id and conn_id.isdigit():
-        if password: # Si se ingresó una contraseña nueva
-            conn.execute('UPDATE db_connections SET name=?, server=?, database=?, username=?, password=? WHERE id=?',
-                         (data['name'], data['server'], data['database'], data['username'], password, conn_id))
-        else: # Si se dejó en blanco, no actualizar la contraseña
-            conn.execute('UPDATE db_connections SET name=?, server=?, database=?, username=? WHERE id=?',
-                         (data['name'], data['server'], data['database'], data['username'], conn_id))
-    else: # Insertar nueva conexión (la contraseña es requerida)
-        if not password:
-             conn.close() # Cerrar conexión antes de lanzar error
-             raise ValueError("La contraseña es requerida para nuevas conexiones.")
-        conn.execute('INSERT INTO db_connections (name, server, database, username, password) VALUES (?, ?, ?, ?, ?)',
-                     (data['name'], data['server'], data['database'], data['username'], password))
-    conn.commit()
+    with conn:
+        # Solo actualizar contraseña si se proporciona una nueva
+        if conn_id and conn_id.isdigit():
+            if password: # Si se ingresó una contraseña nueva
+                conn.execute('UPDATE db_connections SET name=?, server=?, database=?, username=?, password=? WHERE id=?',
+                             (data['name'], data['server'], data['database'], data['username'], password, conn_id))
+            else: # Si se dejó en blanco, no actualizar la contraseña
+                conn.execute('UPDATE db_connections SET name=?, server=?, database=?, username=? WHERE id=?',
+                             (data['name'], data['server'], data['database'], data['username'], conn_id))
+        else: # Insertar nueva conexión (la contraseña es requerida)
+            conn.execute('INSERT INTO db_connections (name, server, database, username, password) VALUES (?, ?, ?, ?, ?)',
+                         (data['name'], data['server'], data['database'], data['username'], password))
     conn.close()
+    invalidate_cache('connections')
 
 def delete_connection(conn_id):
     conn = get_db()
@@ -216,25 +477,24 @@ def delete_connection(conn_id):
         conn.close()
         raise ValueError("No se puede eliminar: conexión usada por uno o más Repositorios.")
 
-    conn.execute("DELETE FROM db_connections WHERE id=?", (conn_id,))
-    conn.commit()
+    with conn:
+        conn.execute("DELETE FROM db_connections WHERE id=?", (conn_id,))
     conn.close()
+    invalidate_cache('connections')
 
 def test_connection(data):
     try:
         password = data.get('password')
         # Si no se proporciona contraseña al probar (ej. editando), intentar obtener la guardada
         if not password and data.get('id'):
-             conn_temp = get_db()
-             saved_conn = conn_temp.execute("SELECT password FROM db_connections WHERE id=?", (data.get('id'),)).fetchone()
-             conn_temp.close()
+             saved_conn = get_connection_by_id(data.get('id'))
              if saved_conn: password = saved_conn['password']
 
         if not password: # Si sigue sin haber contraseña (nueva conexión sin pass o error)
             return False, "Se requiere contraseña para probar la conexión."
 
-        conn_str = f"DRIVER={data.get('driver', '{ODBC Driver 17 for SQL Server}')};SERVER={data['server']};DATABASE={data['database']};UID={data['username']};PWD={password};TrustServerCertificate=yes;"
-        cnxn = pyodbc.connect(conn_str, timeout=5)
+        conn_str = build_connection_string({**data, 'driver': data.get('driver', '{ODBC Driver 17 for SQL Server}'), 'password': password})
+        cnxn = metrics.TrackedConnection(pyodbc.connect(conn_str, timeout=5), 'odbc')
         cnxn.close()
         return True, "Conexión exitosa"
     except Exception as e:
@@ -253,17 +513,44 @@ def get_repository_by_id(repo_id):
     conn.close()
     return dict(repo_row) if repo_row else None
 
+# Columnas de db_connections con prefijo 'conn_' para leerlas en el mismo JOIN
+_CONNECTION_JOIN_COLUMNS = ("dc.name AS conn_name, dc.server AS conn_server, dc.database AS conn_database, "
+                            "dc.username AS conn_username, dc.password AS conn_password, dc.driver AS conn_driver")
+
+def _split_connection_columns(row):
+    """Separa las columnas 'conn_*' de una fila JOIN en un dict de conexión."""
+    data = dict(row)
+    conn_details = {'id': data.get('connection_id')}
+    for key in list(data):
+        if key.startswith('conn_'):
+            conn_details[key[len('conn_'):]] = data.pop(key)
+    return data, conn_details
+
+def get_repository_with_connection(repo_id):
+    """Repositorio y su conexión en una sola consulta. Devuelve (repo, conn_details) o (None, None)."""
+    conn = get_db()
+    row = conn.execute(f'SELECT dr.*, {_CONNECTION_JOIN_COLUMNS} FROM data_repositories dr '
+                       'LEFT JOIN db_connections dc ON dr.connection_id = dc.id WHERE dr.id = ?', (repo_id,)).fetchone()
+    conn.close()
+    if not row: return None, None
+    repo, conn_details = _split_connection_columns(row)
+    return repo, (conn_details if conn_details.get('server') is not None else None)
+
 def save_repository(data):
     repo_id = data.get('id')
     conn = get_db()
-    if repo_id and repo_id.isdigit():
-        conn.execute('UPDATE data_repositories SET name=?, description=?, sql_query=?, connection_id=? WHERE id=?',
-                     (data['name'], data['description'], data['sql_query'], data['connection_id'], repo_id))
-    else:
-        conn.execute('INSERT INTO data_repositories (name, description, sql_query, connection_id) VALUES (?, ?, ?, ?)',
-                     (data['name'], data['description'], data['sql_query'], data['connection_id']))
-    conn.commit()
-    conn.close()
+    fingerprint_query = (data.get('fingerprint_query') or '').strip() or None
+    try:
+        query_timeout = max(0, int(data.get('query_timeout') or 0))
+    except ValueError:
+        raise ValueError("El tiempo máximo de consulta debe ser un número de segundos.")
+    with conn: # Confirma al salir; si algo falla, deshace (no deja la transacción abierta en el hilo)
+        if repo_id and repo_id.isdigit():
+            conn.execute('UPDATE data_repositories SET name=?, description=?, sql_query=?, connection_id=?, fingerprint_query=?, query_timeout=? WHERE id=?',
+                         (data['name'], data['description'], data['sql_query'], data['connection_id'], fingerprint_query, query_timeout, repo_id))
+        else:
+            conn.execute('INSERT INTO data_repositories (name, description, sql_query, connection_id, fingerprint_query, query_timeout) VALUES (?, ?, ?, ?, ?, ?)',
+                         (data['name'], data['description'], data['sql_query'], data['connection_id'], fingerprint_query, query_timeout))
 
 def delete_repository(repo_id):
     conn = get_db()
@@ -273,59 +560,149 @@ def delete_repository(repo_id):
         conn.close()
         raise ValueError("No se puede eliminar: repositorio usado por uno o más Diseños.")
 
-    conn.execute("DELETE FROM data_repositories WHERE id=?", (repo_id,))
-    conn.commit()
+    with conn:
+        conn.execute("DELETE FROM data_repositories WHERE id=?", (repo_id,))
     conn.close()
 
 # --- Gestión de Diseños de Reportes ---
+# Configuración decodificada y plan de ejecución por diseño (ver app.reports.design_plan).
+# Se reutilizan mientras config_json y schedule_days de la fila no cambien; la
+# configuración cacheada se comparte entre llamadas y no debe modificarse.
+_design_configs = {} # design_id -> (config_json, schedule_days_json, config, schedule_days, plan)
+
+def _decode_design(design_id, config_json, schedule_days_json):
+    with _cache_lock:
+        cached = _design_configs.get(design_id)
+    if cached and cached[0] == config_json and cached[1] == schedule_days_json:
+        metrics.inc('hsp_cache_hits_total', cache='design_plan')
+        return cached[2:]
+    metrics.inc('hsp_cache_misses_total', cache='design_plan')
+    try:
+        config = json.loads(config_json or '{}')
+    except json.JSONDecodeError:
+        config = {}
+    # Convertir schedule_days de JSON string a lista Python para la plantilla
+    try:
+        schedule_days = json.loads(schedule_days_json or '[]')
+    except json.JSONDecodeError:
+        schedule_days = []
+    plan = design_plan.compile_plan(config, version=hashlib.sha1((config_json or '').encode('utf-8')).hexdigest())
+    with _cache_lock:
+        _design_configs[design_id] = (config_json, schedule_days_json, config, schedule_days, plan)
+    return config, schedule_days, plan
+
+def invalidate_design_plan(design_id):
+    with _cache_lock:
+        _design_configs.pop(int(design_id), None)
+
 def get_all_designs():
     conn = get_db()
     design_rows = conn.execute('SELECT rd.*, dr.name as repository_name FROM report_designs rd JOIN data_repositories dr ON rd.repository_id = dr.id ORDER BY rd.name').fetchall()
     conn.close()
-    designs = []
-    for row in design_rows:
-        design = dict(row)
-        try:
-            design['config'] = json.loads(design['config_json'] or '{}') # Carga segura
-        except json.JSONDecodeError:
-             design['config'] = {}
-        designs.append(design)
-    return designs
+    return [_parse_design_row(dict(row)) for row in design_rows]
 
 def get_design_by_id(design_id):
     conn = get_db()
     design_row = conn.execute("SELECT * FROM report_designs WHERE id = ?", (design_id,)).fetchone()
     conn.close()
     if not design_row: return None
-    design = dict(design_row)
-    try:
-        design['config'] = json.loads(design['config_json'] or '{}')
-    except json.JSONDecodeError:
-        design['config'] = {}
-    # Convertir schedule_days de JSON string a lista Python para la plantilla
-    try:
-        design['schedule_days'] = json.loads(design['schedule_days'] or '[]')
-    except json.JSONDecodeError:
-        design['schedule_days'] = []
+    return _parse_design_row(dict(design_row))
+
+def get_design_with_source(design_id):
+    """Diseño + repositorio + conexión en un único JOIN (para ejecuciones).
+
+    Devuelve el diseño con las claves extra 'repository' y 'connection' (None si faltan).
+    """
+    conn = get_db()
+    row = conn.execute(f'SELECT rd.*, dr.name AS repo_name, dr.sql_query AS repo_sql_query, dr.fingerprint_query AS repo_fingerprint_query, '
+                       'dr.query_timeout AS repo_query_timeout, '
+                       'dr.connection_id AS connection_id, '
+                       f'{_CONNECTION_JOIN_COLUMNS} FROM report_designs rd '
+                       'LEFT JOIN data_repositories dr ON rd.repository_id = dr.id '
+                       'LEFT JOIN db_connections dc ON dr.connection_id = dc.id WHERE rd.id = ?', (design_id,)).fetchone()
+    conn.close()
+    if not row: return None
+    data, conn_details = _split_connection_columns(row)
+    repository = None
+    if data.get('repo_sql_query') is not None:
+        repository = {'id': data['repository_id'], 'name': data.get('repo_name'),
+                      'sql_query': data['repo_sql_query'], 'fingerprint_query': data.get('repo_fingerprint_query'),
+                      'query_timeout': data.get('repo_query_timeout'), 'connection_id': data.get('connection_id')}
+    for key in ('repo_name', 'repo_sql_query', 'repo_fingerprint_query', 'repo_query_timeout', 'connection_id'):
+        data.pop(key, None)
+    design = _parse_design_row(data)
+    design['repository'] = repository
+    design['connection'] = conn_details if conn_details.get('server') is not None else None
     return design
 
-def save_design(form_data, file_data):
-    design_id = form_data.get('id')
+def _parse_design_row(design):
+    """Decodifica config_json y schedule_days de una fila de report_designs y añade su plan ('plan')."""
+    config, schedule_days, plan = _decode_design(design['id'], design['config_json'], design['schedule_days'])
+    design['config'], design['schedule_days'], design['plan'] = config, list(schedule_days), plan
+    return design
+
+def unsaved_design_from_form(form_data):
+    """Diseño sin guardar a partir del formulario del diseñador (vista previa, volver a mostrar tras un error)."""
+    return {'id': int(form_data['id']) if (form_data.get('id') or '').isdigit() else 0,
+            'name': form_data.get('name') or '', 'output_format': form_data.get('output_format'),
+            'repository_id': int(form_data['repository_id']) if (form_data.get('repository_id') or '').isdigit() else None,
+            'config': design_config_from_form(form_data, {'header_text': form_data.get('header_text')}),
+            'email_to': form_data.get('email_to'), 'email_cc': form_data.get('email_cc'),
+            'schedule_days': json.dumps(form_data.getlist('schedule_days')), 'schedule_time': form_data.get('schedule_time'),
+            'priority': form_data.get('priority')}
+
+def _incremental_config_from_form(form_data):
+    """Configuración del modo incremental (ver app.reports.incremental)."""
+    try:
+        window_days = max(1, int(form_data.get('incremental_window_days') or 30))
+        recheck_days = max(1, int(form_data.get('incremental_recheck_days') or 1))
+    except ValueError:
+        window_days, recheck_days = 30, 1
+    return {
+        'enabled': 'incremental_enabled' in form_data,
+        'date_field': (form_data.get('incremental_date_field') or '').strip(),
+        'from_filter': (form_data.get('incremental_from_filter') or '').strip(),
+        'to_filter': (form_data.get('incremental_to_filter') or '').strip(),
+        'window_days': window_days,
+        'recheck_days': recheck_days
+    }
+
+# Qué hacer en una ejecución programada si la huella de datos no cambió ('' = ejecutar siempre)
+UNCHANGED_ACTIONS = ('skip', 'reuse')
 
+def design_config_from_form(form_data, branding_config):
+    """Configuración (config_json) de un diseño a partir del formulario del diseñador."""
     # Procesar campos, etiquetas y orden
     field_order = form_data.getlist('field_order')
     fields_config = {'order': field_order, 'details': {}}
     for field_name in field_order:
         fields_config['details'][field_name] = {'label': form_data.get(f'field_label_{field_name}', field_name), 'visible': f'field_visible_{field_name}' in form_data}
 
-    # Procesar filtros
+    # Procesar filtros (con un valor de prueba opcional para la vista previa rápida)
     filters = []
     filter_labels, filter_names, filter_types = form_data.getlist('filter_label'), form_data.getlist('filter_name'), form_data.getlist('filter_type')
+    filter_samples = form_data.getlist('filter_sample')
     for i in range(len(filter_labels)):
-        if filter_labels[i] and filter_names[i]: filters.append({'label': filter_labels[i], 'name': filter_names[i], 'type': filter_types[i]})
+        if filter_labels[i] and filter_names[i]:
+            filters.append({'label': filter_labels[i], 'name': filter_names[i], 'type': filter_types[i],
+                            'sample': filter_samples[i] if i < len(filter_samples) else ''})
+
+    return {'fields': fields_config, 'group_by_field': form_data.get('group_by_field'), 'total_fields': form_data.getlist('total_fields'), 'chart': {'type': form_data.get('chart_type'), 'x_axis': form_data.get('chart_x_axis'), 'y_axis': form_data.get('chart_y_axis'), 'format': form_data.get('chart_format') or 'png'}, 'branding': branding_config, 'filters': filters,
+            'bundle_formats': [f for f in form_data.getlist('bundle_formats') if f != form_data.get('output_format')],
+            'incremental': _incremental_config_from_form(form_data),
+            'unchanged_action': form_data.get('unchanged_action') if form_data.get('unchanged_action') in UNCHANGED_ACTIONS else ''}
 
-    # Procesar branding (logo y texto)
+def save_design(form_data, file_data):
+    """Guarda el diseño. ValueError si la configuración no es válida (ver design_plan.validate_config)."""
+    design_id = form_data.get('id')
+
+    # Procesar branding (logo y texto); el logo se añade a branding_config más abajo
     branding_config = {'header_text': form_data.get('header_text')}
+    config = design_config_from_form(form_data, branding_config)
+    errors = design_plan.validate_config(config, form_data.getlist('schedule_days'), form_data.get('schedule_time'))
+    if errors:
+        raise ValueError(' '.join(errors))
+
     logo_file = file_data.get('company_logo')
     current_logo = None
     if design_id: # Si editamos, obtener logo actual
@@ -334,7 +711,10 @@ def save_design(form_data, file_data):
             current_logo = old_design['config']['branding'].get('logo_filename')
 
     if logo_file and logo_file.filename != '':
-        filename = secure_filename(logo_file.filename)
+        from app.reports import image_optimize
+        filename = image_optimize.logo_filename(secure_filename(logo_file.filename))
+        # Reducir y recodificar una sola vez al subirlo (no en cada PDF); ValueError si no es una imagen
+        logo_bytes = image_optimize.optimize_logo(logo_file.read(), filename)
         upload_folder = os.path.join(os.path.dirname(DB_PATH), 'uploads')
         os.makedirs(upload_folder, exist_ok=True)
         logo_path = os.path.join(upload_folder, filename)
@@ -346,34 +726,37 @@ def save_design(form_data, file_data):
                  try: os.remove(old_logo_path)
                  except OSError as e: print(f"Error eliminando logo antiguo {old_logo_path}: {e}")
 
-        logo_file.save(logo_path)
+        with open(logo_path, 'wb') as f:
+            f.write(logo_bytes)
         branding_config['logo_filename'] = filename
     elif current_logo: # Mantener logo antiguo si no se subió nuevo
         branding_config['logo_filename'] = current_logo
 
     # Empaquetar configuración
-    config = {'fields': fields_config, 'group_by_field': form_data.get('group_by_field'), 'total_fields': form_data.getlist('total_fields'), 'chart': {'type': form_data.get('chart_type'), 'x_axis': form_data.get('chart_x_axis'), 'y_axis': form_data.get('chart_y_axis')}, 'branding': branding_config, 'filters': filters}
     config_json = json.dumps(config)
 
     conn = get_db()
     cursor = conn.cursor()
     # Guardar schedule_days como JSON string
     schedule_days_json = json.dumps(form_data.getlist('schedule_days'))
+    try:
+        priority = min(5, max(1, int(form_data.get('priority') or 3)))
+    except ValueError:
+        priority = 3
     params = (
         form_data.get('name'), form_data.get('repository_id'), form_data.get('output_format'), config_json,
         form_data.get('email_to'), form_data.get('email_cc'),
-        schedule_days_json, form_data.get('schedule_time')
+        schedule_days_json, form_data.get('schedule_time'), priority
     )
 
-    if design_id and design_id.isdigit():
-        cursor.execute('UPDATE report_designs SET name=?, repository_id=?, output_format=?, config_json=?, email_to=?, email_cc=?, schedule_days=?, schedule_time=? WHERE id=?', (*params, design_id))
-        saved_design_id = int(design_id)
-    else:
-        cursor.execute('INSERT INTO report_designs (name, repository_id, output_format, config_json, email_to, email_cc, schedule_days, schedule_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', params)
-        saved_design_id = cursor.lastrowid
-
-    conn.commit()
-    conn.close()
+    with conn: # Confirma al salir; si algo falla, deshace
+        if design_id and design_id.isdigit():
+            cursor.execute('UPDATE report_designs SET name=?, repository_id=?, output_format=?, config_json=?, email_to=?, email_cc=?, schedule_days=?, schedule_time=?, priority=? WHERE id=?', (*params, design_id))
+            saved_design_id = int(design_id)
+        else:
+            cursor.execute('INSERT INTO report_designs (name, repository_id, output_format, config_json, email_to, email_cc, schedule_days, schedule_time, priority) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', params)
+            saved_design_id = cursor.lastrowid
+    invalidate_design_plan(saved_design_id)
     return saved_design_id
 
 def delete_design(design_id):
@@ -388,24 +771,45 @@ def delete_design(design_id):
             except OSError as e: print(f"Error eliminando logo {logo_path}: {e}")
 
     conn = get_db()
-    conn.execute("DELETE FROM report_designs WHERE id=?", (design_id,))
-    conn.commit()
+    with conn:
+        conn.execute("DELETE FROM report_designs WHERE id=?", (design_id,))
+        conn.execute("DELETE FROM job_runs WHERE design_id=?", (design_id,))
+        conn.execute("DELETE FROM report_partials WHERE design_id=?", (design_id,))
+        conn.execute("DELETE FROM report_partial_days WHERE design_id=?", (design_id,))
+        conn.execute("DELETE FROM design_run_state WHERE design_id=?", (design_id,))
+        conn.execute("DELETE FROM pdf_render_stats WHERE design_id=?", (design_id,))
     conn.close()
+    invalidate_design_plan(design_id)
+    delete_last_artifacts(design_id)
 
 # --- Funciones de Ejecución de Consultas ---
 def get_repository_columns(repository_id):
-    """Obtiene nombres de columnas de un query de forma segura."""
-    repo = get_repository_by_id(repository_id)
+    """Obtiene nombres de columnas de un query de forma segura.
+
+    El resultado correcto se cachea por repositorio, SQL y conexión: el diseñador lo pide
+    en cada carga y así no vuelve a consultar el servidor mientras la consulta no cambie.
+    """
+    repo, conn_details = get_repository_with_connection(repository_id)
     if not repo: return False, "Repositorio no encontrado.", None
-    conn_db = get_db()
-    conn_details_row = conn_db.execute("SELECT * FROM db_connections WHERE id = ?", (repo['connection_id'],)).fetchone()
-    conn_db.close()
-    if not conn_details_row: return False, "Conexión no encontrada.", None
-    conn_details = dict(conn_details_row)
+    if not conn_details: return False, "Conexión no encontrada.", None
+    cache_key = ('repo_columns', repository_id, conn_details.get('id'),
+                 hashlib.sha1(repo['sql_query'].encode('utf-8')).hexdigest())
+    with _cache_lock:
+        cached = _cache.get(cache_key)
+    if cached is not None:
+        return True, "Columnas obtenidas.", list(cached)
+    result = _describe_repository_columns(repo, conn_details)
+    if result[0]:
+        with _cache_lock:
+            _cache[cache_key] = tuple(result[2])
+    return result
+
+def _describe_repository_columns(repo, conn_details):
     cnxn = None
     try:
-        conn_str = f"DRIVER={conn_details['driver']};SERVER={conn_details['server']};DATABASE={conn_details['database']};UID={conn_details['username']};PWD={conn_details['password']};TrustServerCertificate=yes;"
-        cnxn = pyodbc.connect(conn_str, timeout=5)
+        conn_str = build_connection_string(conn_details)
+        cnxn = metrics.TrackedConnection(pyodbc.connect(conn_str, timeout=5), 'odbc')
+        cnxn.timeout = DESCRIBE_TIMEOUT_SECONDS
         cursor = cnxn.cursor()
 
         # Limpiar query para análisis
@@ -430,52 +834,450 @@ def get_repository_columns(repository_id):
         if cnxn: cnxn.close()
         return False, f"Error inesperado al obtener columnas: {e}", None
 
-def execute_repository_query(repository_id, params=None):
-    """Ejecuta consulta con parámetros y devuelve datos."""
-    repo = get_repository_by_id(repository_id)
+def decimal_scales(description):
+    """Escala (decimales) de las columnas DECIMAL/MONEY según cursor.description: {columna: escala}."""
+    return {column[0]: column[5] for column in description or []
+            if column[1] is Decimal and column[5] is not None}
+
+def query_timeout_seconds(repo):
+    """Tiempo máximo por sentencia configurado en el repositorio (None si es 0/NULL: sin límite)."""
+    return int((repo or {}).get('query_timeout') or 0) or None
+
+def describe_query_error(error, cancelled, timeout, elapsed):
+    """Mensaje para el usuario/historial si la consulta se canceló o agotó su tiempo (None en otro caso)."""
+    if cancelled:
+        return f"Consulta cancelada por un administrador tras {elapsed:.0f} s."
+    if isinstance(error, pyodbc.Error) and error.args and error.args[0] == 'HYT00':
+        return f"La consulta superó el tiempo máximo de {timeout} s y fue cancelada."
+    return None
+
+def execute_repository_query(repository_id, params=None, source=None, max_rows=None, label=None, design_id=None):
+    """Ejecuta consulta con parámetros y devuelve datos.
+
+    source: (repo, conn_details) ya leídos (p. ej. de get_design_with_source) para
+    evitar volver a consultar settings.db.
+    max_rows: muestra acotada (vista previa rápida). Se aplica con SET ROWCOUNT en el
+    servidor, que también limita consultas con varias sentencias o procedimientos, y
+    con fetchmany en el cliente.
+    label/design_id: descripción de la consulta en la lista de consultas en curso.
+    La consulta se corta en el servidor si supera el tiempo máximo configurado en el
+    repositorio (si lo tiene) o si un administrador la cancela.
+    """
+    repo, conn_details = source if source else get_repository_with_connection(repository_id)
     if not repo: return False, "Repositorio no encontrado.", None
-    conn_db = get_db()
-    conn_details_row = conn_db.execute("SELECT * FROM db_connections WHERE id = ?", (repo['connection_id'],)).fetchone()
-    conn_db.close()
-    if not conn_details_row: return False, "Conexión no encontrada.", None
-    conn_details = dict(conn_details_row)
+    if not conn_details: return False, "Conexión no encontrada.", None
+    label = label or f"Repositorio '{repo.get('name')}'"
+    timeout = query_timeout_seconds(repo)
+    started = time.perf_counter()
+    query_state = {'cancelled': False}
     cnxn = None
     try:
-        conn_str = f"DRIVER={conn_details['driver']};SERVER={conn_details['server']};DATABASE={conn_details['database']};UID={conn_details['username']};PWD={conn_details['password']};TrustServerCertificate=yes;"
-        cnxn = pyodbc.connect(conn_str, timeout=10)
+        conn_str = build_connection_string(conn_details)
+        cnxn = metrics.TrackedConnection(pyodbc.connect(conn_str, timeout=10), 'odbc')
+        if timeout:
+            cnxn.timeout = timeout # Límite por sentencia; el 'timeout' de connect solo cubre el inicio de sesión
         cursor = cnxn.cursor()
 
-        # Ejecutar con parámetros
-        cursor.execute(repo['sql_query'], params if params else [])
+        with running_queries.track(cursor, label, design_id) as query_state:
+            if max_rows:
+                cursor.execute(f"SET ROWCOUNT {int(max_rows)}")
 
-        if cursor.description is None:
-            columns, all_data = [], []
-        else:
-            columns = [column[0] for column in cursor.description]
-            all_data = [tuple(row) for row in cursor.fetchall()]
+            # Ejecutar con parámetros
+            cursor.execute(repo['sql_query'], params if params else [])
+
+            if cursor.description is None:
+                columns, all_data = [], []
+            else:
+                columns = [column[0] for column in cursor.description]
+                rows = cursor.fetchmany(int(max_rows)) if max_rows else cursor.fetchall()
+                all_data = [tuple(row) for row in rows]
 
         cnxn.close()
-        data_dict = {'columns': columns, 'data': all_data}
+        print(f"  -> {label}: {len(all_data)} filas en {time.perf_counter() - started:.1f} s.")
+        data_dict = {'columns': columns, 'data': all_data, 'scales': decimal_scales(cursor.description)}
         return True, "Consulta ejecutada.", data_dict
     except Exception as e:
         if cnxn: cnxn.close()
-        print(f"Error detallado en execute_repository_query: {e}")
-        return False, f"Error al ejecutar consulta: {e}", None
+        elapsed = time.perf_counter() - started
+        print(f"Error detallado en execute_repository_query ({label}, {elapsed:.1f} s): {e}")
+        message = describe_query_error(e, query_state['cancelled'], timeout, elapsed) or f"Error al ejecutar consulta: {e}"
+        return False, message, None
+
+def get_data_fingerprint(repo, conn_details):
+    """Ejecuta la consulta de control del repositorio (fingerprint_query) y devuelve un hash de su resultado.
+
+    La consulta debe ser barata, p. ej. 'SELECT COUNT(*), CHECKSUM_AGG(CHECKSUM(*)) FROM SAFACT'
+    o 'SELECT MAX(FechaE) FROM SAFACT'. Devuelve None si no hay consulta de control o si falla.
+    """
+    probe = ((repo or {}).get('fingerprint_query') or '').strip()
+    if not probe or not conn_details: return None
+    cnxn = None
+    try:
+        cnxn = metrics.TrackedConnection(pyodbc.connect(build_connection_string(conn_details), timeout=10), 'odbc')
+        timeout = query_timeout_seconds(repo)
+        if timeout: cnxn.timeout = timeout
+        cursor = cnxn.cursor()
+        cursor.execute(probe)
+        rows = [tuple(row) for row in cursor.fetchall()] if cursor.description else []
+        cnxn.close()
+        return hashlib.sha1(repr(rows).encode('utf-8')).hexdigest()
+    except Exception as e:
+        if cnxn: cnxn.close()
+        print(f"  -> Consulta de control fallida en '{repo.get('name')}' (se ejecutará el reporte completo): {e}")
+        return None
+
+# --- Última ejecución enviada por diseño (omitir/reutilizar si los datos no cambian) ---
+ARTIFACTS_DIR = os.path.join(PROJECT_ROOT, 'report_artifacts')
+
+def _design_artifacts_dir(design_id):
+    return os.path.join(ARTIFACTS_DIR, f"design_{int(design_id)}")
+
+def get_design_fingerprint(design_id):
+    conn = get_db()
+    row = conn.execute("SELECT fingerprint FROM design_run_state WHERE design_id = ?", (design_id,)).fetchone()
+    conn.close()
+    return row['fingerprint'] if row else None
+
+def save_design_fingerprint(design_id, fingerprint):
+    conn = get_db()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO design_run_state (design_id, fingerprint, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+                     (design_id, fingerprint))
+    conn.close()
+
+def save_last_artifacts(design_id, outputs, images):
+    """Guarda en disco los archivos del último envío: outputs [(contenido, mime, nombre)] e images [(cid, bytes)].
+
+    Se escriben en una carpeta temporal que luego reemplaza a la anterior, para no dejar
+    nunca un envío a medias.
+    """
+    target = _design_artifacts_dir(design_id)
+    staging = f"{target}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    manifest = {'outputs': [], 'images': []}
+    for i, (content, mime_type, filename) in enumerate(outputs):
+        is_text = isinstance(content, str)
+        with open(os.path.join(staging, f"output_{i}"), 'wb') as f:
+            f.write(content.encode('utf-8') if is_text else content)
+        manifest['outputs'].append({'file': f"output_{i}", 'mime_type': mime_type, 'filename': filename, 'text': is_text})
+    for i, (cid, data) in enumerate(images or []):
+        with open(os.path.join(staging, f"image_{i}"), 'wb') as f:
+            f.write(data)
+        manifest['images'].append({'file': f"image_{i}", 'cid': cid})
+    with open(os.path.join(staging, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(staging, target)
+
+def load_last_artifacts(design_id):
+    """(outputs, images) del último envío guardado, o None si no hay."""
+    folder = _design_artifacts_dir(design_id)
+    try:
+        with open(os.path.join(folder, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        outputs = []
+        for item in manifest['outputs']:
+            with open(os.path.join(folder, item['file']), 'rb') as f:
+                content = f.read()
+            outputs.append((content.decode('utf-8') if item['text'] else content, item['mime_type'], item['filename']))
+        images = []
+        for item in manifest['images']:
+            with open(os.path.join(folder, item['file']), 'rb') as f:
+                images.append((item['cid'], f.read()))
+        return outputs, images
+    except (OSError, ValueError, KeyError) as e:
+        print(f"No se pudo leer el último envío guardado del diseño {design_id}: {e}")
+        return None
+
+def delete_last_artifacts(design_id):
+    shutil.rmtree(_design_artifacts_dir(design_id), ignore_errors=True)
+
+# --- Consultas en curso (core.query_registry) ---
+def register_running_query(token, pid, label, design_id=None):
+    now = time.time()
+    conn = get_db()
+    with conn:
+        conn.execute("INSERT INTO running_queries (token, pid, label, design_id, started_at, heartbeat) VALUES (?, ?, ?, ?, ?, ?)",
+                     (token, pid, label, design_id, now, now))
+    conn.close()
+
+def unregister_running_query(token):
+    conn = get_db()
+    with conn:
+        conn.execute("DELETE FROM running_queries WHERE token = ?", (token,))
+    conn.close()
+
+def heartbeat_running_queries(tokens):
+    """Refresca el latido de las consultas del proceso y devuelve las que la web pidió cancelar."""
+    placeholders = ','.join('?' * len(tokens))
+    conn = get_db()
+    with conn:
+        conn.execute(f"UPDATE running_queries SET heartbeat = ? WHERE token IN ({placeholders})", [time.time()] + list(tokens))
+        conn.execute("DELETE FROM running_queries WHERE heartbeat < ?", (time.time() - STALE_AFTER_SECONDS,))
+        rows = conn.execute(f"SELECT token FROM running_queries WHERE cancel_requested = 1 AND token IN ({placeholders})",
+                            list(tokens)).fetchall()
+    conn.close()
+    return [row['token'] for row in rows]
+
+def get_running_queries():
+    """Consultas en curso de todos los procesos (con su tiempo transcurrido en segundos)."""
+    now = time.time()
+    conn = get_db()
+    rows = conn.execute("SELECT * FROM running_queries WHERE heartbeat >= ? ORDER BY started_at",
+                        (now - STALE_AFTER_SECONDS,)).fetchall()
+    conn.close()
+    return [dict(row, elapsed_seconds=round(now - row['started_at'], 1)) for row in rows]
+
+def request_query_cancel(token):
+    """Marca la consulta para cancelarla; el proceso que la ejecuta la corta en unos segundos."""
+    conn = get_db()
+    with conn:
+        cursor = conn.execute("UPDATE running_queries SET cancel_requested = 1 WHERE token = ?", (token,))
+    conn.close()
+    if cursor.rowcount == 0:
+        raise ValueError("La consulta ya no está en curso.")
+    running_queries.cancel_local(token) # Si es de este proceso, cancelar sin esperar al vigilante
+
+# --- Turnos de trabajos compartidos entre procesos (core.job_gate) ---
+def try_acquire_job_slot(token, pid, capacity, stale_seconds, priority=3):
+    """Ocupa un turno si hay menos de 'capacity' en curso en todos los procesos y ninguna espera
+    más prioritaria (o de igual prioridad y anterior) lo necesita. Si no lo obtiene, deja o
+    refresca su fila en espera (state='waiting'). Devuelve True si lo obtuvo."""
+    now = time.time()
+    conn = get_db()
+    if conn.in_transaction: # Una escritura previa del hilo sin confirmar haría fallar BEGIN IMMEDIATE
+        conn.rollback()
+    conn.execute("BEGIN IMMEDIATE") # Contar e insertar sin que otro proceso se cuele en medio
+    try:
+        conn.execute("DELETE FROM job_slots WHERE heartbeat < ?", (now - stale_seconds,))
+        conn.execute('''
+            INSERT INTO job_slots (token, pid, acquired_at, heartbeat, priority, state) VALUES (?, ?, ?, ?, ?, 'waiting')
+            ON CONFLICT (token) DO UPDATE SET heartbeat = excluded.heartbeat
+        ''', (token, pid, now, now, priority))
+        running = conn.execute("SELECT COUNT(*) FROM job_slots WHERE state = 'running'").fetchone()[0]
+        # Esperas por delante: más prioritarias, o de igual prioridad y llegada anterior
+        ahead = conn.execute('''
+            SELECT COUNT(*) FROM job_slots AS w JOIN job_slots AS me ON me.token = ?
+            WHERE w.state = 'waiting' AND w.token <> me.token
+              AND (w.priority < me.priority OR (w.priority = me.priority AND w.acquired_at < me.acquired_at))
+        ''', (token,)).fetchone()[0]
+        acquired = running + ahead < capacity
+        if acquired:
+            conn.execute("UPDATE job_slots SET state = 'running', acquired_at = ? WHERE token = ?", (now, token))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return acquired
+
+def release_job_slot(token):
+    conn = get_db()
+    with conn:
+        conn.execute("DELETE FROM job_slots WHERE token = ?", (token,))
+    conn.close()
+
+def heartbeat_job_slots(tokens):
+    placeholders = ','.join('?' * len(tokens))
+    conn = get_db()
+    with conn:
+        conn.execute(f"UPDATE job_slots SET heartbeat = ? WHERE token IN ({placeholders})", [time.time()] + list(tokens))
+    conn.close()
+
+# --- Historial de Ejecuciones (estimación de duración para el programador) ---
+RUNTIME_SAMPLE_SIZE = 5
+JOB_RUNS_KEEP_PER_DESIGN = 50
+
+def record_job_run(design_id, duration_seconds, status):
+    """Guarda la duración de una ejecución programada y recorta el historial del diseño."""
+    conn = get_db()
+    with conn:
+        conn.execute("INSERT INTO job_runs (design_id, duration_seconds, status) VALUES (?, ?, ?)",
+                     (design_id, duration_seconds, status))
+        conn.execute('''
+            DELETE FROM job_runs WHERE design_id = ? AND id NOT IN
+                (SELECT id FROM job_runs WHERE design_id = ? ORDER BY id DESC LIMIT ?)
+        ''', (design_id, design_id, JOB_RUNS_KEEP_PER_DESIGN))
+    conn.close()
+
+def record_pdf_render(design_id, pdf_bytes, seconds):
+    """Acumula el tamaño y el tiempo de render de un PDF del diseño."""
+    conn = get_db()
+    with conn:
+        conn.execute('''
+            INSERT INTO pdf_render_stats (design_id, renders, last_bytes, last_seconds, total_bytes, total_seconds)
+            VALUES (?, 1, ?, ?, ?, ?)
+            ON CONFLICT (design_id) DO UPDATE SET renders = renders + 1, last_bytes = excluded.last_bytes,
+                last_seconds = excluded.last_seconds, total_bytes = total_bytes + excluded.last_bytes,
+                total_seconds = total_seconds + excluded.last_seconds, updated_at = CURRENT_TIMESTAMP
+        ''', (design_id, pdf_bytes, seconds, pdf_bytes, seconds))
+    conn.close()
+
+def get_pdf_render_stats():
+    """design_id -> {'renders', 'last_bytes', 'last_seconds', 'avg_bytes', 'avg_seconds', 'updated_at'}."""
+    conn = get_db()
+    rows = conn.execute("SELECT * FROM pdf_render_stats").fetchall()
+    conn.close()
+    return {row['design_id']: {'renders': row['renders'], 'last_bytes': row['last_bytes'], 'last_seconds': row['last_seconds'],
+                               'avg_bytes': row['total_bytes'] // row['renders'], 'avg_seconds': row['total_seconds'] / row['renders'],
+                               'updated_at': row['updated_at']}
+            for row in rows}
+
+def estimate_runtime(design_id):
+    """Duración estimada (segundos) según las últimas ejecuciones correctas; 0 sin historial."""
+    conn = get_db()
+    row = conn.execute('''
+        SELECT AVG(duration_seconds) FROM
+            (SELECT duration_seconds FROM job_runs WHERE design_id = ? AND status = 'Enviado' ORDER BY id DESC LIMIT ?)
+    ''', (design_id, RUNTIME_SAMPLE_SIZE)).fetchone()
+    conn.close()
+    return float(row[0]) if row and row[0] is not None else 0.0
+
+# --- Agregados Parciales (modo incremental) ---
+def get_report_partials(design_id, plan_hash, day_from):
+    """Días ya calculados y sus agregados desde 'day_from' (YYYY-MM-DD).
+
+    Devuelve (set de días calculados, [{'day', 'group_key', 'totals', 'row_count'}, ...]).
+    """
+    conn = get_db()
+    days = {row['day'] for row in conn.execute(
+        "SELECT day FROM report_partial_days WHERE design_id = ? AND plan_hash = ? AND day >= ?",
+        (design_id, plan_hash, day_from)).fetchall()}
+    rows = conn.execute(
+        "SELECT day, group_key, totals_json, row_count FROM report_partials WHERE design_id = ? AND plan_hash = ? AND day >= ?",
+        (design_id, plan_hash, day_from)).fetchall()
+    conn.close()
+    partials = [{'day': row['day'], 'group_key': row['group_key'], 'totals': json.loads(row['totals_json']),
+                 'row_count': row['row_count']} for row in rows]
+    return days, partials
+
+def save_report_partials(design_id, plan_hash, days, partials, keep_from):
+    """Reemplaza los agregados de 'days' y descarta los anteriores a 'keep_from' o de otro plan."""
+    conn = get_db()
+    with conn:
+        for day in days:
+            conn.execute("DELETE FROM report_partials WHERE design_id = ? AND plan_hash = ? AND day = ?", (design_id, plan_hash, day))
+            conn.execute("INSERT OR IGNORE INTO report_partial_days (design_id, plan_hash, day) VALUES (?, ?, ?)", (design_id, plan_hash, day))
+        conn.executemany(
+            "INSERT INTO report_partials (design_id, plan_hash, day, group_key, totals_json, row_count) VALUES (?, ?, ?, ?, ?, ?)",
+            [(design_id, plan_hash, p['day'], p['group_key'], json.dumps(p['totals']), p['row_count']) for p in partials])
+        for table in ('report_partials', 'report_partial_days'):
+            conn.execute(f"DELETE FROM {table} WHERE design_id = ? AND (plan_hash <> ? OR day < ?)", (design_id, plan_hash, keep_from))
+    conn.close()
 
 # --- Gestión del Historial de Envíos ---
+LOG_ARCHIVE_DIR = os.path.join(PROJECT_ROOT, 'logs_archive')
+LOG_STATUSES = ('Enviado', 'Fallido', 'Omitido')
+
 def log_email_sent(report_name, recipients, status, error_message=None):
     conn = get_db()
-    valid_status = status if status in ('Enviado', 'Fallido', 'Omitido') else 'Fallido'
-    conn.execute('INSERT INTO email_logs (report_name, recipients, status, error_message) VALUES (?, ?, ?, ?)',
-                 (report_name, recipients, valid_status, error_message))
-    conn.commit()
+    valid_status = status if status in LOG_STATUSES else 'Fallido'
+    with conn: # Registro y contador diario en la misma transacción
+        conn.execute('INSERT INTO email_logs (report_name, recipients, status, error_message) VALUES (?, ?, ?, ?)',
+                     (report_name, recipients, valid_status, error_message))
+        conn.execute('''
+            INSERT INTO email_log_stats (day, report_name, status, count) VALUES (date('now'), ?, ?, 1)
+            ON CONFLICT (day, report_name, status) DO UPDATE SET count = count + 1
+        ''', (report_name, valid_status))
     conn.close()
+    metrics.inc('hsp_email_sent_total', status=valid_status)
 
-def get_email_logs(limit=100):
+def get_email_logs(limit=100, before=None, report_name=None, status=None, date_from=None, date_to=None):
+    """Página del historial con paginación por clave (keyset) y filtros.
+
+    before: cursor 'timestamp|id' de la última fila de la página anterior.
+    Devuelve (logs, next_cursor); next_cursor es None si no hay más páginas.
+    """
+    conditions, params = [], []
+    if report_name:
+        conditions.append("report_name = ?"); params.append(report_name)
+    if status in LOG_STATUSES:
+        conditions.append("status = ?"); params.append(status)
+    if date_from:
+        conditions.append("timestamp >= ?"); params.append(f"{date_from} 00:00:00")
+    if date_to:
+        conditions.append("timestamp <= ?"); params.append(f"{date_to} 23:59:59")
+    if before and '|' in before:
+        before_ts, before_id = before.rsplit('|', 1)
+        if before_id.isdigit():
+            conditions.append("(timestamp < ? OR (timestamp = ? AND id < ?))")
+            params.extend([before_ts, before_ts, int(before_id)])
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    conn = get_db()
+    # Se pide una fila extra para saber si existe página siguiente
+    log_rows = conn.execute(f"SELECT * FROM email_logs {where} ORDER BY timestamp DESC, id DESC LIMIT ?",
+                            (*params, limit + 1)).fetchall()
+    conn.close()
+    logs = [dict(row) for row in log_rows[:limit]]
+    next_cursor = f"{logs[-1]['timestamp']}|{logs[-1]['id']}" if len(log_rows) > limit else None
+    return logs, next_cursor
+
+def get_email_log_report_names():
+    """Nombres de reporte presentes en los contadores (para el filtro del historial)."""
     conn = get_db()
-    log_rows = conn.execute("SELECT * FROM email_logs ORDER BY timestamp DESC LIMIT ?", (limit,)).fetchall()
+    rows = conn.execute("SELECT DISTINCT report_name FROM email_log_stats ORDER BY report_name").fetchall()
     conn.close()
-    return [dict(row) for row in log_rows]
+    return [row['report_name'] for row in rows]
+
+def get_email_log_stats(days=30, report_name=None):
+    """Enviados/fallidos/omitidos por día desde los contadores incrementales."""
+    conn = get_db()
+    query = '''
+        SELECT day,
+               SUM(CASE WHEN status = 'Enviado' THEN count ELSE 0 END) AS enviados,
+               SUM(CASE WHEN status = 'Fallido' THEN count ELSE 0 END) AS fallidos,
+               SUM(CASE WHEN status = 'Omitido' THEN count ELSE 0 END) AS omitidos
+        FROM email_log_stats WHERE day >= date('now', ?)
+    '''
+    params = [f'-{int(days)} days']
+    if report_name:
+        query += " AND report_name = ?"; params.append(report_name)
+    rows = conn.execute(query + " GROUP BY day ORDER BY day DESC", params).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def prune_email_logs(retention_days=None, archive=None):
+    """Elimina registros más antiguos que la retención, archivándolos por mes en CSV comprimido.
+
+    Los archivos son 'logs_archive/email_logs_AAAA-MM.csv.gz' (se agregan miembros gzip si
+    el mes ya existe). Los contadores de email_log_stats no se tocan.
+    Devuelve el número de registros eliminados.
+    """
+    settings = get_settings()
+    if retention_days is None: retention_days = settings.get('log_retention_days') or 0
+    if archive is None: archive = bool(settings.get('log_archive_enabled', 1))
+    if not retention_days or int(retention_days) <= 0:
+        return 0
+
+    conn = get_db()
+    cutoff = conn.execute("SELECT datetime('now', ?)", (f'-{int(retention_days)} days',)).fetchone()[0]
+    rows = conn.execute("SELECT * FROM email_logs WHERE timestamp < ? ORDER BY timestamp, id", (cutoff,)).fetchall()
+    if not rows:
+        conn.close()
+        return 0
+
+    if archive:
+        os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+        columns = rows[0].keys()
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(str(row['timestamp'])[:7], []).append(row)
+        for month, month_rows in by_month.items():
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            archive_path = os.path.join(LOG_ARCHIVE_DIR, f'email_logs_{month}.csv.gz')
+            if not os.path.exists(archive_path):
+                writer.writerow(columns)
+            writer.writerows([tuple(row) for row in month_rows])
+            with gzip.open(archive_path, 'at', encoding='utf-8', newline='') as f:
+                f.write(buf.getvalue())
+
+    with conn:
+        conn.execute("DELETE FROM email_logs WHERE timestamp < ?", (cutoff,))
+    conn.close()
+    print(f"Historial de envíos: {len(rows)} registros anteriores a {cutoff} {'archivados y ' if archive else ''}eliminados.")
+    return len(rows)
 
 # --- Gestión Configuración Resumen Diario ---
 def get_daily_summary_config():
@@ -485,18 +1287,22 @@ def get_daily_summary_config():
     return dict(config) if config else {}
 
 def update_daily_summary_config(data):
+    try:
+        query_timeout = max(0, int(data.get('query_timeout') or 0))
+    except ValueError:
+        raise ValueError("El tiempo máximo de consulta debe ser un número de segundos.")
     conn = get_db()
-    conn.execute('''
-        UPDATE daily_summary_config SET
-        is_enabled = ?, connection_id = ?, subject = ?, recipients = ?, schedule_time = ?, sql_query = ?
-        WHERE id = 1
-    ''', (
-        1 if 'is_enabled' in data else 0,
-        data.get('connection_id'),
-        data.get('subject'),
-        data.get('recipients'),
-        data.get('schedule_time'),
-        data.get('sql_query')
-    ))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    with conn:
+        conn.execute('''
+            UPDATE daily_summary_config SET
+            is_enabled = ?, connection_id = ?, subject = ?, recipients = ?, schedule_time = ?, sql_query = ?, query_timeout = ?
+            WHERE id = 1
+        ''', (
+            1 if 'is_enabled' in data else 0,
+            data.get('connection_id'),
+            data.get('subject'),
+            data.get('recipients'),
+            data.get('schedule_time'),
+            data.get('sql_query'),
+            query_timeout
+        ))
\ No newline at end of file
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
 from app.admin.routes import login_required # Reutilizar decorador de login
-from app.admin.services import get_daily_summary_config, update_daily_summary_config, get_all_connections
+from app.admin.services import get_daily_summary_config, update_daily_summary_config, get_all_connections, query_timeout_seconds
 from core.scheduler_service import update_daily_summary_job # Para actualizar tarea al guardar config
 from app.daily_summary.services import get_daily_summary_data # Función para obtener datos
-from jinja2 import Environment, FileSystemLoader # Para renderizar preview
+from app.reports import preview_cache
+from app.reports.numeric import format_number # Filtro currency_format
+from app.utils.email_html import get_email_environment # Para renderizar preview
 import os
 from datetime import datetime
 from flask import current_app # Para acceder a config['PROJECT_ROOT'] en preview
@@ -54,18 +56,21 @@ def preview():
     try:
         # Obtener los datos usando la consulta y conexión proporcionadas
         # Esta función ahora devuelve (True, data_dict) o (False, {'error': msg, 'debug_log': [...]})
-        success, result_data = get_daily_summary_data(connection_id, sql_query)
-
-        if not success:
-            # Si falló, result_data contiene el error y el log
+        # Peticiones simultáneas con la misma conexión y consulta comparten una sola ejecución
+        def load_summary():
+            success, result_data = get_daily_summary_data(connection_id, sql_query, query_timeout_seconds(get_daily_summary_config()))
+            if not success: raise preview_cache.PreviewError(result_data) # Los fallos no se guardan
+            return result_data
+        try:
+            summary_data, _ = preview_cache.get_preview(preview_cache.daily_summary_preview_key(connection_id, sql_query),
+                                                        load_summary, force=bool(data.get('force_refresh')))
+        except preview_cache.PreviewError as e:
+            # Si falló, payload contiene el error y el log
             # Devolvemos este diccionario como JSON con estado 500 (Error Interno del Servidor)
-            return jsonify(result_data), 500
-
-        # Si tuvo éxito, result_data contiene los datos del resumen
-        summary_data = result_data
+            return jsonify(e.payload), 500
         project_root = current_app.config.get('PROJECT_ROOT', os.path.dirname(current_app.root_path))
-        template_loader = FileSystemLoader(searchpath=os.path.join(project_root, 'templates', 'daily_summary'))
-        env = Environment(loader=template_loader)
+        # Entorno cacheado (compartido con la tarea de envío): la plantilla se compila una sola vez
+        env = get_email_environment(os.path.join(project_root, 'templates', 'daily_summary'))
 
         # Añadir filtro de formato de fecha si no existe globalmente (mejor hacerlo global en create_app)
         if 'date_format' not in env.filters:
@@ -78,16 +83,8 @@ def preview():
         
         # Añadir filtro de formato numérico (ej: %.2f) si no existe globalmente
         if 'currency_format' not in env.filters:
-             def currency_format_filter(value, format_spec="%.2f"):
-                 try:
-                     # Intentar convertir a float y formatear
-                     num_value = float(value)
-                     return format_spec % num_value
-                 except (ValueError, TypeError):
-                     # Si no es un número válido, devolver 0.00 formateado o el valor original
-                     try: return format_spec % 0.0
-                     except: return value # Fallback si format_spec es inválido
-             env.filters['currency_format'] = currency_format_filter
+             # Los importes llegan como Decimal: se redondean sin pasar por float (no numéricos, tal cual)
+             env.filters['currency_format'] = format_number
 
 
         template = env.get_template('email_body.html')
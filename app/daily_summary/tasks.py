@@ -1,20 +1,30 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
-from jinja2 import Environment, FileSystemLoader
 import os
 
 # Importar scheduler dentro de la función para evitar importación circular
 # from core.scheduler_service import scheduler 
-from app.admin.services import get_settings as get_smtp_config, log_email_sent, get_daily_summary_config
+from app.admin.services import get_settings as get_smtp_config, log_email_sent, get_daily_summary_config, query_timeout_seconds
 from app.utils.email_sender import send_email
+from app.utils.email_html import get_email_environment, minify_html
 from app.daily_summary.services import get_daily_summary_data
+from app.reports.numeric import format_number
 
-def send_daily_summary_email_task():
-    """Tarea que se ejecuta diariamente para enviar el resumen."""
+DAILY_SUMMARY_PRIORITY = 2 # Turno en core.job_gate (1 = más prioritario)
+
+def send_daily_summary_email_task(lease=None):
+    """Tarea que se ejecuta diariamente para enviar el resumen.
+
+    lease: core.job_queue.JobLease si el trabajo viene de la cola; si se perdió, no se envía
+    (ver app.reports.tasks.lease_lost).
+    """
     # Importar scheduler aquí para tener acceso a app.app_context()
     from core.scheduler_service import scheduler 
+    from core.job_gate import job_gate
+    from app.reports.tasks import lease_lost
     
-    with scheduler.app.app_context(): # Usar el contexto de la app del scheduler
+    # Usar el contexto de la app del scheduler y respetar el máximo de trabajos simultáneos
+    with scheduler.app.app_context(), job_gate.slot(DAILY_SUMMARY_PRIORITY):
         config = get_daily_summary_config()
         smtp_config = get_smtp_config()
         
@@ -44,15 +54,15 @@ def send_daily_summary_email_task():
             print(f"[{datetime.now()}] Iniciando generación del resumen diario de ventas...")
             
             # --- Obtener Datos ---
-            success, data = get_daily_summary_data(config['connection_id'], sql_query) 
+            success, data = get_daily_summary_data(config['connection_id'], sql_query, query_timeout_seconds(config))
             if not success:
                 # 'data' contiene el mensaje de error de get_daily_summary_data
                 raise ValueError(f"Fallo al obtener datos: {data}") 
 
             # --- Renderizar Plantilla HTML ---
             project_root = scheduler.app.config.get('PROJECT_ROOT', os.path.dirname(scheduler.app.root_path))
-            template_loader = FileSystemLoader(searchpath=os.path.join(project_root, 'templates', 'daily_summary'))
-            env = Environment(loader=template_loader)
+            # Entorno cacheado: la plantilla se compila una vez y no en cada envío
+            env = get_email_environment(os.path.join(project_root, 'templates', 'daily_summary'))
             
             # Añadir filtro de formato si no existe globalmente
             if 'date_format' not in env.filters:
@@ -61,9 +71,11 @@ def send_daily_summary_email_task():
                      if isinstance(value, datetime): return value.strftime(format)
                      return value
                  env.filters['date_format'] = date_format_filter
+            if 'currency_format' not in env.filters:
+                 env.filters['currency_format'] = format_number # Importes Decimal sin pasar por float
                  
             template = env.get_template('email_body.html')
-            html_body = template.render(data=data, today_date=datetime.now().strftime('%d/%m/%Y'))
+            html_body = minify_html(template.render(data=data, today_date=datetime.now().strftime('%d/%m/%Y')))
 
             # --- Construir Asunto ---
             subject = config.get('subject', 'Cierre de Ventas Diario Empresa: %empresa%')
@@ -73,6 +85,8 @@ def send_daily_summary_email_task():
                 report_name = f"Resumen Diario {nombre_empresa}" # Actualizar nombre para log
 
             # --- Enviar Correo ---
+            if lease_lost(lease, report_name, recipients_str):
+                return
             send_email(
                 smtp_config=smtp_config,
                 recipients=[e.strip() for e in recipients_str.split(',') if e.strip()], # Limpiar espacios y omitir vacíos
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Plan de ejecución compilado de un diseño.
+
+config_json describe el diseño tal como lo edita el diseñador. En cada ejecución
+build_report_context necesitaba derivar de él los campos visibles y su orden, las
+etiquetas, los totales, la agrupación y el gráfico. Aquí se hace una sola vez por
+versión de la configuración: el plan resultante es inmutable y lleva la huella
+(sha1) de la configuración de la que sale.
+
+services._parse_design_row guarda el plan junto a la configuración decodificada en
+una caché del proceso por diseño (se invalida en save_design/delete_design y, si
+otro proceso cambió el diseño, al ver un config_json distinto).
+
+validate_config() se usa al guardar: un diseño con errores no se guarda, en lugar
+de fallar en la ejecución programada.
+"""
+import hashlib
+import json
+import re
+from types import MappingProxyType
+
+CHART_TYPES = ('bar', 'pie', 'line')
+CHART_FORMATS = ('png', 'svg') # 'svg': gráfico vectorial en el PDF
+RESERVED_PARAM_PREFIX = '_' # Parámetros de la URL de ejecución que no son filtros (p. ej. '_refresh')
+_SCHEDULE_TIME = re.compile(r'([01]?\d|2[0-3]):[0-5]\d')
+
+def config_version(config):
+    """Huella de la configuración (independiente del orden de las claves)."""
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class DesignPlan:
+    """Proyección, etiquetas, totales, agrupación y gráfico de un diseño (en nombres de columna de la consulta).
+
+    columns: campos visibles en el orden del diseño (proyección).
+    labels: campo -> etiqueta de esos campos (renombrado).
+    total_fields: campos a totalizar (se convierten a numérico: plan de tipos).
+    group_by: campo de agrupación o None.
+    chart: (tipo, eje X, eje Y, formato para el PDF) o None.
+    """
+    __slots__ = ('version', 'columns', 'labels', 'total_fields', 'group_by', 'chart')
+
+    def __init__(self, config, version=None):
+        fields = config.get('fields') or {}
+        details = fields.get('details') or {}
+        visible = {f for f, d in details.items() if d.get('visible', True)}
+        columns = tuple(f for f in fields.get('order', []) if f in visible)
+        chart = config.get('chart') or {}
+        set_ = object.__setattr__
+        set_(self, 'version', version or config_version(config))
+        set_(self, 'columns', columns)
+        set_(self, 'labels', MappingProxyType({f: details[f].get('label') or f for f in columns}))
+        set_(self, 'total_fields', tuple(f for f in config.get('total_fields', []) if f in columns))
+        set_(self, 'group_by', config.get('group_by_field') if config.get('group_by_field') in columns else None)
+        set_(self, 'chart', (chart['type'], chart.get('x_axis'), chart.get('y_axis'),
+                             chart.get('format') if chart.get('format') in CHART_FORMATS else 'png')
+             if chart.get('type') in CHART_TYPES and chart.get('x_axis') in columns and chart.get('y_axis') in columns else None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("DesignPlan es inmutable")
+
+def compile_plan(config, version=None):
+    return DesignPlan(config, version)
+
+def incremental_extra_columns(plan):
+    """Campos visibles que el modo incremental no puede mostrar (solo guarda grupo y totales)."""
+    return [f for f in plan.columns if f != plan.group_by and f not in plan.total_fields]
+
+def validate_config(config, schedule_days=None, schedule_time=None):
+    """Errores de la configuración de un diseño (lista vacía si es válida)."""
+    errors = []
+    fields = config.get('fields') or {}
+    details = fields.get('details') or {}
+    plan = compile_plan(config)
+    if not plan.columns:
+        errors.append("El diseño no tiene campos visibles.")
+    labels = [plan.labels[f] for f in plan.columns]
+    repeated = sorted({label for label in labels if labels.count(label) > 1})
+    if repeated:
+        errors.append(f"Hay campos visibles con la misma etiqueta: {', '.join(repeated)}.")
+
+    hidden_totals = [f for f in config.get('total_fields', []) if f not in plan.columns]
+    if hidden_totals:
+        errors.append(f"Los campos a totalizar deben ser visibles: {', '.join(hidden_totals)}.")
+    group_by = config.get('group_by_field')
+    if group_by and group_by not in plan.columns:
+        errors.append(f"El campo de agrupación '{group_by}' debe ser visible.")
+
+    chart = config.get('chart') or {}
+    if chart.get('type'):
+        if chart['type'] not in CHART_TYPES:
+            errors.append(f"Tipo de gráfico no soportado: {chart['type']}.")
+        elif plan.chart is None:
+            errors.append("El gráfico necesita un eje X y un eje Y entre los campos visibles.")
+        if chart.get('format', 'png') not in CHART_FORMATS:
+            errors.append(f"Formato de gráfico no soportado: {chart['format']}.")
+
+    filter_names = [f['name'] for f in config.get('filters', [])]
+    repeated = sorted({name for name in filter_names if filter_names.count(name) > 1})
+    if repeated:
+        errors.append(f"Hay filtros con el mismo nombre: {', '.join(repeated)}.")
+    reserved = [name for name in filter_names if name.startswith(RESERVED_PARAM_PREFIX)]
+    if reserved:
+        errors.append(f"Los nombres de filtro no pueden empezar con '{RESERVED_PARAM_PREFIX}': {', '.join(reserved)}.")
+
+    incremental = config.get('incremental') or {}
+    if incremental.get('enabled'):
+        if not group_by or not config.get('total_fields'):
+            errors.append("El modo incremental requiere un campo de agrupación y campos a totalizar.")
+        if not incremental.get('date_field') or incremental['date_field'] not in details:
+            errors.append("El modo incremental requiere una columna de fecha de la consulta.")
+        if incremental.get('from_filter') not in filter_names or incremental.get('to_filter') not in filter_names:
+            errors.append("Los filtros 'desde' y 'hasta' del modo incremental deben existir entre los filtros.")
+        extra = incremental_extra_columns(plan)
+        if extra:
+            errors.append("El modo incremental muestra una fila por grupo: solo pueden ser visibles el campo de "
+                          f"agrupación y los campos a totalizar (ocultar: {', '.join(extra)}).")
+
+    if schedule_days and not _SCHEDULE_TIME.fullmatch(schedule_time or ''):
+        errors.append("Indica la hora de envío (HH:MM) para los días programados.")
+    return errors
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Descargas de reportes servidas desde archivo, con ETag.
+
+Cada reporte generado desde el navegador se guarda en report_artifacts/downloads/
+con el nombre de su ETag y se envía con send_file (por bloques, con soporte de
+Range y de peticiones condicionales). El ETag depende de la versión del diseño, de
+los valores de filtro y de la huella de datos del repositorio (consulta de control):
+
+- Con consulta de control: si la huella no cambió y el archivo existe, se sirve (o
+  se responde 304) sin volver a consultar el ERP ni generar el reporte.
+- Sin consulta de control no hay forma barata de saber si los datos cambiaron: el
+  reporte se genera (la vista previa compartida evita repetirlo durante unos
+  segundos) y el ETag incluye el hash del contenido, así el navegador solo vuelve a
+  descargarlo si cambió.
+"""
+import hashlib
+import json
+import os
+import time
+
+from app.admin.services import ARTIFACTS_DIR
+from app.reports.preview_cache import report_preview_key, text_hash
+
+DOWNLOADS_DIR = os.path.join(ARTIFACTS_DIR, 'downloads')
+DOWNLOAD_MAX_AGE_SECONDS = 24 * 3600 # Los archivos más antiguos se eliminan al guardar uno nuevo
+
+def download_key(design, filter_values, data_fingerprint):
+    return text_hash(report_preview_key(design, filter_values), data_fingerprint)
+
+def _paths(etag):
+    return os.path.join(DOWNLOADS_DIR, f"{etag}.bin"), os.path.join(DOWNLOADS_DIR, f"{etag}.json")
+
+def find_artifact(etag):
+    """Archivo ya generado para el ETag: {'path', 'etag', 'mimetype', 'filename'} o None."""
+    path, meta_path = _paths(etag)
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not os.path.exists(path): return None
+    return dict(meta, path=path, etag=etag)
+
+def store_artifact(key, output, mimetype, filename, content_etag=False):
+    """Guarda el reporte generado y devuelve su descripción (ver find_artifact).
+
+    content_etag: el ETag incluye el hash del contenido (diseños sin consulta de control).
+    """
+    content = output.encode('utf-8') if isinstance(output, str) else output
+    etag = text_hash(key, hashlib.sha1(content).hexdigest()) if content_etag else key
+    existing = find_artifact(etag)
+    if existing: return existing
+    os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+    _purge_old()
+    path, meta_path = _paths(etag)
+    # Escritura atómica: otra petición puede estar enviando un archivo con el mismo nombre
+    for target, data in ((path, content), (meta_path, json.dumps({'mimetype': mimetype, 'filename': filename}).encode('utf-8'))):
+        staging = f"{target}.{os.getpid()}.{time.monotonic_ns()}.tmp"
+        with open(staging, 'wb') as f:
+            f.write(data)
+        try:
+            os.replace(staging, target)
+        except OSError: # En Windows no se puede reemplazar un archivo abierto: el existente sirve igual
+            os.remove(staging)
+    return {'path': path, 'etag': etag, 'mimetype': mimetype, 'filename': filename}
+
+def _purge_old():
+    limit = time.time() - DOWNLOAD_MAX_AGE_SECONDS
+    for name in os.listdir(DOWNLOADS_DIR):
+        full_path = os.path.join(DOWNLOADS_DIR, name)
+        try:
+            if os.path.getmtime(full_path) < limit: os.remove(full_path)
+        except OSError:
+            pass # En uso o ya eliminado por otra petición
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Reducción de series largas para gráficos de línea (Largest-Triangle-Three-Buckets).
+
+Dibujar decenas de miles de puntos no aporta nada en un gráfico de 8 pulgadas y
+hace crecer el tiempo de matplotlib y el tamaño del PDF con la cantidad de datos.
+LTTB conserva la forma visual de la serie (picos y valles) eligiendo, en cada
+tramo, el punto que forma el triángulo de mayor área con el punto elegido en el
+tramo anterior y el promedio del tramo siguiente. El eje X se toma como posición
+(los ejes de los reportes suelen ser fechas o categorías ordenadas).
+"""
+import numpy as np
+
+def lttb_indices(values, threshold):
+    """Posiciones de los puntos a conservar (siempre el primero y el último)."""
+    n = len(values)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    y = np.asarray(values, dtype=float)
+    x = np.arange(n, dtype=float)
+    bucket_size = (n - 2) / (threshold - 2)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    selected = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n) # En el último tramo, el "siguiente" es el último punto
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        areas = np.abs((x[selected] - avg_x) * (y[start:end] - y[selected])
+                       - (x[selected] - x[start:end]) * (avg_y - y[selected]))
+        selected = start + int(areas.argmax())
+        indices[i + 1] = selected
+    return indices
+
+def downsample_series(series, threshold):
+    """Serie de pandas reducida a 'threshold' puntos como máximo (mismo orden e índice)."""
+    if len(series) <= threshold:
+        return series
+    return series.iloc[lttb_indices(series.to_numpy(dtype=float), threshold)]
@@ -1,177 +1,433 @@
 import pandas as pd
 import os
 import io
+import time
 import base64
 from flask import current_app
-from jinja2 import Environment, FileSystemLoader
-from weasyprint import HTML
-import matplotlib.pyplot as plt
+from jinja2 import Environment
 
-from app.admin.services import get_design_by_id, execute_repository_query
+from app.admin.services import get_design_with_source, execute_repository_query, get_settings, record_pdf_render
+from app.utils.email_html import InlineCssLoader, minify_html
+from app.reports import render_farm, query_batch, incremental, numeric, design_plan, table_render, downsample
+from core import metrics
 
-def generate_report(design_id, filter_values=None):
-    """Genera un reporte, incluyendo grupos, totales y gráficos."""
-    design = get_design_by_id(design_id)
+REPORT_STYLESHEET = 'report_styles.css' # Hoja de estilos del PDF (parseada una vez por proceso)
+
+OUTPUT_FORMATS = ('pdf', 'xlsx', 'html_email')
+OUTPUT_EXTENSIONS = {'pdf': 'pdf', 'xlsx': 'xlsx', 'html_email': 'html'}
+EMAIL_DEFAULT_BUDGET_KB = 100 # Gmail y otros clientes recortan los mensajes de más de ~100 KB
+CHART_MAX_LINE_POINTS = 400 # Puntos máximos de un gráfico de línea (las series largas se reducen con LTTB)
+
+def generate_report(design_id, filter_values=None, shared_query=False):
+    """Genera un reporte, incluyendo grupos, totales y gráficos.
+
+    shared_query: si es True (trabajos programados), la consulta se comparte con otros
+    diseños del mismo lote que usan el mismo repositorio y parámetros.
+    """
+    design = get_design_with_source(design_id) # Diseño, repositorio y conexión en un solo JOIN
+    if not design: raise ValueError("Diseño no encontrado")
+    context = build_report_context(design, filter_values, shared_query)
+    return render_report_output(design, context, design['output_format'])
+
+PREVIEW_SAMPLE_ROWS = 200
+
+def generate_sample_preview(design, filter_values=None, max_rows=PREVIEW_SAMPLE_ROWS):
+    """Vista previa rápida del diseñador: muestra de 'max_rows' filas renderizada como HTML.
+
+    'design' puede ser un diseño sin guardar (mismo formato que get_design_with_source).
+    Se usa la plantilla del PDF con la hoja de estilos en línea, sin pasar por WeasyPrint.
+    Los subtotales y totales corresponden solo a la muestra.
+    """
+    context = build_report_context(design, filter_values, max_rows=max_rows)
+    with open(os.path.join(get_reports_template_dir(), REPORT_STYLESHEET), encoding='utf-8') as f:
+        inline_styles = f.read()
+    template_data = dict(report_template_data(context), inline_styles=inline_styles,
+                         logo_path=None) # El logo local (file:///) no se ve en el navegador
+    return render_template_from_file('report_template.html', template_data)
+
+def get_bundle_formats(design):
+    """Formato principal del diseño seguido de los formatos adicionales del paquete (sin repetir)."""
+    formats = [design['output_format']]
+    for output_format in design.get('config', {}).get('bundle_formats', []):
+        if output_format in OUTPUT_FORMATS and output_format not in formats:
+            formats.append(output_format)
+    return formats
+
+def generate_report_bundle(design_id, filter_values=None, shared_query=False, formats=None):
+    """Genera varias salidas (PDF, XLSX, cuerpo HTML) a partir de una sola ejecución.
+
+    La consulta, la agrupación, los totales y el gráfico se calculan una vez y se
+    reutilizan en cada formato. Pensado para envíos por correo: devuelve
+    (outputs, images), donde outputs es [(output, mimetype, filename), ...] con el
+    formato principal del diseño en primer lugar e images es [(cid, png_bytes), ...]
+    con los gráficos que el cuerpo HTML referencia como cid: (para send_email).
+    """
+    design = get_design_with_source(design_id)
     if not design: raise ValueError("Diseño no encontrado")
+    context = build_report_context(design, filter_values, shared_query)
+    formats = formats or get_bundle_formats(design)
+    # Solo el formato principal puede ser el cuerpo del correo; un HTML adjunto debe abrirse por sí solo
+    outputs = [render_report_output(design, context, output_format, for_email=(output_format == formats[0]))
+               for output_format in formats]
+
+    # Cuerpo HTML recortado por tamaño: adjuntar el reporte completo si el paquete no lo incluye ya
+    if context.get('email_full_html') and not any(f in formats for f in ('pdf', 'xlsx')):
+        filename = outputs[formats.index('html_email')][2].replace('.html', '_completo.html')
+        outputs.append((context['email_full_html'], 'text/html', filename))
+    return outputs, context.get('email_images', [])
+
+def build_report_context(design, filter_values=None, shared_query=False, max_rows=None):
+    """Etapa común a todos los formatos: consulta, campos, grupos, totales y gráfico.
 
+    El gráfico se renderiza al pedirlo cada formato (chart_png o SVG en el PDF) y las
+    filas como diccionarios solo para la plantilla de correo (email_template_data):
+    PDF, vista previa y Excel trabajan sobre el DataFrame.
+    max_rows: solo las primeras filas (vista previa rápida del diseñador).
+    """
     # 1. Obtener y preparar datos
-    params = [filter_values.get(f['name']) for f in design['config'].get('filters', [])] if filter_values else []
-    success, message, raw_data = execute_repository_query(design['repository_id'], params)
-    if not success: raise ConnectionError(f"Error al obtener datos: {message}")
-    df = pd.DataFrame(raw_data['data'], columns=raw_data['columns'])
+    run_query = lambda values: _run_design_query(design, values, shared_query, max_rows)
+    incremental_config = incremental.get_incremental_config(design) if not filter_values and not max_rows else None
+    if incremental_config:
+        # Ejecución sin filtros (programada): solo se consultan los días nuevos de la ventana
+        df = incremental.build_incremental_frame(design, incremental_config, run_query)
+        scales = None
+    else:
+        success, message, raw_data = run_query(filter_values)
+        if not success: raise ConnectionError(f"Error al obtener datos: {message}")
+        df = pd.DataFrame(raw_data['data'], columns=raw_data['columns'])
+        scales = raw_data.get('scales')
     if df.empty: raise ValueError("La consulta no devolvió datos.")
 
-    # Convertir columnas de total a numérico (si es posible)
+    # 2. Proyección, tipos y etiquetas según el plan compilado del diseño (un diseño sin
+    # guardar, como el de la vista previa, se compila aquí)
     config = design['config']
-    total_fields_original = config.get('total_fields', [])
-    for col in total_fields_original:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce') # 'coerce' convierte errores en NaN
+    plan = design.get('plan') or design_plan.compile_plan(config)
+    labels = plan.labels
+    columns = [f for f in plan.columns if f in df.columns]
+    if not columns: raise ValueError("Ningún campo visible existe.")
+    total_fields = [f for f in plan.total_fields if f in df.columns]
+    if incremental_config:
+        # Una fila por grupo: se muestra cuántas filas de detalle resume cada una
+        labels = dict(labels, **{incremental.ROW_COUNT_FIELD: incremental.ROW_COUNT_LABEL})
+        columns.append(incremental.ROW_COUNT_FIELD)
+        total_fields.append(incremental.ROW_COUNT_FIELD)
 
-    # 2. Procesar visibilidad, orden y etiquetas (igual que antes)
-    visible_fields_config = config.get('fields', {}).get('details', {})
-    visible_fields = [f for f, details in visible_fields_config.items() if details.get('visible', True)]
-    existing_visible_fields = [f for f in visible_fields if f in df.columns]
-    if not existing_visible_fields: raise ValueError("Ningún campo visible existe.")
-    df = df[existing_visible_fields]
-    ordered_fields = [f for f in config.get('fields', {}).get('order', []) if f in existing_visible_fields]
-    df = df[ordered_fields]
-    labels = {f: details.get('label', f) for f, details in visible_fields_config.items()}
-    df.rename(columns=labels, inplace=True)
+    # Columnas de total: las DECIMAL/MONEY conservan su Decimal (se suman exactas, ver
+    # numeric); el resto se convierte a numérico como siempre
+    if scales is None: scales = numeric.infer_scales(df, total_fields)
+    for col in total_fields:
+        if col not in scales:
+            df[col] = pd.to_numeric(df[col], errors='coerce') # 'coerce' convierte errores en NaN
+    df = df[columns].rename(columns=labels)
 
-    # Renombrar también los campos de totalizar según las etiquetas
-    total_fields_labeled = [labels.get(f, f) for f in total_fields_original if labels.get(f, f) in df.columns]
+    # Campos de totalizar, agrupación y ejes del gráfico con sus etiquetas
+    total_fields_labeled = [labels[f] for f in total_fields]
+    scales_labeled = {labels[f]: scales[f] for f in total_fields if f in scales}
+    totals = numeric.totals_frame(df, total_fields_labeled, scales_labeled) if total_fields_labeled else None
 
     # 3. Agrupar y calcular subtotales (si se configuró)
     grouped_data = None
-    group_by_field_labeled = labels.get(config.get('group_by_field'))
-    
-    if group_by_field_labeled and group_by_field_labeled in df.columns:
-        grouped = df.groupby(group_by_field_labeled)
-        grouped_data = {}
-        for name, group in grouped:
-            subtotals = group[total_fields_labeled].sum() if total_fields_labeled else None
-            grouped_data[name] = {
-                'rows': group.to_dict(orient='records'),
-                'subtotals': subtotals.to_dict() if subtotals is not None else None
-            }
-            
+    positions = None
+    # En modo incremental cada grupo ya es una sola fila: sin subtotales repetidos
+    group_by_field_labeled = labels[plan.group_by] if plan.group_by in columns and not incremental_config else None
+
+    if group_by_field_labeled:
+        # Grupos una sola vez (los nulos son un grupo más): la tabla y el correo usan sus posiciones
+        names, codes, positions = table_render.group_positions(df[group_by_field_labeled])
+        subtotals = numeric.exact_subtotals(totals, codes, total_fields_labeled, scales_labeled) \
+            if totals is not None else {}
+        # Solo los subtotales: las filas de cada grupo las agrega email_template_data
+        grouped_data = {name: {'subtotals': subtotals.get(code)} for code, name in enumerate(names)}
+
     # 4. Calcular totales generales (si se configuró)
-    grand_totals = df[total_fields_labeled].sum().to_dict() if total_fields_labeled else None
-
-    # 5. Generar gráfico (si se configuró)
-    chart_image_base64 = None
-    chart_config = config.get('chart', {})
-    chart_type = chart_config.get('type')
-    x_axis_original = chart_config.get('x_axis')
-    y_axis_original = chart_config.get('y_axis')
-    
-    # Usar etiquetas si existen
-    x_axis_labeled = labels.get(x_axis_original)
-    y_axis_labeled = labels.get(y_axis_original)
-
-    if chart_type and x_axis_labeled in df.columns and y_axis_labeled in df.columns:
-        chart_image_base64 = generate_chart_base64(df, chart_type, x_axis_labeled, y_axis_labeled)
-
-    # 6. Preparar datos finales para la plantilla
+    grand_totals = numeric.exact_totals(totals, total_fields_labeled, scales_labeled) if totals is not None else None
+
+    # 5. Datos del gráfico (si se configuró); se dibuja en el formato que lo pida
+    chart_spec = None
+    if plan.chart and plan.chart[1] in columns and plan.chart[2] in columns:
+        chart_type, x_axis, y_axis, chart_format = plan.chart
+        with metrics.timer('hsp_report_stage_seconds', stage='chart'):
+            chart_spec = build_chart_spec(df, chart_type, labels[x_axis], labels[y_axis])
+            if chart_spec: chart_spec['format'] = chart_format # El PDF puede usar SVG (ver _render_report_output)
+
+    # 6. Preparar datos finales para las plantillas
     template_data = {
         'title': design['name'],
         'columns': df.columns.tolist(), # Columnas ya renombradas
-        'grouped_data': grouped_data, # Datos agrupados o None
-        'data_rows': df.to_dict(orient='records') if not grouped_data else None, # Datos planos si no hay grupos
+        'grouped_data': grouped_data, # Subtotales por grupo o None
         'group_by_field': group_by_field_labeled,
         'total_fields': total_fields_labeled,
         'grand_totals': grand_totals,
-        'chart_image': chart_image_base64,
+        'chart_image': None, # Lo completa cada formato (PNG, SVG o cid:)
         'branding': config.get('branding', {}),
         'logo_path': get_logo_path(config)
     }
+    return {'df': df, 'template_data': template_data, 'chart_spec': chart_spec, 'group_positions': positions}
+
+def chart_png(context):
+    """PNG del gráfico para correo, Excel y vistas HTML (se dibuja una vez, al primer formato que lo pide)."""
+    if 'chart_png' not in context:
+        spec = context.get('chart_spec')
+        with metrics.timer('hsp_report_stage_seconds', stage='chart'):
+            context['chart_png'] = render_chart(dict(spec, format='png')) if spec else None
+    return context['chart_png']
 
-    # 7. Generar output
+def email_template_data(context, chart_image=None):
+    """Datos de email_template.html: la plantilla recorre las filas como diccionarios.
+
+    Se arman solo para el correo (una vez por contexto); chart_image reemplaza la
+    imagen del gráfico (p. ej. una referencia cid:).
+    """
+    if 'email_rows' not in context:
+        df, template_data = context['df'], context['template_data']
+        if template_data['grouped_data']:
+            context['email_rows'] = {'data_rows': None, 'grouped_data': {
+                name: dict(info, rows=df.iloc[group_rows].to_dict(orient='records'))
+                for (name, info), group_rows in zip(template_data['grouped_data'].items(), context['group_positions'])}}
+        else:
+            context['email_rows'] = {'data_rows': df.to_dict(orient='records'), 'grouped_data': None}
+    return dict(context['template_data'], **context['email_rows'],
+                chart_image=chart_image or png_to_data_uri(chart_png(context)))
+
+def _run_design_query(design, filter_values, shared_query, max_rows=None):
+    """Ejecuta el repositorio del diseño con los valores de filtro (en el orden de sus '?')."""
+    params = [filter_values.get(f['name']) for f in design['config'].get('filters', [])] if filter_values else []
+    source = (design['repository'], design['connection'])
+    run_query = lambda: execute_repository_query(design['repository_id'], params, source=source, max_rows=max_rows,
+                                                 label=f"Diseño '{design['name']}'", design_id=design.get('id'))
+    with metrics.timer('hsp_report_stage_seconds', stage='query'):
+        if shared_query:
+            return query_batch.execute_shared(design['repository'], design['connection'], params, run_query)
+        return run_query()
+
+def render_report_output(design, context, output_format, for_email=False):
+    """Etapa de salida: convierte el contexto común en un formato concreto.
+
+    for_email: para envíos, el HTML de correo referencia el gráfico como cid: (los bytes
+    quedan en context['email_images']) y se recorta al presupuesto de tamaño configurado
+    (el HTML completo, con el gráfico embebido, queda en context['email_full_html']).
+    Sin for_email (vista previa en el navegador) el gráfico va como data URI.
+    """
+    with metrics.timer('hsp_report_stage_seconds', stage=f"render_{output_format}"):
+        return _render_report_output(design, context, output_format, for_email)
+
+def _render_report_output(design, context, output_format, for_email=False):
     safe_filename = "".join(c for c in design['name'] if c.isalnum() or c in (' ', '_')).rstrip()
-    output_format = design['output_format']
-    extension = output_format.split('_')[0]
+    extension = OUTPUT_EXTENSIONS.get(output_format, output_format.split('_')[0])
     filename = f"{safe_filename.replace(' ', '_')}.{extension}"
-    
-    template_map = {
-        'pdf': 'report_template.html',
-        'html_email': 'email_template.html'
-    }
-    template_name = template_map.get(output_format)
-    if not template_name: raise NotImplementedError(f"Formato {output_format} no implementado")
-
-    html_string = render_template_from_file(template_name, template_data)
+    config = design['config']
 
     if output_format == 'pdf':
-        pdf_bytes = HTML(string=html_string).write_pdf()
+        started = time.perf_counter()
+        template_data = report_template_data(context, chart=False)
+        chart_spec = context.get('chart_spec')
+        svg_bytes = None
+        if chart_spec and chart_spec.get('format') == 'svg':
+            # Gráfico vectorial: nítido al imprimir y de tamaño independiente de la resolución
+            with metrics.timer('hsp_report_stage_seconds', stage='chart'):
+                svg_bytes = render_chart(chart_spec)
+        if svg_bytes:
+            template_data['chart_image'] = f"data:image/svg+xml;base64,{base64.b64encode(svg_bytes).decode('utf-8')}"
+        else:
+            template_data['chart_image'] = png_to_data_uri(chart_png(context))
+        html_string = render_template_from_file('report_template.html', template_data)
+        pdf_bytes = render_farm.render_pdf(
+            html_string,
+            stylesheet_paths=[os.path.join(get_reports_template_dir(), REPORT_STYLESHEET)],
+            asset_paths=[get_logo_file(config)]
+        )
+        _record_pdf_render(design, pdf_bytes, time.perf_counter() - started)
         return pdf_bytes, 'application/pdf', filename
     elif output_format == 'html_email':
+        if not for_email:
+            return render_email_html(email_template_data(context))[0], 'text/html', filename
+        png_bytes = chart_png(context)
+        cid = f"report_chart_{design['id']}" if png_bytes else None
+        if cid:
+            context['email_images'] = [(cid, png_bytes)]
+        html_string, full_html = render_email_html(email_template_data(context, f"cid:{cid}" if cid else None),
+                                                   get_email_budget_bytes())
+        if full_html:
+            # El adjunto completo se abre fuera del correo: el gráfico debe ir embebido
+            context['email_full_html'] = render_email_html(email_template_data(context))[0] if cid else full_html
         return html_string, 'text/html', filename
-    else: # Futuro: Excel
+    elif output_format == 'xlsx':
+        return render_xlsx(context), 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', filename
+    else:
         raise NotImplementedError(f"Formato {output_format} no implementado")
 
+def _record_pdf_render(design, pdf_bytes, seconds):
+    """Tamaño y tiempo de render del PDF por diseño (métricas y pantalla de diseños)."""
+    if not design.get('id'): return # Diseño sin guardar (diseñador)
+    metrics.observe('hsp_pdf_size_bytes', len(pdf_bytes), design_id=design['id'])
+    metrics.observe('hsp_pdf_render_seconds', seconds, design_id=design['id'])
+    print(f"  -> PDF '{design['name']}': {len(pdf_bytes) / 1024:.0f} KB en {seconds:.2f} s")
+    try:
+        record_pdf_render(design['id'], len(pdf_bytes), seconds)
+    except Exception as e: # Las estadísticas no deben hacer fallar el reporte
+        print(f"  -> No se pudieron guardar las estadísticas del PDF: {e}")
+
+def report_template_data(context, chart=True):
+    """Datos de report_template.html con el cuerpo de la tabla ya renderizado (ver table_render).
+
+    chart: incluir el gráfico como PNG (el PDF lo resuelve aparte: puede ser SVG).
+    """
+    with metrics.timer('hsp_report_stage_seconds', stage='table'):
+        template_data = dict(context['template_data'], table_body_html=table_render.render_table_body(context['df'], context['template_data'], context.get('group_positions')))
+    if chart:
+        template_data['chart_image'] = png_to_data_uri(chart_png(context))
+    return template_data
+
+def get_email_budget_bytes():
+    """Tamaño máximo del cuerpo HTML de correo (settings.email_size_budget_kb; 0 = sin límite)."""
+    budget_kb = get_settings().get('email_size_budget_kb')
+    budget_kb = EMAIL_DEFAULT_BUDGET_KB if budget_kb is None else budget_kb
+    return budget_kb * 1024 if budget_kb > 0 else None
+
+def _count_rows(template_data):
+    if template_data['grouped_data']:
+        return sum(len(group['rows']) for group in template_data['grouped_data'].values())
+    return len(template_data['data_rows'] or [])
+
+def _truncate_template_data(template_data, max_rows, total_rows):
+    """Copia de los datos de plantilla con a lo sumo 'max_rows' filas de detalle (los totales no cambian)."""
+    truncated = dict(template_data, truncated={'shown_rows': max_rows, 'total_rows': total_rows})
+    if template_data['grouped_data']:
+        groups, remaining = {}, max_rows
+        for name, group in template_data['grouped_data'].items():
+            if remaining <= 0: break
+            groups[name] = dict(group, rows=group['rows'][:remaining])
+            remaining -= len(groups[name]['rows'])
+        truncated['grouped_data'] = groups
+        truncated['data_rows'] = [] # Si no cabe ningún grupo la plantilla recorre la lista plana
+    else:
+        truncated['data_rows'] = (template_data['data_rows'] or [])[:max_rows]
+    return truncated
+
+def render_email_html(template_data, budget_bytes=None):
+    """Renderiza el HTML de correo minificado. Devuelve (html, html_completo o None).
+
+    Si supera 'budget_bytes' se estima el tamaño por fila y se recorta el detalle hasta
+    que quepa; en ese caso el segundo valor es el HTML completo (para adjuntarlo).
+    """
+    render = lambda data: minify_html(render_template_from_file('email_template.html', data))
+    size = lambda html: len(html.encode('utf-8'))
+    full_html = render(template_data)
+    total_rows = _count_rows(template_data)
+    if not budget_bytes or size(full_html) <= budget_bytes or total_rows == 0:
+        return full_html, None
+
+    base_size = size(render(_truncate_template_data(template_data, 0, total_rows)))
+    row_size = max(1.0, (size(full_html) - base_size) / total_rows)
+    shown_rows = max(0, int((budget_bytes - base_size) / row_size))
+    for _ in range(5): # La estimación es lineal; corregir si las filas mostradas son más largas que la media
+        html = render(_truncate_template_data(template_data, shown_rows, total_rows))
+        if size(html) <= budget_bytes or shown_rows == 0: break
+        shown_rows = int(shown_rows * 0.9)
+    print(f"  -> Correo HTML recortado a {shown_rows} de {total_rows} filas ({size(html) // 1024} KB).")
+    return html, full_html
+
+def render_xlsx(context):
+    """Libro Excel: hoja de detalle, resumen por grupo (si hay) y gráfico (si hay)."""
+    template_data = context['template_data']
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+        context['df'].to_excel(writer, sheet_name='Detalle', index=False)
+
+        group_field = template_data['group_by_field']
+        if template_data['grouped_data'] and template_data['total_fields']:
+            summary_rows = [{group_field: name, **(group['subtotals'] or {})}
+                            for name, group in template_data['grouped_data'].items()]
+            if template_data['grand_totals']:
+                summary_rows.append({group_field: 'Total General', **template_data['grand_totals']})
+            pd.DataFrame(summary_rows).to_excel(writer, sheet_name='Resumen', index=False)
+
+        png_bytes = chart_png(context)
+        if png_bytes:
+            worksheet = writer.book.add_worksheet('Gráfico')
+            worksheet.insert_image('B2', 'grafico.png', {'image_data': io.BytesIO(png_bytes)})
+    return buffer.getvalue()
+
 def generate_chart_base64(df, chart_type, x_col, y_col):
     """Genera un gráfico con Matplotlib y lo devuelve como imagen base64."""
+    return png_to_data_uri(generate_chart_png(df, chart_type, x_col, y_col))
+
+def png_to_data_uri(png_bytes):
+    """Imagen PNG como data URI para embeber en HTML (None si no hay imagen)."""
+    if not png_bytes: return None
+    return f"data:image/png;base64,{base64.b64encode(png_bytes).decode('utf-8')}"
+
+def generate_chart_png(df, chart_type, x_col, y_col):
+    """Genera un gráfico con Matplotlib y devuelve los bytes PNG (None si falla)."""
+    return render_chart(build_chart_spec(df, chart_type, x_col, y_col))
+
+def build_chart_spec(df, chart_type, x_col, y_col):
+    """Especificación serializable del gráfico para la granja de render (None si falla)."""
     try:
-        # Asegurarse de que la columna Y sea numérica
-        df[y_col] = pd.to_numeric(df[y_col], errors='coerce').fillna(0)
-        
-        # Agrupar si hay muchos datos en X (ej. tomar top 10)
-        if df[x_col].nunique() > 15:
-            plot_data = df.groupby(x_col)[y_col].sum().nlargest(10)
-        else:
-             plot_data = df.groupby(x_col)[y_col].sum()
-
-        plt.style.use('ggplot')
-        fig, ax = plt.subplots(figsize=(8, 4)) # Tamaño ajustado para reportes
-
-        if chart_type == 'bar':
-            plot_data.plot(kind='bar', ax=ax)
-            plt.ylabel(y_col)
-        elif chart_type == 'pie':
-             # Los gráficos de torta a veces necesitan ajustes si hay muchos valores pequeños
-            plot_data.plot(kind='pie', ax=ax, autopct='%1.1f%%', startangle=90, legend=False)
-            plt.ylabel('') # Ocultar etiqueta Y en tortas
-        elif chart_type == 'line':
-            plot_data.plot(kind='line', ax=ax, marker='o')
-            plt.ylabel(y_col)
-        
-        plt.title(f'{y_col} por {x_col}')
-        plt.xlabel(x_col)
-        plt.xticks(rotation=45, ha='right') # Rotar etiquetas del eje X si son largas
-        plt.tight_layout() # Ajustar márgenes
-
-        # Guardar en memoria como PNG
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png')
-        plt.close(fig) # Liberar memoria
-        buf.seek(0)
-        
-        # Codificar en base64 para embeber en HTML
-        image_base64 = base64.b64encode(buf.read()).decode('utf-8')
-        return f"data:image/png;base64,{image_base64}"
-        
+        # Asegurarse de que la columna Y sea numérica (copia: el gráfico admite float,
+        # pero el DataFrame conserva los Decimal que se muestran en las tablas)
+        y_values = pd.to_numeric(df[y_col], errors='coerce').fillna(0)
+        plot_data = y_values.groupby(df[x_col]).sum()
+
+        if chart_type == 'line':
+            # Serie ordenada por X: las largas se reducen conservando su forma (no el top 10)
+            plot_data = downsample.downsample_series(plot_data, CHART_MAX_LINE_POINTS)
+        elif len(plot_data) > 15:
+            plot_data = plot_data.nlargest(10) # Muchas categorías: tomar el top 10
+
+        # El dibujo se hace en la granja de render (proceso aparte) a partir de una especificación simple
+        return {
+            'type': chart_type,
+            'labels': [str(label) for label in plot_data.index],
+            'values': [float(value) for value in plot_data.values],
+            'title': f'{y_col} por {x_col}',
+            'x_label': x_col,
+            'y_label': y_col,
+            'figsize': (8, 4) # Tamaño ajustado para reportes
+        }
     except Exception as e:
         print(f"Error generando gráfico: {e}")
         return None # Devolver None si falla la generación
 
-# --- Funciones auxiliares (render_template_from_file, get_logo_path) sin cambios ---
-def render_template_from_file(template_name, context):
+def render_chart(spec):
+    """Bytes del gráfico (PNG, o SVG si spec['format'] == 'svg'); None si no hay gráfico o falla."""
+    if not spec: return None
+    try:
+        return render_farm.render_chart(spec)
+    except Exception as e:
+        print(f"Error generando gráfico: {e}")
+        return None
+
+# --- Funciones auxiliares (render_template_from_file, get_logo_path) ---
+_template_envs = {} # searchpath -> Environment (conserva las plantillas compiladas entre renders)
+
+def get_reports_template_dir():
     project_root = current_app.config.get('PROJECT_ROOT', os.path.dirname(current_app.root_path))
-    searchpath = os.path.join(project_root, 'templates', 'reports')
-    template_loader = FileSystemLoader(searchpath=searchpath)
-    env = Environment(loader=template_loader)
+    return os.path.join(project_root, 'templates', 'reports')
+
+def render_template_from_file(template_name, context):
+    searchpath = get_reports_template_dir()
+    env = _template_envs.get(searchpath)
+    if env is None:
+        # auto_reload detecta cambios en disco; InlineCssLoader aplica los estilos de las plantillas de correo al compilarlas
+        env = Environment(loader=InlineCssLoader(searchpath=searchpath))
+        # Añadir 'zip' al entorno para usarlo en la plantilla
+        env.globals['zip'] = zip
+        _template_envs[searchpath] = env
     try:
         template = env.get_template(template_name)
     except Exception as e:
         raise FileNotFoundError(f"Plantilla '{template_name}' no encontrada en '{searchpath}'. Error: {e}")
-    # Añadir 'zip' al entorno para usarlo en la plantilla
-    env.globals['zip'] = zip
     return template.render(context)
 
-def get_logo_path(config):
+def get_logo_file(config):
+    """Ruta en disco del logo del diseño (None si no tiene o no existe)."""
     logo_filename = config.get('branding', {}).get('logo_filename')
     if not logo_filename: return None
     project_root = current_app.config.get('PROJECT_ROOT', os.path.dirname(current_app.root_path))
     logo_path = os.path.join(project_root, 'uploads', logo_filename)
-    return f'file:///{logo_path}' if os.path.exists(logo_path) else None
\ No newline at end of file
+    return logo_path if os.path.exists(logo_path) else None
+
+def get_logo_path(config):
+    logo_path = get_logo_file(config)
+    return f'file:///{logo_path}' if logo_path else None
\ No newline at end of file
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Reducción del peso de las imágenes que van en los reportes.
+
+- Logos: se reducen y recodifican una sola vez al subirlos (save_design). El
+  reporte los muestra a 60 px de alto; guardar la foto original de varios MB
+  hacía que cada PDF la llevara completa.
+- Gráficos PNG: matplotlib guarda color verdadero sin optimizar; se pasan a una
+  paleta de 256 colores (los gráficos tienen pocos colores planos) y solo se usa
+  el resultado si pesa menos.
+
+Pillow es opcional: sin él, los logos se guardan tal cual y los gráficos no se
+recomprimen (WeasyPrint igualmente optimiza las imágenes al escribir el PDF,
+ver pdf_renderer).
+"""
+import io
+import os
+
+LOGO_MAX_WIDTH = 1200 # px: ~300 ppp para un logo ancho a 60 px CSS de alto
+LOGO_MAX_HEIGHT = 240
+LOGO_JPEG_QUALITY = 85
+LOGO_FORMATS = {'.png': 'PNG', '.jpg': 'JPEG', '.jpeg': 'JPEG'} # Se conserva el formato (y el nombre)
+
+def _pillow():
+    try:
+        from PIL import Image, ImageOps
+        return Image, ImageOps
+    except ImportError:
+        return None, None
+
+def logo_filename(filename):
+    """Nombre con el que se guardará el logo: los formatos que no son PNG/JPEG se convierten a PNG."""
+    base, ext = os.path.splitext(filename)
+    if ext.lower() in LOGO_FORMATS or ext.lower() == '.svg' or _pillow()[0] is None:
+        return filename
+    return f"{base}.png"
+
+def optimize_logo(data, filename):
+    """Bytes del logo reducido a LOGO_MAX_WIDTH x LOGO_MAX_HEIGHT y sin metadatos.
+
+    filename es el nombre final (logo_filename). Devuelve los bytes originales si
+    es SVG, si Pillow no está instalado o si el resultado no pesa menos.
+    ValueError si Pillow no reconoce el archivo como imagen.
+    """
+    Image, ImageOps = _pillow()
+    if Image is None or filename.lower().endswith('.svg'):
+        return data
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image) # Fotos de cámara/teléfono: respetar la orientación
+    except Exception as e:
+        raise ValueError(f"El logo no es una imagen válida: {e}")
+    image_format = LOGO_FORMATS.get(os.path.splitext(filename)[1].lower(), 'PNG')
+    original_size = image.size
+    image.thumbnail((LOGO_MAX_WIDTH, LOGO_MAX_HEIGHT), Image.LANCZOS)
+
+    buf = io.BytesIO()
+    if image_format == 'JPEG':
+        image.convert('RGB').save(buf, 'JPEG', quality=LOGO_JPEG_QUALITY, optimize=True, progressive=True)
+    else:
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+            image = image.convert('RGBA')
+        image.save(buf, 'PNG', optimize=True)
+    optimized = buf.getvalue()
+    if len(optimized) >= len(data) and image.size == original_size and filename.lower().endswith(tuple(LOGO_FORMATS)):
+        return data # Ya estaba optimizado
+    print(f"  -> Logo optimizado: {original_size[0]}x{original_size[1]} ({len(data) // 1024} KB) -> "
+          f"{image.size[0]}x{image.size[1]} ({len(optimized) // 1024} KB)")
+    return optimized
+
+def compress_png(png_bytes):
+    """PNG con paleta de 256 colores si pesa menos que el original (sin Pillow, el original)."""
+    Image, _ = _pillow()
+    if Image is None or not png_bytes:
+        return png_bytes
+    try:
+        image = Image.open(io.BytesIO(png_bytes))
+        if image.mode == 'RGBA' and image.getextrema()[3][0] == 255: # Sin transparencia (fondo de matplotlib)
+            image = image.convert('RGB')
+        if image.mode != 'RGB':
+            return png_bytes
+        buf = io.BytesIO()
+        image.quantize(colors=256, dither=0).save(buf, 'PNG', optimize=True) # Sin tramado: colores planos
+        return buf.getvalue() if buf.tell() < len(png_bytes) else png_bytes
+    except Exception as e:
+        print(f"  -> No se pudo comprimir el gráfico PNG: {e}")
+        return png_bytes
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Recalculo incremental para reportes recurrentes con rango de fechas.
+
+Para diseños con 'group_by_field' y 'total_fields', cada ejecución programada guarda
+agregados parciales por día y grupo (sumas de los campos de total y número de filas).
+La siguiente ejecución solo consulta los días que faltan más los últimos
+'recheck_days' (el día en curso aún no está cerrado) y arma subtotales y totales
+fusionando los parciales de toda la ventana.
+
+Requisitos del diseño (config['incremental']):
+    date_field   -> columna del resultado con la fecha de cada fila
+    from_filter  -> filtro (parámetro '?') con la fecha inicial del rango
+    to_filter    -> filtro con la fecha final del rango
+    window_days  -> días que cubre el reporte (hasta hoy incluido)
+    recheck_days -> días finales que se recalculan siempre (por defecto 1: hoy)
+
+El reporte resultante muestra una fila por grupo con sus totales y el número de
+filas (no el detalle): solo admite diseños cuyos campos visibles son el de
+agrupación y los de total (ver design_plan.validate_config). Las claves de grupo
+se guardan con su tipo (número, fecha o texto) para que el orden y el formato
+sean los del reporte normal.
+"""
+import hashlib
+import json
+from datetime import date, timedelta
+from decimal import Decimal
+
+import pandas as pd
+
+from app.admin.services import get_report_partials, save_report_partials
+from app.reports import numeric, design_plan
+
+ROW_COUNT_FIELD = '__row_count'
+ROW_COUNT_LABEL = 'Filas'
+KEY_FORMAT = 2 # Versión de la codificación de group_key (cambiarla recalcula los parciales)
+
+def get_incremental_config(design):
+    """Configuración incremental del diseño si es aplicable; None en caso contrario."""
+    config = design.get('config', {})
+    incremental = config.get('incremental') or {}
+    if not incremental.get('enabled'):
+        return None
+    if not config.get('group_by_field') or not config.get('total_fields'):
+        return None
+    filter_names = {f['name'] for f in config.get('filters', [])}
+    if not incremental.get('date_field') or incremental.get('from_filter') not in filter_names \
+            or incremental.get('to_filter') not in filter_names:
+        print(f"  -> Modo incremental ignorado en '{design.get('name')}': falta la columna de fecha o los filtros del rango.")
+        return None
+    extra = design_plan.incremental_extra_columns(design.get('plan') or design_plan.compile_plan(config))
+    if extra: # Diseño guardado antes de la validación: mejor el reporte completo que perder columnas
+        print(f"  -> Modo incremental ignorado en '{design.get('name')}': campos visibles fuera de grupo y totales ({', '.join(extra)}).")
+        return None
+    return incremental
+
+def encode_group_key(value):
+    """Clave de grupo -> texto JSON que conserva el tipo (número, Decimal, fecha o texto)."""
+    if isinstance(value, bool) or value is None:
+        return json.dumps(value)
+    if isinstance(value, (int, float)) or hasattr(value, 'dtype') and pd.api.types.is_number(value):
+        return json.dumps(value.item() if hasattr(value, 'item') else value)
+    if isinstance(value, Decimal):
+        return json.dumps({'decimal': str(value)})
+    if isinstance(value, (pd.Timestamp, date)):
+        return json.dumps({'datetime': pd.Timestamp(value).isoformat()})
+    return json.dumps(str(value))
+
+def decode_group_key(text):
+    value = json.loads(text)
+    if isinstance(value, dict):
+        if 'decimal' in value: return Decimal(value['decimal'])
+        if 'datetime' in value: return pd.Timestamp(value['datetime'])
+    return value
+
+def _sorted_groups(items):
+    try:
+        return sorted(items, key=lambda item: item[0])
+    except TypeError: # Tipos mezclados en la columna de agrupación
+        return sorted(items, key=lambda item: str(item[0]))
+
+def plan_hash(design, incremental):
+    """Huella de todo lo que afecta a los agregados: si cambia, los parciales se recalculan."""
+    config = design['config']
+    plan = {
+        'sql': (design.get('repository') or {}).get('sql_query'),
+        'connection_id': (design.get('connection') or {}).get('id'),
+        'group_by_field': config.get('group_by_field'),
+        'total_fields': sorted(config.get('total_fields', [])),
+        'filters': [f['name'] for f in config.get('filters', [])],
+        'date_field': incremental['date_field'],
+        'from_filter': incremental['from_filter'],
+        'to_filter': incremental['to_filter'],
+        'key_format': KEY_FORMAT
+    }
+    return hashlib.sha1(json.dumps(plan, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def _aggregate_by_day(df, date_field, group_field, total_fields, scales):
+    """Filas de la consulta -> parciales [{'day', 'group_key', 'totals', 'row_count'}].
+
+    Los totales de columnas decimales se guardan como texto ("1234.50") para no perder
+    exactitud en el JSON; el resto como float.
+    """
+    if df.empty:
+        return []
+    days = pd.to_datetime(df[date_field], errors='coerce').dt.strftime('%Y-%m-%d')
+    valid = days.notna()
+    frame = numeric.totals_frame(df[valid], total_fields, scales)
+    keys = [days[valid].rename('__day'), df.loc[valid, group_field].rename('__group')]
+    sums = numeric.exact_subtotals(frame, keys, total_fields, scales)
+    counts = frame.groupby(keys).size()
+    return [{'day': day, 'group_key': encode_group_key(group_key),
+             'totals': {col: str(value) if col in scales else float(value) for col, value in totals.items()},
+             'row_count': int(counts.loc[(day, group_key)])}
+            for (day, group_key), totals in sums.items()]
+
+def build_incremental_frame(design, incremental, run_query, today=None):
+    """Devuelve un DataFrame con una fila por grupo: campo de agrupación, totales y ROW_COUNT_FIELD.
+
+    run_query(filter_values) debe devolver la tupla (success, message, data) de
+    execute_repository_query para los valores de filtro indicados.
+    """
+    config = design['config']
+    group_field = config['group_by_field']
+    total_fields = list(config['total_fields'])
+    date_field = incremental['date_field']
+    window_days = max(1, int(incremental.get('window_days') or 30))
+    recheck_days = min(window_days, max(1, int(incremental.get('recheck_days') or 1)))
+
+    today = today or date.today()
+    window = [today - timedelta(days=offset) for offset in range(window_days - 1, -1, -1)]
+    window_start = window[0].isoformat()
+    digest = plan_hash(design, incremental)
+
+    computed_days, partials = get_report_partials(design['id'], digest, window_start)
+    recheck = {d.isoformat() for d in window[-recheck_days:]}
+    pending = [d for d in window if d.isoformat() not in computed_days or d.isoformat() in recheck]
+
+    if pending:
+        query_from, query_to = pending[0], today # Rango contiguo desde el primer día pendiente
+        filter_values = {incremental['from_filter']: query_from.isoformat(), incremental['to_filter']: query_to.isoformat()}
+        success, message, raw_data = run_query(filter_values)
+        if not success: raise ConnectionError(f"Error al obtener datos: {message}")
+        df = pd.DataFrame(raw_data['data'], columns=raw_data['columns'])
+        missing = [c for c in [date_field, group_field] + total_fields if c not in df.columns]
+        if missing: raise ValueError(f"Modo incremental: la consulta no devuelve las columnas {', '.join(missing)}.")
+
+        refreshed_days = [d.isoformat() for d in window if d >= query_from]
+        scales = {col: scale for col, scale in (raw_data.get('scales') or {}).items() if col in total_fields}
+        fresh = [p for p in _aggregate_by_day(df, date_field, group_field, total_fields, scales) if p['day'] in refreshed_days]
+        save_report_partials(design['id'], digest, refreshed_days, fresh, window_start)
+        partials = [p for p in partials if p['day'] not in refreshed_days] + fresh
+        print(f"  -> Modo incremental: consultados {len(refreshed_days)} de {window_days} días.")
+    else:
+        print("  -> Modo incremental: todos los días de la ventana ya estaban calculados.")
+
+    # Fusionar parciales: un registro por grupo con sus sumas (en Decimal; los totales
+    # guardados como texto son decimales exactos, los demás vuelven a float)
+    merged, exact_fields = {}, set()
+    for partial in partials:
+        entry = merged.setdefault(partial['group_key'], {col: Decimal(0) for col in total_fields})
+        for col in total_fields:
+            value = partial['totals'].get(col, 0)
+            if isinstance(value, str): exact_fields.add(col)
+            entry[col] += numeric.to_decimal(value) or 0
+        entry[ROW_COUNT_FIELD] = entry.get(ROW_COUNT_FIELD, 0) + partial['row_count']
+    for entry in merged.values():
+        for col in total_fields:
+            if col not in exact_fields: entry[col] = float(entry[col])
+    rows = [{group_field: group_key, **values}
+            for group_key, values in _sorted_groups((decode_group_key(k), v) for k, v in merged.items())]
+    return pd.DataFrame(rows, columns=[group_field] + total_fields + [ROW_COUNT_FIELD])
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Envíos manuales de reportes por correo (uno o varios a la vez).
+
+send_manual_report() es lo que hacía la ruta /send-report-email: generar el
+paquete del diseño con los filtros indicados, enviarlo y registrar el envío.
+
+Para el cierre de mes, start_bulk_send() recibe muchos (diseño, filtros,
+destinatarios) y los ejecuta en segundo plano: cada envío espera turno en
+core.job_gate (el mismo presupuesto de SQL Server, CPU y SMTP que los reportes
+programados, compartido con el proceso del programador, por prioridad del diseño) y los que comparten repositorio y
+parámetros ejecutan la consulta una sola vez (query_batch). El avance de cada
+envío se consulta con get_bulk_run(); las ejecuciones viven en memoria del
+proceso web y se olvidan BULK_KEEP_SECONDS después de terminar.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from app.admin.services import get_design_by_id, get_settings, log_email_sent
+from app.utils.email_sender import send_email, attachments_from_outputs
+
+BULK_MAX_ITEMS = 200
+BULK_MAX_WORKERS = 8 # Hilos esperando turno; el paralelismo real lo fija core.job_gate
+BULK_KEEP_SECONDS = 3600
+
+STATUS_QUEUED = 'En cola'
+STATUS_RUNNING = 'En curso'
+STATUS_SENT = 'Enviado'
+STATUS_FAILED = 'Fallido'
+
+def split_emails(value):
+    return [e.strip() for e in (value or '').split(',') if e.strip()]
+
+def filter_values_for(design, values):
+    """Valores de los filtros declarados en el diseño (los demás se ignoran)."""
+    return {f['name']: (values or {}).get(f['name']) for f in design['config'].get('filters', [])}
+
+def send_manual_report(design, filter_values, email_to, email_cc='', subject=None, body_extra='', shared_query=False):
+    """Genera el reporte y lo envía a los destinatarios indicados. Devuelve (success, message).
+
+    El resultado (enviado o fallido) queda en el historial de envíos.
+    """
+    report_name = design['name'] if design else 'Diseño no encontrado'
+    recipients_str = f"Manual a: {email_to} | CC: {email_cc or ''}"
+    try:
+        if not design:
+            raise ValueError("Diseño no encontrado")
+        smtp_config = get_settings()
+        if not smtp_config.get('smtp_server'):
+            raise ValueError("Servidor SMTP no configurado.")
+        recipients = split_emails(email_to)
+        if not recipients:
+            raise ValueError("Indica al menos un destinatario.")
+
+        # Generar el reporte y los formatos adicionales del paquete (una sola consulta)
+        from app.reports.generator_service import generate_report_bundle # Carga diferida (pandas/WeasyPrint)
+        outputs, images = generate_report_bundle(design['id'], filter_values, shared_query=shared_query)
+        output = outputs[0][0]
+
+        body = f"{body_extra}\n\n" if body_extra else ""
+        if design['output_format'] == 'html_email':
+            body += output # El reporte es el cuerpo principal
+            is_html_body = True
+            attachments = attachments_from_outputs(outputs[1:])
+        else:
+            body += "Adjunto encontrará el reporte solicitado."
+            is_html_body = False
+            attachments = attachments_from_outputs(outputs)
+
+        send_email(
+            smtp_config=smtp_config,
+            recipients=recipients,
+            cc=split_emails(email_cc),
+            subject=subject or f"Reporte: {report_name}",
+            body=body,
+            is_html=is_html_body,
+            attachments=attachments,
+            images=images
+        )
+        log_email_sent(report_name, recipients_str, STATUS_SENT)
+        return True, f"Reporte '{report_name}' enviado correctamente."
+    except Exception as e:
+        log_email_sent(report_name, recipients_str, STATUS_FAILED, str(e))
+        return False, str(e)
+
+class BulkRun:
+    """Un envío masivo: estado de cada elemento y resultado consolidado."""
+    def __init__(self, items):
+        self.id = uuid.uuid4().hex
+        self.started_at = datetime.now()
+        self.finished_at = None
+        self.finished_monotonic = None
+        self.items = items
+        self._lock = threading.Lock()
+
+    def update(self, item, **changes):
+        with self._lock:
+            item.update(changes)
+            if all(i['status'] in (STATUS_SENT, STATUS_FAILED) for i in self.items):
+                self.finished_at = datetime.now()
+                self.finished_monotonic = time.monotonic()
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def to_dict(self):
+        with self._lock:
+            items = [{k: v for k, v in item.items() if not k.startswith('_')} for item in self.items]
+            counts = {status: sum(1 for i in items if i['status'] == status)
+                      for status in (STATUS_QUEUED, STATUS_RUNNING, STATUS_SENT, STATUS_FAILED)}
+            return {
+                'id': self.id,
+                'finished': self.finished,
+                'started_at': self.started_at.strftime('%Y-%m-%d %H:%M:%S'),
+                'finished_at': self.finished_at.strftime('%Y-%m-%d %H:%M:%S') if self.finished_at else None,
+                'total': len(items),
+                'done': counts[STATUS_SENT] + counts[STATUS_FAILED],
+                'sent': counts[STATUS_SENT],
+                'failed': counts[STATUS_FAILED],
+                'items': items,
+            }
+
+_runs = {} # id -> BulkRun
+_runs_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=BULK_MAX_WORKERS, thread_name_prefix='hsp-bulk-send')
+
+def _purge_finished_runs():
+    now = time.monotonic()
+    with _runs_lock:
+        for run_id in [r.id for r in _runs.values() if r.finished and now - r.finished_monotonic > BULK_KEEP_SECONDS]:
+            del _runs[run_id]
+
+def _prepare_items(raw_items):
+    """Valida la petición y arma los elementos del envío. Lanza ValueError con todos los errores."""
+    if not isinstance(raw_items, list) or not raw_items:
+        raise ValueError("Indica al menos un reporte a enviar.")
+    if len(raw_items) > BULK_MAX_ITEMS:
+        raise ValueError(f"Se pueden enviar como máximo {BULK_MAX_ITEMS} reportes por lote.")
+    items, errors = [], []
+    designs = {}
+    for index, raw in enumerate(raw_items, start=1):
+        raw = raw if isinstance(raw, dict) else {}
+        design_id = raw.get('design_id')
+        if design_id not in designs:
+            try:
+                designs[design_id] = get_design_by_id(int(design_id))
+            except (TypeError, ValueError):
+                designs[design_id] = None
+        design = designs[design_id]
+        if not design:
+            errors.append(f"#{index}: diseño '{design_id}' no encontrado.")
+            continue
+        filter_values = filter_values_for(design, raw.get('filters'))
+        missing = [f.get('label') or f['name'] for f in design['config'].get('filters', [])
+                   if filter_values[f['name']] in (None, '')]
+        email_to = raw.get('email_to') if raw.get('email_to') is not None else design.get('email_to')
+        email_cc = raw.get('email_cc') if raw.get('email_cc') is not None else design.get('email_cc')
+        if missing:
+            errors.append(f"#{index} '{design['name']}': faltan los filtros {', '.join(missing)}.")
+        if not split_emails(email_to):
+            errors.append(f"#{index} '{design['name']}': sin destinatarios.")
+        items.append({
+            'index': index, 'design_id': design['id'], 'name': design['name'], 'email_to': email_to or '',
+            'status': STATUS_QUEUED, 'message': None, 'seconds': None,
+            '_design': design, '_filters': filter_values, '_email_cc': email_cc or '',
+            '_subject': raw.get('subject') or f"Reporte: {design['name']}", '_body': raw.get('body') or '',
+        })
+    if errors:
+        raise ValueError(' '.join(errors))
+    return items
+
+def _run_item(app, run, item):
+    from core.job_gate import job_gate
+    design = item['_design']
+    try:
+        with app.app_context(), job_gate.slot(design.get('priority') or 3):
+            run.update(item, status=STATUS_RUNNING)
+            started = time.perf_counter()
+            # shared_query: los elementos con el mismo repositorio y filtros comparten la consulta
+            success, message = send_manual_report(design, item['_filters'], item['email_to'], item['_email_cc'],
+                                                   item['_subject'], item['_body'], shared_query=True)
+            run.update(item, status=STATUS_SENT if success else STATUS_FAILED, message=message,
+                       seconds=round(time.perf_counter() - started, 1))
+    except Exception as e: # Nunca dejar un elemento 'En curso' para siempre
+        run.update(item, status=STATUS_FAILED, message=str(e))
+    if run.finished:
+        summary = run.to_dict()
+        print(f"[{datetime.now()}] Envío masivo {run.id[:8]} terminado: "
+              f"{summary['sent']} enviados, {summary['failed']} fallidos de {summary['total']}.")
+
+def start_bulk_send(app, raw_items):
+    """Valida y lanza un envío masivo en segundo plano. Devuelve el BulkRun (ValueError si la petición no es válida)."""
+    from core.scheduler_service import apply_concurrency_settings
+    _purge_finished_runs()
+    items = _prepare_items(raw_items)
+    apply_concurrency_settings() # El proceso web usa el mismo máximo de trabajos simultáneos que el programador
+    run = BulkRun(items)
+    with _runs_lock:
+        _runs[run.id] = run
+    print(f"[{datetime.now()}] Envío masivo {run.id[:8]}: {len(items)} reportes en cola.")
+    for item in items:
+        _executor.submit(_run_item, app, run, item)
+    return run
+
+def get_bulk_run(run_id):
+    with _runs_lock:
+        return _runs.get(run_id)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Importes exactos para columnas DECIMAL/MONEY.
+
+pyodbc entrega DECIMAL y MONEY de SQL Server como decimal.Decimal. Sumarlos como
+float pierde centavos en totales grandes; sumar los Decimal tal como llegan es
+exacto y, con la suma de pandas sobre la columna (object), tan rápido como la
+suma de Python: no hace falta ninguna conversión intermedia.
+
+'scales' (de cursor.description, ver execute_repository_query, clave 'scales')
+indica qué columnas son decimales; si no se conoce (p. ej. parciales del modo
+incremental) se deduce de los valores. Las demás columnas se suman como float,
+como antes. pandas se importa dentro de las funciones que lo usan: el resumen
+diario solo necesita to_decimal y format_number y no debe cargarlo al arrancar.
+"""
+import re
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+_FIXED_FORMAT = re.compile(r'%\.(\d+)f')
+
+def to_decimal(value):
+    """Decimal exacto del valor (None si no es numérico). Los float pasan por str() para no arrastrar binario."""
+    if value is None or isinstance(value, Decimal):
+        return value
+    try:
+        number = Decimal(str(value).strip())
+    except (InvalidOperation, ValueError):
+        return None
+    return number if number.is_finite() else None
+
+def infer_scales(df, fields):
+    """Escala de las columnas cuyos valores son Decimal (máximo número de decimales observado)."""
+    scales = {}
+    for field in fields:
+        values = [v for v in df[field] if isinstance(v, Decimal) and v.is_finite()]
+        if values:
+            scales[field] = max(0, max(-v.as_tuple().exponent for v in values))
+    return scales
+
+def _decimal_column(series):
+    """Columna de Decimal (nulos como None). Si ya llega así de pyodbc, se usa sin recorrerla."""
+    import pandas as pd
+    if pd.api.types.infer_dtype(series, skipna=True) == 'decimal':
+        return series
+    return series.map(to_decimal).astype(object)
+
+def totals_frame(df, fields, scales):
+    """Columnas listas para sumar: Decimal (campos en 'scales') o float (resto, como antes)."""
+    import pandas as pd
+    return pd.DataFrame({field: _decimal_column(df[field]) if field in scales
+                         else pd.to_numeric(df[field], errors='coerce') for field in fields}, index=df.index)
+
+def _restore(values, fields, scales):
+    # Un grupo sin valores suma 0 (int): devolver siempre Decimal en las columnas decimales
+    return {field: (values[field] if isinstance(values[field], Decimal) else Decimal(int(values[field] or 0)))
+            if field in scales else values[field] for field in fields}
+
+def exact_totals(frame, fields, scales):
+    """Totales de 'frame' (salida de totals_frame): {campo: Decimal o float}."""
+    sums = frame[fields].sum()
+    return _restore({field: sums[field] for field in fields}, fields, scales)
+
+def exact_subtotals(frame, keys, fields, scales):
+    """Subtotales por clave de grupo: {grupo: {campo: valor}} (un solo groupby para todos los grupos)."""
+    sums = frame[fields].groupby(keys).sum()
+    # Columna por columna: convertir filas mezclaría Decimal con float
+    columns = {field: sums[field].tolist() for field in fields}
+    return {name: _restore({field: columns[field][i] for field in fields}, fields, scales)
+            for i, name in enumerate(sums.index)}
+
+def format_number(value, format_spec="%.2f"):
+    """Formato numérico ("%.2f") sin pasar por float para importes Decimal."""
+    match = _FIXED_FORMAT.fullmatch(format_spec)
+    if not match:
+        try: return format_spec % float(value)
+        except (ValueError, TypeError): return value
+    number = to_decimal(value if value is not None else 0)
+    if number is None: return value # No numérico: se muestra tal cual (como el filtro anterior)
+    return f"{number.quantize(Decimal(1).scaleb(-int(match.group(1))), rounding=ROUND_HALF_UP):f}"
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Motor de renderizado PDF (WeasyPrint) de larga duración, uno por proceso.
+
+Conserva entre renders la configuración de fuentes, las hojas de estilo ya
+parseadas y las imágenes decodificadas (logos), para que un lote de reportes
+no pague el coste de preparación en cada PDF.
+
+Tamaño del PDF: las fuentes se incrustan solo con los glifos usados y sin
+hinting, y las imágenes se recomprimen y se limitan a PDF_IMAGE_DPI (ver
+pdf_write_options; los logos ya llegan reducidos, ver image_optimize).
+"""
+import os
+import threading
+import weasyprint
+from weasyprint import HTML, CSS
+from weasyprint.text.fonts import FontConfiguration
+
+PDF_IMAGE_DPI = 200 # Suficiente para imprimir; las imágenes más grandes se reducen
+PDF_JPEG_QUALITY = 85
+
+def _weasyprint_59():
+    return 'optimize_images' in getattr(weasyprint, 'DEFAULT_OPTIONS', {})
+
+def pdf_write_options(image_cache):
+    """Opciones de write_pdf (tamaño y caché de imágenes) según la versión de WeasyPrint instalada."""
+    if _weasyprint_59():
+        return {'optimize_images': True, 'jpeg_quality': PDF_JPEG_QUALITY, 'dpi': PDF_IMAGE_DPI,
+                'full_fonts': False, 'hinting': False, 'cache': image_cache}
+    # WeasyPrint 53-58: sin opciones de calidad/resolución y la caché se llama image_cache
+    return {'optimize_size': ('fonts', 'images'), 'image_cache': image_cache}
+
+class PdfRenderer:
+    def __init__(self):
+        self.font_config = FontConfiguration()
+        self._stylesheets = {}   # ruta -> (mtime, CSS parseado)
+        self._image_cache = {}   # Caché de imágenes decodificadas de WeasyPrint
+        self._asset_mtimes = {}  # ruta -> mtime de los recursos usados (logos)
+        self._lock = threading.Lock() # WeasyPrint/fontconfig no son seguros entre hilos
+        self.write_options = pdf_write_options(self._image_cache)
+
+    def get_stylesheet(self, css_path):
+        """Devuelve la hoja de estilo parseada, recargándola solo si el archivo cambió."""
+        mtime = os.path.getmtime(css_path)
+        cached = self._stylesheets.get(css_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        stylesheet = CSS(filename=css_path, font_config=self.font_config)
+        self._stylesheets[css_path] = (mtime, stylesheet)
+        return stylesheet
+
+    def _check_assets(self, asset_paths):
+        """Vacía la caché de imágenes si algún recurso (logo) cambió en disco."""
+        for path in asset_paths or []:
+            if not path or not os.path.exists(path): continue
+            mtime = os.path.getmtime(path)
+            if self._asset_mtimes.get(path) not in (None, mtime):
+                self._image_cache.clear()
+            self._asset_mtimes[path] = mtime
+
+    def render(self, html_string, stylesheet_paths=None, asset_paths=None, base_url=None):
+        """Convierte HTML a bytes PDF reutilizando fuentes, estilos e imágenes."""
+        with self._lock:
+            self._check_assets(asset_paths)
+            stylesheets = [self.get_stylesheet(p) for p in (stylesheet_paths or []) if os.path.exists(p)]
+            return HTML(string=html_string, base_url=base_url).write_pdf(
+                stylesheets=stylesheets, font_config=self.font_config, **self.write_options)
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+def get_pdf_renderer():
+    """Instancia única del renderizador para este proceso."""
+    global _renderer
+    if _renderer is None:
+        with _renderer_lock:
+            if _renderer is None:
+                _renderer = PdfRenderer()
+    return _renderer
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Vistas previas compartidas entre peticiones simultáneas.
+
+Si varios administradores piden la misma vista previa a la vez (mismo diseño y
+filtros, o misma consulta del resumen diario), solo la primera petición consulta el
+ERP y genera el resultado; las demás esperan y lo reutilizan. El resultado se
+conserva PREVIEW_CACHE_SECONDS segundos. 'force' (botón "Forzar actualización")
+ignora lo guardado y vuelve a generar.
+"""
+import hashlib
+
+from app.reports.query_batch import SingleFlight
+from core import metrics
+
+PREVIEW_CACHE_SECONDS = 30
+
+_previews = SingleFlight(PREVIEW_CACHE_SECONDS)
+
+class PreviewError(Exception):
+    """Fallo de una vista previa: no se guarda, pero sí lo reciben las peticiones que esperaban."""
+    def __init__(self, payload):
+        super().__init__(str(payload))
+        self.payload = payload
+
+def text_hash(*parts):
+    return hashlib.sha1('\x00'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+def report_preview_key(design, filter_values):
+    """Clave de la vista previa de un diseño: cambia si se edita el diseño o su consulta."""
+    version = text_hash(design.get('config_json'), design.get('output_format'), design.get('name'),
+                        (design.get('repository') or {}).get('sql_query'), (design.get('connection') or {}).get('id'))
+    return ('report', design['id'], version, tuple(sorted((filter_values or {}).items())))
+
+def daily_summary_preview_key(connection_id, sql_query):
+    return ('daily_summary', str(connection_id), text_hash(sql_query))
+
+def get_preview(key, builder, force=False):
+    """Devuelve (resultado, compartido); 'compartido' es True si no se generó en esta petición."""
+    return _previews.do(key, builder, force=force)
+
+def stats():
+    return {'hits': _previews.hits, 'misses': _previews.misses}
+
+def _preview_collector():
+    return [('hsp_cache_hits_total', {'cache': 'preview'}, _previews.hits),
+            ('hsp_cache_misses_total', {'cache': 'preview'}, _previews.misses)]
+
+metrics.register_collector(_preview_collector)
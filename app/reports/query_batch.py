@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Deduplicación de consultas entre diseños programados.
+
+Cuando varios diseños usan el mismo repositorio con los mismos parámetros y se
+disparan a la vez, la consulta al ERP se ejecuta una sola vez: el primer trabajo
+la ejecuta y los que esperaban reutilizan su resultado. Cada diseño sigue
+formateando, enviando y registrando su envío por separado.
+
+El resultado completo no se guarda más de BATCH_WINDOW_SECONDS tras servir a los
+que esperaban: los diseños repartidos más allá de esa ventana
+(settings.schedule_spread_minutes) vuelven a consultar. Los resultados vencidos
+se liberan con un hilo de limpieza, sin esperar a que llegue otra consulta.
+"""
+import hashlib
+import threading
+import time
+
+from core import metrics
+
+BATCH_WINDOW_SECONDS = 30 # Tope en que un resultado ya servido sigue siendo reutilizable
+
+class SingleFlight:
+    """Ejecuta una sola vez cada clave concurrente y conserva el resultado 'ttl' segundos."""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {} # clave -> {'event', 'result', 'error', 'expires'}
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self.hits = 0
+        self.misses = 0
+
+    def _purge_expired(self, now):
+        for key in [k for k, e in self._entries.items() if e['expires'] is not None and e['expires'] < now]:
+            del self._entries[key]
+
+    def _ensure_sweeper(self):
+        """Arranca el hilo de limpieza si no está corriendo (se detiene solo cuando no quedan resultados)."""
+        if self._sweeper is None or not self._sweeper.is_alive():
+            self._sweeper = threading.Thread(target=self._sweep, name='single-flight-sweeper', daemon=True)
+            self._sweeper.start()
+
+    def _sweep(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._purge_expired(now)
+                pending = [e['expires'] for e in self._entries.values() if e['expires'] is not None]
+                if not pending:
+                    self._sweeper = None
+                    return
+                wait = max(0.0, min(pending) - now) + 0.05
+            time.sleep(wait)
+
+    def do(self, key, loader, force=False, ttl=None):
+        """Devuelve (resultado, compartido). 'compartido' es True si no se ejecutó loader() aquí.
+
+        ttl: segundos que se conserva este resultado (por defecto self.ttl); con 0 se
+        libera en cuanto se sirve a quienes ya esperaban.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._purge_expired(now)
+            entry = self._entries.get(key)
+            if force and entry and entry['event'].is_set():
+                entry = None
+            if entry is None:
+                entry = {'event': threading.Event(), 'result': None, 'error': None, 'expires': None}
+                self._entries[key] = entry
+                owner = True
+                self.misses += 1
+            else:
+                owner = False
+                self.hits += 1
+
+        if not owner:
+            entry['event'].wait()
+            if entry['error'] is not None:
+                raise entry['error']
+            return entry['result'], True
+
+        completed = False
+        try:
+            entry['result'] = loader()
+            completed = True
+            keep = self.ttl if ttl is None else ttl
+            with self._lock:
+                now = time.monotonic()
+                if keep > 0:
+                    entry['expires'] = now + keep
+                    self._ensure_sweeper()
+                elif self._entries.get(key) is entry:
+                    del self._entries[key]
+                self._purge_expired(now)
+            return entry['result'], False
+        except Exception as e:
+            entry['error'] = e
+            raise
+        finally:
+            if not completed:
+                if entry['error'] is None: # KeyboardInterrupt, SystemExit...: los que esperan no reciben None
+                    entry['error'] = RuntimeError("La consulta compartida se interrumpió.")
+                with self._lock:
+                    if self._entries.get(key) is entry: # Los errores no se conservan
+                        del self._entries[key]
+            entry['event'].set()
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None: self._entries.clear()
+            else: self._entries.pop(key, None)
+
+_batch_results = SingleFlight(BATCH_WINDOW_SECONDS)
+
+def _batch_collector():
+    return [('hsp_cache_hits_total', {'cache': 'query_batch'}, _batch_results.hits),
+            ('hsp_cache_misses_total', {'cache': 'query_batch'}, _batch_results.misses)]
+
+metrics.register_collector(_batch_collector)
+
+def query_key(repository, conn_details, params):
+    """Clave de deduplicación: repositorio, SQL/conexión actuales y parámetros.
+
+    Los parámetros van con su tipo y repr: None y 'None', o 1 y '1', no comparten resultado.
+    """
+    sql_hash = hashlib.sha1((repository or {}).get('sql_query', '').encode('utf-8')).hexdigest()
+    return ((repository or {}).get('id'), (conn_details or {}).get('id'), sql_hash,
+            tuple((type(p).__name__, repr(p)) for p in (params or [])))
+
+def execute_shared(repository, conn_details, params, executor):
+    """Ejecuta executor() una vez por clave entre los trabajos concurrentes.
+
+    executor debe devolver la tupla (success, message, data) de execute_repository_query.
+    Los fallos no se comparten más allá de los trabajos que ya estaban esperando.
+    """
+    def loader():
+        result = executor()
+        if not result[0]:
+            raise ConnectionError(result[1])
+        return result
+    key = query_key(repository, conn_details, params)
+    try:
+        result, shared = _batch_results.do(key, loader)
+    except ConnectionError as e:
+        return False, str(e), None
+    if shared:
+        print(f"  -> Reutilizando resultado compartido del repositorio '{(repository or {}).get('name')}'.")
+    return result
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""Granja local de procesos para renderizado pesado (WeasyPrint y matplotlib).
+
+WeasyPrint y matplotlib son intensivos en CPU y retienen el GIL; ejecutarlos en
+procesos aparte evita que un PDF grande congele el servidor web y el programador.
+Los procesos se pre-calientan importando las librerías pesadas y se reciclan tras
+N trabajos o si su memoria residente supera el límite.
+
+Cada proceso tiene su propio canal (Pipe) y atiende un trabajo a la vez: el tiempo
+máximo cuenta desde que un proceso toma el trabajo (no mientras espera turno) y,
+si se supera, solo se termina ese proceso; los renders de los demás siguen. La espera
+de turno también tiene tope (RENDER_FARM_QUEUE_TIMEOUT) y, si no se puede reponer un
+proceso caído, quien espera intenta crearlo y recibe el error en lugar de esperar
+para siempre.
+
+El límite de memoria se mide al terminar cada trabajo: un render que lo supere termina
+igual (lo acota RENDER_FARM_TIMEOUT) y el proceso se recicla después.
+
+Configuración (app.config):
+    RENDER_FARM_WORKERS           Nº de procesos; 0 = renderizar en el propio proceso.
+    RENDER_FARM_TIMEOUT           Segundos máximos por trabajo.
+    RENDER_FARM_QUEUE_TIMEOUT     Segundos máximos esperando un proceso libre.
+    RENDER_FARM_MAX_TASKS         Trabajos por proceso antes de reciclarlo.
+    RENDER_FARM_MEMORY_LIMIT_MB   RSS tras un trabajo por encima del cual se recicla el proceso (0 = sin límite).
+"""
+import io
+import os
+import time
+import queue
+import atexit
+import threading
+import multiprocessing
+
+from core import metrics
+
+DEFAULT_CONFIG = {
+    'RENDER_FARM_WORKERS': min(2, os.cpu_count() or 1),
+    'RENDER_FARM_TIMEOUT': 120,
+    'RENDER_FARM_QUEUE_TIMEOUT': 600,
+    'RENDER_FARM_MAX_TASKS': 50,
+    'RENDER_FARM_MEMORY_LIMIT_MB': 1024,
+}
+
+TASK_STARTED = 'started'
+WORKER_START_TIMEOUT = 300 # Segundos para que un proceso nuevo termine de pre-calentarse y tome el trabajo
+WAIT_POLL_SECONDS = 1 # Cada cuánto quien espera turno revisa si puede crear un proceso (p. ej. tras una reposición fallida)
+
+class RenderTimeoutError(RuntimeError):
+    """El trabajo de render superó el tiempo máximo y su proceso fue descartado."""
+
+# --- Código que corre dentro de los procesos de la granja ---
+def _worker_init():
+    """Pre-calienta el proceso importando las librerías pesadas."""
+    import matplotlib
+    matplotlib.use('Agg') # Backend no interactivo
+    import matplotlib.pyplot # noqa: F401
+    try:
+        from app.reports.pdf_renderer import get_pdf_renderer
+        get_pdf_renderer() # Carga fuentes/fontconfig una sola vez por proceso
+    except Exception as e: # Sin GTK/Pango el proceso aún sirve para gráficos
+        print(f"Granja de render: WeasyPrint no disponible en el proceso: {e}")
+
+def _worker_main(conn, memory_limit_mb):
+    """Bucle del proceso: recibe (func, args), avisa que empieza y responde (ok, resultado, reciclar). None termina."""
+    _worker_init()
+    limit = int(memory_limit_mb or 0) * 1024 * 1024
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            return
+        if task is None:
+            return
+        func, args = task
+        conn.send(TASK_STARTED)
+        try:
+            ok, result = True, func(*args)
+        except Exception as e:
+            ok, result = False, e
+        # Límite sobre la memoria residente (no el espacio de direcciones): se mide al terminar el trabajo
+        rss = metrics.resident_memory_bytes() if limit else None
+        recycle = bool(rss and rss > limit)
+        try:
+            conn.send((ok, result, recycle))
+        except Exception: # Excepción no serializable
+            conn.send((False, RuntimeError(f"{type(result).__name__}: {result}"), recycle))
+        if recycle:
+            return
+
+def render_pdf_job(html_string, stylesheet_paths=None, asset_paths=None):
+    from app.reports.pdf_renderer import get_pdf_renderer
+    return get_pdf_renderer().render(html_string, stylesheet_paths=stylesheet_paths, asset_paths=asset_paths)
+
+LINE_MAX_TICKS = 12 # Etiquetas del eje X en gráficos de línea largos
+LINE_MARKER_MAX_POINTS = 31 # Con más puntos, los marcadores solo tapan la línea
+
+def render_chart_job(spec):
+    """Dibuja un gráfico a partir de una especificación serializable y devuelve los bytes PNG (o SVG).
+
+    spec: {'type': 'bar'|'pie'|'line', 'labels': [...], 'values': [...],
+           'title': str, 'x_label': str, 'y_label': str, 'figsize': (w, h),
+           'format': 'png'|'svg' (opcional, PNG por defecto)}
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    labels = [str(label) for label in spec.get('labels', [])]
+    values = spec.get('values', [])
+    chart_type = spec.get('type')
+
+    plt.style.use('ggplot')
+    fig, ax = plt.subplots(figsize=tuple(spec.get('figsize', (8, 4))))
+    try:
+        if chart_type == 'bar':
+            ax.bar(labels, values)
+            ax.set_ylabel(spec.get('y_label', ''))
+        elif chart_type == 'pie':
+            ax.pie(values, labels=labels, autopct='%1.1f%%', startangle=90)
+            ax.set_ylabel('') # Ocultar etiqueta Y en tortas
+        elif chart_type == 'line':
+            # Eje X por posición: con cientos de puntos, un eje categórico dibujaría todas las etiquetas
+            positions = range(len(values))
+            ax.plot(positions, values, marker='o' if len(values) <= LINE_MARKER_MAX_POINTS else None)
+            step = max(1, -(-len(labels) // LINE_MAX_TICKS))
+            ax.set_xticks(list(positions)[::step], labels[::step])
+            ax.set_ylabel(spec.get('y_label', ''))
+        ax.set_title(spec.get('title', ''))
+        ax.set_xlabel(spec.get('x_label', ''))
+        plt.setp(ax.get_xticklabels(), rotation=45, ha='right') # Rotar etiquetas del eje X si son largas
+        fig.tight_layout()
+        buf = io.BytesIO()
+        if spec.get('format') == 'svg':
+            # Texto como texto (lo dibuja WeasyPrint) e identificadores fijos: mismo gráfico, mismos bytes
+            with matplotlib.rc_context({'svg.fonttype': 'none', 'svg.hashsalt': 'hsp-report'}):
+                fig.savefig(buf, format='svg', metadata={'Date': None})
+        else:
+            fig.savefig(buf, format='png')
+            from app.reports.image_optimize import compress_png
+            return compress_png(buf.getvalue()) # Paleta de 256 colores: el PDF y el correo pesan menos
+        return buf.getvalue()
+    finally:
+        plt.close(fig) # Liberar memoria
+
+# --- Lado del proceso web/programador ---
+class _Worker:
+    """Un proceso de la granja con su canal."""
+    def __init__(self, memory_limit_mb):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main, args=(child_conn, memory_limit_mb),
+                                               name='hsp-render', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def stop(self, kill=False):
+        if kill:
+            self.process.terminate()
+        else:
+            try: self.conn.send(None)
+            except OSError: pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+class RenderFarm:
+    def __init__(self, workers, timeout, max_tasks, memory_limit_mb, queue_timeout=600):
+        self.workers = workers
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.max_tasks = max_tasks
+        self.memory_limit_mb = memory_limit_mb
+        self._idle = queue.LifoQueue() # Procesos libres (el último usado primero: cachés calientes)
+        self._started = 0 # Procesos vivos (libres u ocupados)
+        self._closed = False
+        self._lock = threading.Lock()
+        self.busy = 0 # Trabajos en curso (para métricas de utilización)
+
+    def _acquire(self):
+        """Un proceso libre; crea uno si no se llegó al máximo, si no espera turno (hasta queue_timeout)."""
+        deadline = time.monotonic() + self.queue_timeout
+        while True:
+            if self._closed:
+                raise RuntimeError("La granja de render se está cerrando.")
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                create = self._started < self.workers
+                if create: self._started += 1
+            if create: # También tras una reposición fallida: si no se puede crear, el error llega aquí
+                try:
+                    return _Worker(self.memory_limit_mb)
+                except Exception:
+                    with self._lock: self._started -= 1
+                    raise
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RenderTimeoutError(f"No hubo un proceso de render libre en {self.queue_timeout}s.")
+            try:
+                return self._idle.get(timeout=min(remaining, WAIT_POLL_SECONDS))
+            except queue.Empty:
+                continue
+
+    def _release(self, worker, retire=False, kill=False):
+        if retire or kill or self._closed:
+            worker.stop(kill=kill)
+            with self._lock: self._started -= 1
+            if self._closed: return
+            try: # Un trabajo que espera turno puede necesitar un proceso nuevo
+                self._idle.put(_Worker(self.memory_limit_mb))
+                with self._lock: self._started += 1
+            except Exception as e:
+                print(f"Granja de render: no se pudo reponer el proceso: {e}")
+        else:
+            self._idle.put(worker)
+
+    def submit(self, func, *args, timeout=None):
+        timeout = timeout or self.timeout
+        worker = self._acquire()
+        with self._lock:
+            self.busy += 1
+        try:
+            try:
+                worker.conn.send((func, args))
+                # Un proceso nuevo primero importa las librerías: el tiempo máximo empieza cuando toma el trabajo
+                if not worker.conn.poll(WORKER_START_TIMEOUT) or worker.conn.recv() != TASK_STARTED:
+                    self._release(worker, kill=True)
+                    raise RenderTimeoutError("El proceso de render no arrancó a tiempo.")
+                if not worker.conn.poll(timeout):
+                    self._release(worker, kill=True) # Solo este proceso; los demás siguen con sus renders
+                    raise RenderTimeoutError(f"El render superó {timeout}s y fue cancelado.")
+                ok, result, recycle = worker.conn.recv()
+            except (EOFError, OSError) as e:
+                self._release(worker, kill=True)
+                raise RuntimeError(f"El proceso de render terminó inesperadamente (¿memoria insuficiente?): {e}") from e
+            worker.tasks += 1
+            self._release(worker, retire=recycle or worker.tasks >= self.max_tasks)
+            if not ok:
+                raise result
+            return result
+        finally:
+            with self._lock:
+                self.busy -= 1
+
+    def shutdown(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break
+
+_farm = None
+_farm_lock = threading.Lock()
+
+def _get_config():
+    config = dict(DEFAULT_CONFIG)
+    try:
+        from flask import current_app
+        for key in config:
+            config[key] = current_app.config.get(key, config[key])
+    except RuntimeError:
+        pass # Sin contexto de aplicación: usar valores por defecto
+    return config
+
+def get_render_farm():
+    """Granja compartida del proceso, o None si está deshabilitada (RENDER_FARM_WORKERS=0)."""
+    global _farm
+    if _farm is None:
+        config = _get_config()
+        if not config['RENDER_FARM_WORKERS']:
+            return None
+        with _farm_lock:
+            if _farm is None:
+                _farm = RenderFarm(config['RENDER_FARM_WORKERS'], config['RENDER_FARM_TIMEOUT'],
+                                   config['RENDER_FARM_MAX_TASKS'], config['RENDER_FARM_MEMORY_LIMIT_MB'],
+                                   config['RENDER_FARM_QUEUE_TIMEOUT'])
+                atexit.register(_farm.shutdown)
+    return _farm
+
+def _render_farm_collector():
+    farm = _farm
+    return [('hsp_render_workers', {}, farm.workers if farm else 0),
+            ('hsp_render_busy_workers', {}, farm.busy if farm else 0)]
+
+metrics.register_collector(_render_farm_collector)
+
+def render_pdf(html_string, stylesheet_paths=None, asset_paths=None):
+    """HTML -> PDF en la granja (o en el proceso actual si está deshabilitada)."""
+    farm = get_render_farm()
+    if farm is None:
+        return render_pdf_job(html_string, stylesheet_paths, asset_paths)
+    return farm.submit(render_pdf_job, html_string, stylesheet_paths, asset_paths)
+
+def render_chart(spec):
+    """Especificación de gráfico -> bytes PNG en la granja (o en el proceso actual)."""
+    farm = get_render_farm()
+    if farm is None:
+        return render_chart_job(spec)
+    return farm.submit(render_chart_job, spec)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Plantillas de correo HTML compactas.
+
+- InlineCssLoader: las plantillas que empiezan con {# inline-css: archivo.css #} se
+  escriben con clases; al cargarlas, cada class="..." se sustituye por el style=""
+  equivalente. Se hace una sola vez por plantilla (Jinja guarda la versión compilada
+  y solo la recarga si cambian la plantilla o la hoja de estilos), no en cada envío.
+- minify_html: elimina comentarios y espacios entre etiquetas del HTML generado.
+"""
+import os
+import re
+
+from jinja2 import Environment, FileSystemLoader
+
+INLINE_CSS_DIRECTIVE = re.compile(r'^\s*\{#\s*inline-css:\s*([\w.\-]+)\s*#\}\s*')
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+_CSS_RULE = re.compile(r'\.([\w\-]+)\s*\{([^}]*)\}')
+_TAG_WITH_CLASS = re.compile(r'<([a-zA-Z][\w]*)([^<>]*?)\sclass="([^"{}]*)"([^<>]*)>')
+_STYLE_ATTR = re.compile(r'\sstyle="([^"]*)"')
+
+def parse_class_rules(css_text):
+    """'.clase { decl; }' -> {'clase': 'decl'} (solo selectores de una clase)."""
+    rules = {}
+    for name, body in _CSS_RULE.findall(_CSS_COMMENT.sub('', css_text)):
+        declarations = '; '.join(d.strip() for d in body.split(';') if d.strip())
+        rules[name] = f"{rules[name]}; {declarations}" if name in rules else declarations
+    return rules
+
+def inline_classes(source, rules):
+    """Sustituye los atributos class por style="" con las declaraciones de cada clase."""
+    def replace(match):
+        tag, before, classes, after = match.groups()
+        declarations = [rules[c] for c in classes.split() if c in rules]
+        attrs = before + after
+        existing = _STYLE_ATTR.search(attrs)
+        if existing:
+            declarations.append(existing.group(1).strip().rstrip(';'))
+            attrs = _STYLE_ATTR.sub('', attrs, count=1)
+        if not declarations:
+            return f'<{tag}{attrs}>'
+        return f'<{tag}{attrs} style="{"; ".join(declarations)}">'
+    return _TAG_WITH_CLASS.sub(replace, source)
+
+class InlineCssLoader(FileSystemLoader):
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        directive = INLINE_CSS_DIRECTIVE.match(source)
+        if not directive:
+            return source, filename, uptodate
+        css_path = os.path.join(os.path.dirname(filename), directive.group(1))
+        with open(css_path, encoding='utf-8') as f:
+            rules = parse_class_rules(f.read())
+        css_mtime = os.path.getmtime(css_path)
+        source = inline_classes(source[directive.end():], rules)
+        def css_uptodate():
+            try:
+                return uptodate() and os.path.getmtime(css_path) == css_mtime
+            except OSError:
+                return False
+        return source, filename, css_uptodate
+
+_environments = {} # searchpath -> Environment
+
+def get_email_environment(searchpath):
+    """Entorno Jinja (uno por carpeta) que conserva las plantillas ya compiladas y con estilos en línea."""
+    env = _environments.get(searchpath)
+    if env is None:
+        env = Environment(loader=InlineCssLoader(searchpath=searchpath))
+        env.globals['zip'] = zip
+        _environments[searchpath] = env
+    return env
+
+_PRESERVE_BLOCKS = re.compile(r'(<pre\b.*?</pre>|<textarea\b.*?</textarea>|<!--\[if.*?<!\[endif\]-->)', re.S | re.I)
+_HTML_COMMENT = re.compile(r'<!--(?!\[if).*?-->', re.S)
+_BETWEEN_TAGS = re.compile(r'>\s+<')
+_WHITESPACE = re.compile(r'\s{2,}')
+
+def minify_html(html):
+    """Quita comentarios y espacios redundantes (respeta <pre>, <textarea> y comentarios condicionales de Outlook)."""
+    parts = _PRESERVE_BLOCKS.split(html)
+    for i in range(0, len(parts), 2): # Posiciones pares: fuera de los bloques preservados
+        text = _HTML_COMMENT.sub('', parts[i])
+        text = _BETWEEN_TAGS.sub('><', text)
+        parts[i] = _WHITESPACE.sub(' ', text)
+    return ''.join(parts).strip()
@@ -6,7 +6,13 @@ from email.mime.image import MIMEImage
 from email import encoders
 import uuid # Para CIDs únicos si no se proporcionan
 
-def send_email(smtp_config, recipients, cc, subject, body, is_html=False, attachment=None, images=None):
+from core import metrics
+
+def attachments_from_outputs(outputs):
+    """Convierte salidas de reporte [(contenido, mimetype, nombre)] al orden de adjunto de send_email."""
+    return [(filename, mimetype, content) for content, mimetype, filename in outputs]
+
+def send_email(smtp_config, recipients, cc, subject, body, is_html=False, attachment=None, images=None, attachments=None):
     """
     Envía un correo electrónico, soportando adjuntos normales y/o imágenes embebidas (CID).
 
@@ -20,6 +26,8 @@ def send_email(smtp_config, recipients, cc, subject, body, is_html=False, attach
         attachment (tuple, optional): (filename, mimetype, content_bytes) para adjunto normal.
         images (list, optional): Lista de tuplas [(cid, image_bytes), ...] para imágenes embebidas.
                                  'cid' debe ser único (ej: 'chart_30_days_id').
+        attachments (list, optional): Lista de tuplas (filename, mimetype, content_bytes) para
+                                 varios adjuntos (p. ej. un paquete PDF + XLSX).
     """
     valid_recipients = [r for r in recipients if r and '@' in r] # Simple validación
     valid_cc = [c for c in cc if c and '@' in c]
@@ -27,11 +35,20 @@ def send_email(smtp_config, recipients, cc, subject, body, is_html=False, attach
         print("  -> Correo no enviado: No hay destinatarios válidos.")
         return
 
+    all_attachments = ([attachment] if attachment else []) + list(attachments or [])
+
     # Estructura principal: 'mixed' si hay adjuntos, 'related' si solo hay imágenes embebidas, 'alternative' si solo HTML/texto
-    if attachment:
+    image_container = None
+    if all_attachments:
         msg_root = MIMEMultipart('mixed')
+        if images: # Cuerpo con imágenes embebidas + adjuntos: 'related' dentro de 'mixed'
+            image_container = MIMEMultipart('related')
+            msg_root.attach(image_container)
+            msg_body_container = MIMEMultipart('alternative')
+            image_container.attach(msg_body_container)
     elif images:
         msg_root = MIMEMultipart('related')
+        image_container = msg_root
         # Si hay imágenes, necesitamos una parte 'alternative' DENTRO de 'related' para el cuerpo HTML
         msg_body_container = MIMEMultipart('alternative')
         msg_root.attach(msg_body_container)
@@ -53,7 +70,7 @@ def send_email(smtp_config, recipients, cc, subject, body, is_html=False, attach
     body_part = MIMEText(body, body_type, 'utf-8')
 
     # Adjuntar el cuerpo
-    if images or not attachment: # Si hay imágenes o solo cuerpo, va en 'alternative' o raíz si es 'alternative'
+    if images or not all_attachments: # Si hay imágenes o solo cuerpo, va en 'alternative' o raíz si es 'alternative'
         msg_body_container.attach(body_part)
     else: # Si hay adjunto normal pero no imágenes, va directamente en 'mixed'
         msg_root.attach(body_part)
@@ -67,15 +84,15 @@ def send_email(smtp_config, recipients, cc, subject, body, is_html=False, attach
                     img = MIMEImage(img_bytes)
                     img.add_header('Content-ID', f'<{cid}>')
                     img.add_header('Content-Disposition', 'inline', filename=f'{cid}.png')
-                    msg_root.attach(img) # Adjuntar al nivel 'related'
+                    image_container.attach(img) # Adjuntar al nivel 'related'
                 except Exception as img_e:
                      print(f"WARN: No se pudo adjuntar imagen embebida con CID '{cid}': {img_e}")
 
 
-    # Adjuntar archivo normal (si existe) al nivel principal ('mixed' o 'related')
-    if attachment:
-        filename, mimetype, content_bytes = attachment
+    # Adjuntar archivos normales (si existen) al nivel principal ('mixed' o 'related')
+    for filename, mimetype, content_bytes in all_attachments:
         if content_bytes:
+            if isinstance(content_bytes, str): content_bytes = content_bytes.encode('utf-8')
             main_type, sub_type = mimetype.split('/', 1) if mimetype and '/' in mimetype else ('application', 'octet-stream')
             part = MIMEBase(main_type, sub_type)
             part.set_payload(content_bytes)
@@ -99,10 +116,10 @@ def send_email(smtp_config, recipients, cc, subject, body, is_html=False, attach
         print(f"  -> Conectando a SMTP: {smtp_server}:{smtp_port}")
         # Decidir si usar SMTP_SSL (puerto 465) o SMTP con STARTTLS (normalmente 587 o 25)
         if smtp_port == 465:
-            server = smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=20)
+            server = metrics.TrackedConnection(smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=20), 'smtp')
             print("  -> Usando SMTP_SSL.")
         else:
-            server = smtplib.SMTP(smtp_server, smtp_port, timeout=20)
+            server = metrics.TrackedConnection(smtplib.SMTP(smtp_server, smtp_port, timeout=20), 'smtp')
             server.ehlo()
             server.starttls()
             server.ehlo()
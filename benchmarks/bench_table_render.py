@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Compara el render de report_template.html: bucles de Jinja vs. table_render.
+
+Uso (desde la raíz del proyecto):
+    python benchmarks/bench_table_render.py --rows 100000
+    python benchmarks/bench_table_render.py --rows 20000 --grouped
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+import pandas as pd
+from jinja2 import Environment, FileSystemLoader
+
+from app.reports import numeric, table_render
+
+def build_data(rows, grouped):
+    """DataFrame y datos de plantilla con la misma forma que build_report_context."""
+    start = datetime(2026, 1, 1)
+    df = pd.DataFrame({
+        'Fecha': [start + timedelta(days=i % 365) for i in range(rows)],
+        'Cliente': [f"Cliente <{i % 500}> & Cía" for i in range(rows)],
+        'Documento': [f"FAC-{i:08d}" for i in range(rows)],
+        'Cantidad': [random.randint(1, 50) for _ in range(rows)],
+        'Monto': [Decimal(random.randint(100, 10_000_000)).scaleb(-2) for _ in range(rows)],
+    })
+    total_fields = ['Cantidad', 'Monto']
+    scales = {'Monto': 2}
+    totals = numeric.totals_frame(df, total_fields, scales)
+    grouped_data = None
+    if grouped:
+        subtotals = numeric.exact_subtotals(totals, df['Cliente'], total_fields, scales)
+        grouped_data = {name: {'rows': group.to_dict(orient='records'), 'subtotals': subtotals.get(name)}
+                        for name, group in df.groupby('Cliente')}
+    template_data = {
+        'title': 'Benchmark', 'columns': df.columns.tolist(), 'grouped_data': grouped_data,
+        'data_rows': df.to_dict(orient='records') if not grouped_data else None,
+        'group_by_field': 'Cliente' if grouped else None, 'total_fields': total_fields,
+        'grand_totals': numeric.exact_totals(totals, total_fields, scales),
+        'chart_image': None, 'branding': {}, 'logo_path': None,
+    }
+    return df, template_data
+
+def timed(label, func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<32}{best:8.3f} s  ({len(output) / 1024:,.0f} KB)")
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--grouped', action='store_true', help='Agrupar por cliente (subtotales)')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(1)
+    df, template_data = build_data(args.rows, args.grouped)
+    env = Environment(loader=FileSystemLoader(os.path.join(PROJECT_ROOT, 'templates', 'reports')))
+    template = env.get_template('report_template.html')
+
+    print(f"{args.rows:,} filas{' agrupadas' if args.grouped else ''}, mejor de {args.repeat}:")
+    loops = timed("Bucles de Jinja", lambda: template.render(template_data), args.repeat)
+    fast = timed("table_render + plantilla",
+                 lambda: template.render(dict(template_data, table_body_html=table_render.render_table_body(df, template_data))),
+                 args.repeat)
+    print(f"Mejora: x{loops / fast:.1f}")
+
+if __name__ == '__main__':
+    main()
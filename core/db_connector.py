@@ -1,9 +1,7 @@
 # core/db_connector.py
 import pyodbc
-import pandas as pd
 import configparser
-from tkinter import messagebox
-from utils.db_config_ui import open_db_config_window
+# tkinter y pandas se importan al usarse: este módulo no debe ralentizar el arranque
 
 CONFIG_FILE = 'config.ini'
 
@@ -15,6 +13,7 @@ def get_db_connection():
     parser = configparser.ConfigParser()
     if not parser.read(CONFIG_FILE):
         # Si el archivo no existe, abre la UI para crearlo
+        from utils.db_config_ui import open_db_config_window
         open_db_config_window()
         parser.read(CONFIG_FILE)
 
@@ -27,6 +26,7 @@ def get_db_connection():
     except pyodbc.Error as ex:
         sqlstate = ex.args[0]
         print(f"Error de conexión: {sqlstate}")
+        from tkinter import messagebox
         messagebox.showerror("Error de Conexión", "No se pudo conectar a la base de datos. Por favor, revisa la configuración.")
         # Opcional: podrías volver a abrir la UI aquí
         # open_db_config_window()
@@ -36,6 +36,7 @@ def execute_query(query: str, params=None):
     """
     Ejecuta una consulta y devuelve los resultados en un DataFrame de pandas.
     """
+    import pandas as pd
     cnxn = get_db_connection()
     if cnxn:
         try:
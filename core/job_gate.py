@@ -0,0 +1,130 @@
+# core/job_gate.py
+"""Presupuesto de trabajos concurrentes con prioridad.
+
+Limita cuántos reportes programados se ejecutan a la vez (SQL Server, CPU y SMTP)
+y, cuando hay cola, deja pasar primero a los diseños de mayor prioridad
+(número menor = más prioritario).
+
+El límite es de la instalación, no del proceso: además del turno local, cada
+trabajo ocupa un turno en la tabla job_slots de settings.db (SharedSlots), así
+los envíos masivos de la web y los reportes del programador (otro proceso en
+modo 'prod') no superan juntos el máximo configurado. Los trabajadores de la cola
+(--mode worker) solo usan su turno local: cada uno aporta sus propios --slots.
+
+Entre procesos la prioridad también se respeta: quien espera un turno compartido deja
+su fila 'waiting' con la prioridad del diseño, y un turno libre es para la espera más
+prioritaria (a igual prioridad, la más antigua). La espera es por sondeo (cada
+SHARED_POLL_SECONDS) y mantiene ocupado el turno local, de modo que un proceso nunca
+tiene más trabajos en curso o en espera que el máximo configurado.
+"""
+import heapq
+import itertools
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+SHARED_POLL_SECONDS = 0.25
+SHARED_HEARTBEAT_SECONDS = 10
+SHARED_STALE_SECONDS = 60 # Sin latido en este tiempo, el turno es de un proceso caído y se libera
+
+class SharedSlots:
+    """Turnos compartidos por todos los procesos que usan el mismo settings.db."""
+    def __init__(self):
+        self._tokens = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+
+    def acquire(self, capacity, priority=3):
+        """Espera un turno libre. Devuelve su token (None si settings.db no responde: solo vale el turno local)."""
+        from app.admin.services import try_acquire_job_slot
+        token = uuid.uuid4().hex
+        try:
+            while not try_acquire_job_slot(token, os.getpid(), capacity, SHARED_STALE_SECONDS, priority):
+                time.sleep(SHARED_POLL_SECONDS)
+        except Exception as e:
+            print(f"Turnos compartidos no disponibles (se usa solo el límite del proceso): {e}")
+            self.release(token) # Quitar la fila en espera si quedó
+            return None
+        with self._lock:
+            self._tokens.add(token)
+            if self._heartbeat is None or not self._heartbeat.is_alive():
+                self._heartbeat = threading.Thread(target=self._beat, name='job-slot-heartbeat', daemon=True)
+                self._heartbeat.start()
+        return token
+
+    def release(self, token):
+        from app.admin.services import release_job_slot
+        with self._lock:
+            self._tokens.discard(token)
+        try:
+            release_job_slot(token)
+        except Exception as e: # Si no se pudo borrar, vence por falta de latido
+            print(f"No se pudo liberar el turno compartido: {e}")
+
+    def _beat(self):
+        from app.admin.services import heartbeat_job_slots
+        while True:
+            time.sleep(SHARED_HEARTBEAT_SECONDS)
+            with self._lock:
+                tokens = list(self._tokens)
+                if not tokens:
+                    self._heartbeat = None
+                    return
+            try:
+                heartbeat_job_slots(tokens)
+            except Exception as e:
+                print(f"Turnos compartidos: {e}")
+
+class PriorityGate:
+    def __init__(self, capacity, shared=None):
+        self.capacity = max(1, int(capacity))
+        self.shared = shared # SharedSlots o None (solo límite del proceso)
+        self.running = 0
+        self._waiters = [] # heap de (prioridad, orden de llegada, evento)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def set_capacity(self, capacity):
+        with self._lock:
+            self.capacity = max(1, int(capacity))
+            self._wake_waiters()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def _wake_waiters(self):
+        while self._waiters and self.running < self.capacity:
+            _, _, event = heapq.heappop(self._waiters)
+            self.running += 1
+            event.set()
+
+    def acquire(self, priority):
+        with self._lock:
+            if self.running < self.capacity and not self._waiters:
+                self.running += 1
+                return
+            event = threading.Event()
+            heapq.heappush(self._waiters, (priority, next(self._counter), event))
+        event.wait()
+
+    def release(self):
+        with self._lock:
+            self.running -= 1
+            self._wake_waiters()
+
+    @contextmanager
+    def slot(self, priority):
+        self.acquire(priority)
+        token = None
+        try:
+            token = self.shared.acquire(self.capacity, priority) if self.shared else None
+            yield
+        finally:
+            if token: self.shared.release(token)
+            self.release()
+
+DEFAULT_MAX_CONCURRENT_JOBS = 4
+job_gate = PriorityGate(DEFAULT_MAX_CONCURRENT_JOBS, shared=SharedSlots())
@@ -0,0 +1,328 @@
+# core/job_queue.py
+"""Cola de trabajos con arriendo (lease) para ejecutar reportes en varios procesos o equipos.
+
+En modo distribuido (run_app.py --dispatch queue) el programador no genera los
+reportes: al llegar la hora solo encola el trabajo. Los procesos trabajadores
+(run_app.py --mode worker, tantos como se quiera) toman trabajos de la cola y los
+ejecutan. Tomar un trabajo es un arriendo por LEASE_SECONDS que el trabajador
+renueva mientras lo ejecuta; si el trabajador muere, el arriendo vence y otro lo
+vuelve a tomar (hasta MAX_ATTEMPTS intentos). La entrega es "al menos una vez":
+un reporte interrumpido a mitad del envío puede enviarse de nuevo. Un trabajador
+que perdió su arriendo (p. ej. estuvo bloqueado más de LEASE_SECONDS) lo sabe por
+job['lease'] (JobLease) y no debe enviar: el trabajo ya es de otro.
+
+Backends (app.config['JOB_QUEUE'] o variable de entorno HSP_JOB_QUEUE):
+    'sqlite' (por defecto)  Tabla job_queue en settings.db: varios procesos del mismo equipo.
+    'sqlite:<ruta>'         Otro archivo SQLite (pruebas).
+    'odbc:<cadena ODBC>'    Tabla hsp_job_queue en SQL Server, compartida entre equipos; las
+                            horas de los arriendos son las del servidor (sin desfase de relojes).
+Los trabajadores de otros equipos también necesitan la configuración (settings.db),
+p. ej. en una carpeta compartida con la instalación.
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+LEASE_SECONDS = 120
+HEARTBEAT_SECONDS = 30
+POLL_SECONDS = 5
+MAX_ATTEMPTS = 3
+KEEP_FINISHED_DAYS = 7
+
+class SQLiteJobQueue:
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS job_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    design_id INTEGER,
+                    priority INTEGER NOT NULL DEFAULT 3,
+                    dedupe_key TEXT UNIQUE,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    enqueued_at REAL NOT NULL,
+                    lease_until REAL,
+                    worker TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    finished_at REAL,
+                    error TEXT
+                )''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_job_queue_status ON job_queue (status, priority, id)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None) # Transacciones explícitas
+        conn.row_factory = sqlite3.Row
+        return _Closing(conn)
+
+    def enqueue(self, kind, design_id=None, priority=3, dedupe_key=None):
+        """Encola un trabajo. Devuelve False si ya existía uno con la misma clave."""
+        with self._connect() as conn:
+            cursor = conn.execute("INSERT OR IGNORE INTO job_queue (kind, design_id, priority, dedupe_key, enqueued_at) "
+                                  "VALUES (?, ?, ?, ?, ?)", (kind, design_id, priority, dedupe_key, time.time()))
+            return cursor.rowcount == 1
+
+    def claim(self, worker, lease_seconds=LEASE_SECONDS):
+        """Toma el trabajo pendiente más prioritario (o uno con arriendo vencido). None si no hay."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE") # Un solo trabajador a la vez elige y marca
+            try:
+                conn.execute("UPDATE job_queue SET status = 'failed', finished_at = ?, error = ? "
+                             "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                             (now, _LEASE_EXPIRED, now, MAX_ATTEMPTS))
+                row = conn.execute("SELECT id FROM job_queue WHERE status = 'queued' "
+                                   "OR (status = 'running' AND lease_until < ?) ORDER BY priority, id LIMIT 1",
+                                   (now,)).fetchone()
+                if row:
+                    conn.execute("UPDATE job_queue SET status = 'running', worker = ?, lease_until = ?, "
+                                 "attempts = attempts + 1 WHERE id = ?", (worker, now + lease_seconds, row['id']))
+                    row = conn.execute("SELECT id, kind, design_id, attempts FROM job_queue WHERE id = ?",
+                                       (row['id'],)).fetchone()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return dict(row) if row else None
+
+    def heartbeat(self, job_id, worker, lease_seconds=LEASE_SECONDS):
+        """Renueva el arriendo. False si el trabajo ya no es de este trabajador."""
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE job_queue SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                                  (time.time() + lease_seconds, job_id, worker))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, status='done', error=None):
+        with self._connect() as conn:
+            conn.execute("UPDATE job_queue SET status = ?, finished_at = ?, error = ?, lease_until = NULL "
+                         "WHERE id = ? AND worker = ?", (status, time.time(), error, job_id, worker))
+
+    def counts(self):
+        """Trabajos por estado (para métricas)."""
+        with self._connect() as conn:
+            return {row['status']: row['total'] for row in
+                    conn.execute("SELECT status, COUNT(*) AS total FROM job_queue GROUP BY status").fetchall()}
+
+    def purge(self, keep_days=KEEP_FINISHED_DAYS):
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM job_queue WHERE status IN ('done', 'failed') AND finished_at < ?",
+                                (time.time() - keep_days * 86400,)).rowcount
+
+class OdbcJobQueue:
+    """La misma cola sobre SQL Server (pyodbc), para trabajadores en varios equipos."""
+    def __init__(self, connection_string):
+        self.connection_string = connection_string
+        with self._connect() as conn:
+            conn.execute('''
+                IF OBJECT_ID('hsp_job_queue') IS NULL
+                CREATE TABLE hsp_job_queue (
+                    id BIGINT IDENTITY PRIMARY KEY,
+                    kind NVARCHAR(40) NOT NULL,
+                    design_id INT NULL,
+                    priority INT NOT NULL DEFAULT 3,
+                    dedupe_key NVARCHAR(200) NULL,
+                    status NVARCHAR(20) NOT NULL DEFAULT 'queued',
+                    enqueued_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+                    lease_until DATETIME2 NULL,
+                    worker NVARCHAR(200) NULL,
+                    attempts INT NOT NULL DEFAULT 0,
+                    finished_at DATETIME2 NULL,
+                    error NVARCHAR(MAX) NULL
+                )''')
+            conn.execute('''
+                IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ux_hsp_job_queue_dedupe')
+                CREATE UNIQUE INDEX ux_hsp_job_queue_dedupe ON hsp_job_queue (dedupe_key) WHERE dedupe_key IS NOT NULL''')
+            conn.commit()
+
+    def _connect(self):
+        import pyodbc
+        from core import metrics
+        return _Closing(metrics.TrackedConnection(pyodbc.connect(self.connection_string, timeout=10), 'odbc'))
+
+    def enqueue(self, kind, design_id=None, priority=3, dedupe_key=None):
+        with self._connect() as conn:
+            cursor = conn.execute("INSERT INTO hsp_job_queue (kind, design_id, priority, dedupe_key) "
+                                  "SELECT ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM hsp_job_queue WHERE dedupe_key = ?)",
+                                  (kind, design_id, priority, dedupe_key, dedupe_key))
+            conn.commit()
+            return cursor.rowcount == 1
+
+    def claim(self, worker, lease_seconds=LEASE_SECONDS):
+        with self._connect() as conn:
+            conn.execute("UPDATE hsp_job_queue SET status = 'failed', finished_at = SYSUTCDATETIME(), error = ? "
+                         "WHERE status = 'running' AND lease_until < SYSUTCDATETIME() AND attempts >= ?",
+                         (_LEASE_EXPIRED, MAX_ATTEMPTS))
+            # READPAST: cada trabajador salta las filas que otro está tomando en ese momento
+            row = conn.execute('''
+                WITH next_job AS (
+                    SELECT TOP (1) * FROM hsp_job_queue WITH (UPDLOCK, READPAST, ROWLOCK)
+                    WHERE status = 'queued' OR (status = 'running' AND lease_until < SYSUTCDATETIME())
+                    ORDER BY priority, id)
+                UPDATE next_job SET status = 'running', worker = ?, attempts = attempts + 1,
+                                    lease_until = DATEADD(second, ?, SYSUTCDATETIME())
+                OUTPUT inserted.id, inserted.kind, inserted.design_id, inserted.attempts''',
+                (worker, lease_seconds)).fetchone()
+            conn.commit()
+        return {'id': row[0], 'kind': row[1], 'design_id': row[2], 'attempts': row[3]} if row else None
+
+    def heartbeat(self, job_id, worker, lease_seconds=LEASE_SECONDS):
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE hsp_job_queue SET lease_until = DATEADD(second, ?, SYSUTCDATETIME()) "
+                                  "WHERE id = ? AND worker = ? AND status = 'running'", (lease_seconds, job_id, worker))
+            conn.commit()
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, status='done', error=None):
+        with self._connect() as conn:
+            conn.execute("UPDATE hsp_job_queue SET status = ?, finished_at = SYSUTCDATETIME(), error = ?, lease_until = NULL "
+                         "WHERE id = ? AND worker = ?", (status, error, job_id, worker))
+            conn.commit()
+
+    def counts(self):
+        with self._connect() as conn:
+            return {status: total for status, total in
+                    conn.execute("SELECT status, COUNT(*) FROM hsp_job_queue GROUP BY status").fetchall()}
+
+    def purge(self, keep_days=KEEP_FINISHED_DAYS):
+        with self._connect() as conn:
+            deleted = conn.execute("DELETE FROM hsp_job_queue WHERE status IN ('done', 'failed') "
+                                   "AND finished_at < DATEADD(day, ?, SYSUTCDATETIME())", (-keep_days,)).rowcount
+            conn.commit()
+            return deleted
+
+_LEASE_EXPIRED = f"Arriendo vencido {MAX_ATTEMPTS} veces (el trabajador dejó de responder)."
+
+class JobLease:
+    """Arriendo de un trabajo tomado por este proceso. 'lost' se activa si otro trabajador lo tomó."""
+    def __init__(self, queue, job_id, worker):
+        self.queue = queue
+        self.job_id = job_id
+        self.worker = worker
+        self.lost = threading.Event()
+
+    def renew(self):
+        """Renueva el arriendo. False si se perdió (ahora o antes)."""
+        if not self.lost.is_set() and not self.queue.heartbeat(self.job_id, self.worker):
+            self.lost.set()
+            print(f"Cola de trabajos: se perdió el arriendo del trabajo {self.job_id} (otro trabajador lo tomó).")
+        return not self.lost.is_set()
+
+    def confirm(self):
+        """Antes de un efecto externo (envío SMTP): renueva y devuelve False si el trabajo ya no es nuestro.
+
+        Si la cola no responde se continúa (entrega "al menos una vez")."""
+        try:
+            return self.renew()
+        except Exception as e:
+            print(f"Cola de trabajos: no se pudo confirmar el arriendo del trabajo {self.job_id}: {e}")
+            return not self.lost.is_set()
+
+class _Closing:
+    """'with' que cierra la conexión al salir (sqlite3 y pyodbc solo cierran la transacción)."""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, *exc):
+        self.conn.close()
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_job_queue(spec=None):
+    """Cola configurada (una por proceso). spec: ver el docstring del módulo."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            if spec is None:
+                try:
+                    from flask import current_app
+                    spec = current_app.config.get('JOB_QUEUE')
+                except RuntimeError: # Sin contexto de aplicación
+                    spec = None
+                spec = spec or os.environ.get('HSP_JOB_QUEUE') or 'sqlite'
+            if spec.startswith('odbc:'):
+                _queue = OdbcJobQueue(spec[len('odbc:'):])
+            else:
+                from app.admin.services import DB_PATH
+                _queue = SQLiteJobQueue(spec[len('sqlite:'):] if spec.startswith('sqlite:') else DB_PATH)
+        return _queue
+
+def queue_collector():
+    """Trabajos en la cola por estado (colector de core.metrics)."""
+    counts = get_job_queue().counts()
+    return [('hsp_job_queue_jobs', {'status': status}, counts.get(status, 0))
+            for status in ('queued', 'running', 'done', 'failed')]
+
+class QueueWorker:
+    """Trabajador: 'slots' hilos que toman y ejecutan trabajos, más un hilo que renueva los arriendos."""
+    def __init__(self, queue, run_job, slots=1, worker_id=None):
+        self.queue = queue
+        self.run_job = run_job # run_job(job) ejecuta un trabajo ({'id', 'kind', 'design_id', 'attempts', 'lease'})
+        self.slots = max(1, int(slots))
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._active = {} # id -> JobLease
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def run(self):
+        """Bloquea hasta stop() (o Ctrl+C)."""
+        print(f"Trabajador '{self.worker_id}' esperando trabajos ({self.slots} simultáneos).")
+        threads = [threading.Thread(target=self._heartbeat_loop, name='job-lease-heartbeat', daemon=True)]
+        threads += [threading.Thread(target=self._claim_loop, name=f'job-worker-{i}', daemon=True) for i in range(self.slots)]
+        for thread in threads:
+            thread.start()
+        try:
+            while not self._stop.wait(1):
+                pass
+        finally:
+            self._stop.set()
+
+    def stop(self):
+        self._stop.set()
+
+    def _claim_loop(self):
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim(self.worker_id)
+            except Exception as e:
+                print(f"Cola de trabajos: error al tomar un trabajo: {e}")
+                job = None
+            if not job:
+                self._stop.wait(POLL_SECONDS)
+                continue
+            job['lease'] = JobLease(self.queue, job['id'], self.worker_id)
+            with self._lock:
+                self._active[job['id']] = job['lease']
+            status, error = 'done', None
+            try:
+                print(f"Trabajador '{self.worker_id}': trabajo {job['id']} ({job['kind']}, intento {job['attempts']}).")
+                self.run_job(job)
+            except Exception as e:
+                status, error = 'failed', str(e)
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._active.pop(job['id'], None)
+            if job['lease'].lost.is_set():
+                continue # El trabajo es de otro trabajador: él lo cerrará
+            try:
+                self.queue.complete(job['id'], self.worker_id, status, error)
+            except Exception as e:
+                print(f"Cola de trabajos: no se pudo cerrar el trabajo {job['id']}: {e}")
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(HEARTBEAT_SECONDS):
+            with self._lock:
+                active = list(self._active.values())
+            for lease in active:
+                try:
+                    lease.renew()
+                except Exception as e:
+                    print(f"Cola de trabajos: error al renovar el arriendo del trabajo {lease.job_id}: {e}")
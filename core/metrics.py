@@ -0,0 +1,233 @@
+# core/metrics.py
+"""Métricas de operación en formato de texto de Prometheus.
+
+Sin dependencias externas: contadores, valores instantáneos (gauge) e histogramas en
+memoria del proceso, más "colectores" que se evalúan al consultar /metrics
+(trabajos programados, granja de render, cachés, memoria del proceso).
+
+Uso:
+    metrics.inc('hsp_email_sent_total', status='Enviado')
+    with metrics.timer('hsp_report_stage_seconds', stage='query'):
+        ...
+
+En modo 'prod' el programador corre en otro proceso: sus métricas se publican con
+--metrics-port (ver run_app.py) y las del servidor web en /metrics.
+"""
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+
+# nombre -> (tipo, ayuda)
+METRICS = {
+    'hsp_scheduler_jobs': ('gauge', 'Trabajos registrados en el programador.'),
+    'hsp_scheduler_running_jobs': ('gauge', 'Reportes programados ejecutándose (dentro del presupuesto de concurrencia).'),
+    'hsp_scheduler_waiting_jobs': ('gauge', 'Reportes programados esperando turno en el presupuesto de concurrencia.'),
+    'hsp_scheduler_max_concurrent_jobs': ('gauge', 'Presupuesto de reportes programados simultáneos.'),
+    'hsp_scheduler_misfires_total': ('counter', 'Ejecuciones perdidas (misfire) por el programador.'),
+    'hsp_scheduler_job_errors_total': ('counter', 'Trabajos del programador que terminaron con excepción.'),
+    'hsp_scheduler_queue_lag_seconds': ('histogram', 'Retraso entre la hora programada y el envío del trabajo al pool.'),
+    'hsp_job_gate_wait_seconds': ('histogram', 'Espera de un reporte programado por un turno de ejecución.'),
+    'hsp_job_duration_seconds': ('summary', 'Duración de los reportes programados por diseño y resultado.'),
+    'hsp_report_stage_seconds': ('histogram', 'Duración de cada etapa de generación/envío de reportes.'),
+    'hsp_pdf_size_bytes': ('summary', 'Tamaño de los PDF generados, por diseño.'),
+    'hsp_pdf_render_seconds': ('summary', 'Tiempo de render de los PDF (tabla, gráfico y WeasyPrint), por diseño.'),
+    'hsp_odbc_connections_total': ('counter', 'Conexiones ODBC abiertas hacia el ERP.'),
+    'hsp_odbc_connections_open': ('gauge', 'Conexiones ODBC abiertas en este momento.'),
+    'hsp_smtp_connections_total': ('counter', 'Conexiones SMTP abiertas.'),
+    'hsp_smtp_connections_open': ('gauge', 'Conexiones SMTP abiertas en este momento.'),
+    'hsp_email_sent_total': ('counter', 'Correos de reportes registrados en el historial, por estado.'),
+    'hsp_cache_hits_total': ('counter', 'Aciertos de caché, por caché.'),
+    'hsp_cache_misses_total': ('counter', 'Fallos de caché, por caché.'),
+    'hsp_render_workers': ('gauge', 'Procesos configurados en la granja de render.'),
+    'hsp_render_busy_workers': ('gauge', 'Trabajos de render en curso.'),
+    'hsp_job_queue_jobs': ('gauge', 'Trabajos en la cola distribuida, por estado.'),
+    'hsp_process_resident_memory_bytes': ('gauge', 'Memoria residente (RSS) del proceso.'),
+    'hsp_process_start_time_seconds': ('gauge', 'Inicio del proceso (segundos desde epoch).'),
+}
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs: return ''
+    escaped = ('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+def _format_value(value):
+    if value == float('inf'): return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Registry:
+    def __init__(self):
+        self._values = {}      # (nombre, etiquetas) -> valor (contadores y gauges)
+        self._histograms = {}  # (nombre, etiquetas) -> {'buckets': [...], 'sum', 'count'}
+        self._collectors = []  # funciones -> [(nombre, {etiquetas}, valor)]
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, name, value=1, **labels):
+        self.inc(name, -value, **labels)
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'bounds': buckets, 'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(histogram['bounds']):
+                if value <= bound: histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def register_collector(self, collector):
+        """collector() -> [(nombre, {etiquetas}, valor)]; se evalúa en cada consulta."""
+        if collector not in self._collectors:
+            self._collectors.append(collector)
+
+    def render(self):
+        """Texto en formato de exposición de Prometheus (versión 0.0.4)."""
+        samples = {} # nombre -> [líneas]
+        with self._lock:
+            for (name, label_key), value in self._values.items():
+                samples.setdefault(name, []).append(f"{name}{_format_labels(label_key)} {_format_value(value)}")
+            for (name, label_key), h in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                if METRICS.get(name, ('histogram',))[0] == 'histogram':
+                    for bound, count in zip(h['bounds'], h['buckets']):
+                        lines.append(f"{name}_bucket{_format_labels(label_key, [('le', _format_value(float(bound)))])} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(label_key, [('le', '+Inf')])} {h['count']}")
+                lines.append(f"{name}_sum{_format_labels(label_key)} {_format_value(h['sum'])}")
+                lines.append(f"{name}_count{_format_labels(label_key)} {h['count']}")
+        for collector in list(self._collectors):
+            try:
+                for name, labels, value in collector():
+                    if value is not None:
+                        samples.setdefault(name, []).append(f"{name}{_format_labels(_label_key(labels))} {_format_value(value)}")
+            except Exception as e:
+                print(f"Métricas: error en el colector {getattr(collector, '__name__', collector)}: {e}")
+        output = []
+        for name in sorted(samples):
+            metric_type, help_text = METRICS.get(name, ('untyped', ''))
+            if help_text: output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(samples[name])
+        return '\n'.join(output) + '\n'
+
+registry = Registry()
+
+# Atajos a nivel de módulo
+inc, dec, set_value, observe, timer = registry.inc, registry.dec, registry.set, registry.observe, registry.timer
+register_collector = registry.register_collector
+render = registry.render
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class TrackedConnection:
+    """Envoltorio de una conexión (p. ej. pyodbc) que lleva la cuenta de las abiertas."""
+    def __init__(self, connection, kind):
+        self._connection = connection
+        self._kind = kind
+        self._open = True
+        inc(f'hsp_{kind}_connections_total')
+        inc(f'hsp_{kind}_connections_open')
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value): # p. ej. cnxn.timeout = 30 llega a la conexión real
+        if name.startswith('_'): object.__setattr__(self, name, value)
+        else: setattr(self._connection, name, value)
+
+    def _release(self):
+        if self._open:
+            self._open = False
+            dec(f'hsp_{self._kind}_connections_open')
+
+    def close(self):
+        self._release()
+        self._connection.close()
+
+    def quit(self): # smtplib
+        self._release()
+        return self._connection.quit()
+
+# --- Colectores del propio proceso ---
+def resident_memory_bytes():
+    """Memoria residente (RSS) del proceso actual en bytes, o None si no se puede medir."""
+    try:
+        import psutil # Opcional
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _process_collector():
+    return [('hsp_process_resident_memory_bytes', {}, resident_memory_bytes()),
+            ('hsp_process_start_time_seconds', {}, registry.start_time)]
+
+register_collector(_process_collector)
+
+def serve_in_background(port, host='127.0.0.1'):
+    """Publica /metrics en un hilo aparte (proceso del programador, que no tiene servidor web)."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # Sin una línea de log por cada consulta
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    print(f"Métricas del programador en http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,49 @@
+# core/process_lock.py
+"""Bloqueo exclusivo entre procesos basado en archivo (Windows y POSIX).
+
+Se usa para garantizar que un solo proceso ejecuta el programador de tareas,
+aunque se arranquen varios por error: el bloqueo lo libera el sistema operativo
+si el proceso muere.
+"""
+import os
+
+class ProcessLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        """Intenta tomar el bloqueo sin esperar. Devuelve True si se obtuvo."""
+        self._file = open(self.path, 'a+')
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._file.close()
+            self._file = None
+            return False
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(str(os.getpid()))
+        self._file.flush()
+        return True
+
+    def release(self):
+        if not self._file:
+            return
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,87 @@
+# core/query_registry.py
+"""Consultas al ERP en curso y su cancelación.
+
+Cada consulta larga (repositorios, resumen diario) se registra mientras se ejecuta:
+en memoria (para poder llamar a cursor.cancel() desde otro hilo) y en la tabla
+running_queries de settings.db, que es lo que ve la web aunque el programador
+corra en otro proceso (modo 'prod').
+
+Cancelar desde la web marca la fila; un hilo vigilante del proceso dueño de la
+consulta lo detecta cada CANCEL_POLL_SECONDS, llama a cursor.cancel() (SQLCancel:
+el servidor aborta la sentencia) y refresca el latido de sus consultas. Las filas
+sin latido reciente (proceso caído) se ignoran y se limpian.
+"""
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+CANCEL_POLL_SECONDS = 2
+STALE_AFTER_SECONDS = 30 # Sin latido en este tiempo, la fila se considera huérfana
+
+class RunningQueries:
+    def __init__(self):
+        self._running = {} # token -> {'cursor', 'label', 'cancelled'}
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    @contextmanager
+    def track(self, cursor, label, design_id=None):
+        """Registra la consulta durante el bloque. Al salir, 'entry["cancelled"]' indica si se canceló."""
+        from app.admin.services import register_running_query, unregister_running_query
+        token = uuid.uuid4().hex
+        entry = {'cursor': cursor, 'label': label, 'cancelled': False}
+        with self._lock:
+            self._running[token] = entry
+            self._ensure_watcher()
+        try:
+            register_running_query(token, os.getpid(), label, design_id)
+        except Exception as e: # El registro es informativo: no debe impedir la consulta
+            print(f"No se pudo registrar la consulta en curso '{label}': {e}")
+        try:
+            yield entry
+        finally:
+            with self._lock:
+                self._running.pop(token, None)
+            try:
+                unregister_running_query(token)
+            except Exception as e:
+                print(f"No se pudo quitar del registro la consulta '{label}': {e}")
+
+    def cancel_local(self, token):
+        """Cancela en el servidor una consulta de este proceso. Devuelve True si estaba en curso."""
+        with self._lock:
+            entry = self._running.get(token)
+        if not entry:
+            return False
+        entry['cancelled'] = True
+        try:
+            entry['cursor'].cancel()
+            print(f"Consulta '{entry['label']}' cancelada por un administrador.")
+        except Exception as e:
+            print(f"Error al cancelar la consulta '{entry['label']}': {e}")
+        return True
+
+    def _ensure_watcher(self):
+        """Arranca el hilo vigilante si no está corriendo (se detiene solo cuando no hay consultas)."""
+        if self._watcher is None or not self._watcher.is_alive():
+            self._watcher = threading.Thread(target=self._watch, name='query-cancel-watcher', daemon=True)
+            self._watcher.start()
+
+    def _watch(self):
+        from app.admin.services import heartbeat_running_queries
+        while True:
+            time.sleep(CANCEL_POLL_SECONDS)
+            with self._lock:
+                tokens = list(self._running)
+                if not tokens:
+                    self._watcher = None
+                    return
+            try:
+                for token in heartbeat_running_queries(tokens):
+                    self.cancel_local(token)
+            except Exception as e:
+                print(f"Vigilante de consultas: {e}")
+
+running_queries = RunningQueries()
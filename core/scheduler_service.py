@@ -3,21 +3,113 @@ from app.admin.services import get_all_designs, get_design_by_id
 from app.reports.tasks import execute_scheduled_report
 from app.daily_summary.tasks import send_daily_summary_email_task # <-- Importa la nueva tarea
 from app.admin.services import get_daily_summary_config          # <-- Importa la config
+from app.admin.services import prune_email_logs, get_settings, estimate_runtime, invalidate_cache
+from core.job_gate import job_gate
+from core import metrics
 import json
+from datetime import datetime
 
 scheduler = APScheduler()
 DAILY_SUMMARY_JOB_ID = 'daily_summary_job'
+LOG_MAINTENANCE_JOB_ID = 'email_log_maintenance_job'
+JOB_SYNC_JOB_ID = 'job_sync_job'
+JOB_SYNC_INTERVAL_SECONDS = 60
+
+# Modos del programador (app.config['SCHEDULER_MODE']):
+#   'embedded' -> corre dentro del servidor web (modo desarrollo, por defecto)
+#   'external' -> proceso web de producción: el programador corre en otro proceso
+#   'process'  -> proceso dedicado del programador (run_app.py --mode scheduler)
+# Despacho (app.config['SCHEDULER_DISPATCH']):
+#   'local'    -> los trabajos se ejecutan en este proceso (por defecto)
+#   'queue'    -> solo se encolan en core.job_queue; los ejecutan los procesos trabajadores
+_applied_schedules = {} # job_id -> horario aplicado, para no reprogramar si no cambió
+_metrics_registered = False
+
+def scheduler_runs_here():
+    """False si el programador vive en otro proceso; ese proceso se sincroniza desde la BBDD."""
+    try:
+        from flask import current_app
+        return current_app.config.get('SCHEDULER_MODE', 'embedded') != 'external'
+    except RuntimeError: # Sin contexto de aplicación
+        return True
+
+def dispatches_to_queue():
+    return scheduler.app is not None and scheduler.app.config.get('SCHEDULER_DISPATCH') == 'queue'
+
+def _enqueue(kind, design_id=None, priority=3):
+    """Encola la ejecución de este minuto (la clave evita duplicarla si el disparo se repite)."""
+    from core.job_queue import get_job_queue
+    minute = datetime.now().strftime('%Y-%m-%dT%H:%M')
+    dedupe_key = f"{kind}:{design_id or ''}:{minute}"
+    if get_job_queue().enqueue(kind, design_id, priority, dedupe_key):
+        print(f"[{datetime.now()}] Trabajo encolado: {dedupe_key}")
+
+def dispatch_scheduled_report(design_id):
+    """Disparo programado de un reporte: lo ejecuta aquí o lo encola para los trabajadores."""
+    if not dispatches_to_queue():
+        return execute_scheduled_report(design_id)
+    with scheduler.app.app_context():
+        design = get_design_by_id(design_id)
+        _enqueue('report', design_id, (design or {}).get('priority') or 3)
+
+def dispatch_daily_summary():
+    if not dispatches_to_queue():
+        return send_daily_summary_email_task()
+    _enqueue('daily_summary', priority=1)
+
+def run_queued_job(job):
+    """Ejecuta un trabajo tomado de la cola (proceso trabajador)."""
+    invalidate_cache() # SMTP, credenciales y límites pueden haber cambiado desde la web (otro proceso)
+    # Con el arriendo, el envío se omite si otro trabajador tomó el trabajo mientras se generaba
+    if job['kind'] == 'report':
+        execute_scheduled_report(job['design_id'], lease=job.get('lease'))
+    elif job['kind'] == 'daily_summary':
+        send_daily_summary_email_task(lease=job.get('lease'))
+    else:
+        raise ValueError(f"Tipo de trabajo desconocido: {job['kind']}")
+
+def apply_concurrency_settings():
+    """Ajusta el máximo de trabajos simultáneos a lo guardado en la configuración."""
+    job_gate.set_capacity(get_settings().get('max_concurrent_jobs') or 1)
+
+def _spread_offset_seconds(design_id, spread_minutes):
+    """Desplazamiento determinista dentro de la ventana: los diseños de la misma hora no arrancan juntos."""
+    window = max(0, int(spread_minutes or 0)) * 60
+    return (int(design_id) * 7919) % window if window else 0 # Multiplicador primo: reparte ids consecutivos
+
+def compute_start_time(design_id, hour, minute, days_of_week, spread_minutes=0, estimated_seconds=0):
+    """Hora de arranque para que el reporte llegue a la hora configurada (plazo de entrega).
+
+    Se adelanta la duración estimada más un desplazamiento dentro de la ventana de reparto.
+    Devuelve (hora, minuto, segundo, días); si el adelanto cruza la medianoche, los días
+    se desplazan al día anterior.
+    """
+    lead = int(estimated_seconds or 0) + _spread_offset_seconds(design_id, spread_minutes)
+    start = hour * 3600 + minute * 60 - lead
+    day_shift = 0
+    while start < 0:
+        start += 24 * 3600
+        day_shift += 1
+    if day_shift and days_of_week not in ('*', ''):
+        days_of_week = ",".join(str((int(d) - day_shift) % 7) for d in days_of_week.split(','))
+    return start // 3600, (start % 3600) // 60, start % 60, days_of_week
 
 def update_job_for_design(design):
     """Crea, actualiza o elimina un trabajo para un diseño de reporte específico."""
+    if not scheduler_runs_here():
+        return
     job_id = f'report_job_{design["id"]}'
     
-    # Extraer horario del diseño
+    # Extraer horario del diseño (get_design_by_id ya entrega schedule_days como lista)
     schedule_time_str = design.get('schedule_time')
-    schedule_days_json = design.get('schedule_days', '[]')
+    schedule_days = design.get('schedule_days') or []
+    if isinstance(schedule_days, str):
+        try: schedule_days = json.loads(schedule_days)
+        except json.JSONDecodeError: schedule_days = []
     
     # Si no hay horario, eliminar el trabajo si existe
-    if not schedule_time_str or not schedule_days_json or schedule_days_json == '[]':
+    if not schedule_time_str or not schedule_days:
+        _applied_schedules.pop(job_id, None)
         if scheduler.get_job(job_id):
             scheduler.remove_job(job_id)
             print(f"Trabajo '{job_id}' eliminado por falta de horario.")
@@ -25,13 +117,21 @@ def update_job_for_design(design):
 
     try:
         hour, minute = map(int, schedule_time_str.split(':'))
-        days_of_week = ",".join(json.loads(schedule_days_json))
+        settings = get_settings()
+        start_hour, start_minute, start_second, start_days = compute_start_time(
+            design['id'], hour, minute, ",".join(str(d) for d in schedule_days),
+            spread_minutes=settings.get('schedule_spread_minutes') or 0,
+            estimated_seconds=estimate_runtime(design['id']))
+        signature = (start_hour, start_minute, start_second, start_days)
+        if _applied_schedules.get(job_id) == signature and scheduler.get_job(job_id):
+            return # Sin cambios
 
         job_args = {
             'trigger': 'cron',
-            'hour': hour,
-            'minute': minute,
-            'day_of_week': days_of_week,
+            'hour': start_hour,
+            'minute': start_minute,
+            'second': start_second,
+            'day_of_week': start_days,
             'args': [design['id']]  # Pasamos el design_id a la tarea
         }
 
@@ -39,8 +139,11 @@ def update_job_for_design(design):
             scheduler.modify_job(id=job_id, **job_args)
             print(f"Trabajo '{job_id}' para '{design['name']}' actualizado.")
         else:
-            scheduler.add_job(id=job_id, func=execute_scheduled_report, **job_args)
+            scheduler.add_job(id=job_id, func=dispatch_scheduled_report, **job_args)
             print(f"Trabajo '{job_id}' para '{design['name']}' creado.")
+        if (start_hour, start_minute) != (hour, minute):
+            print(f"  -> Arranque a las {start_hour:02d}:{start_minute:02d}:{start_second:02d} para entregar a las {schedule_time_str}.")
+        _applied_schedules[job_id] = signature
             
     except (ValueError, TypeError) as e:
         print(f"Error al procesar horario para trabajo '{job_id}': {e}")
@@ -59,6 +162,8 @@ def schedule_all_jobs_on_startup(app):
 
 def update_daily_summary_job():
     """Crea, actualiza o elimina el trabajo para el resumen diario."""
+    if not scheduler_runs_here():
+        return
     config = get_daily_summary_config()
     
     if config.get('is_enabled') and config.get('schedule_time'):
@@ -67,24 +172,60 @@ def update_daily_summary_job():
             job_args = {
                 'trigger': 'cron', 'hour': hour, 'minute': minute, 'day_of_week': '*' # Todos los días
             }
+            if _applied_schedules.get(DAILY_SUMMARY_JOB_ID) == (hour, minute) and scheduler.get_job(DAILY_SUMMARY_JOB_ID):
+                return # Sin cambios
+            _applied_schedules[DAILY_SUMMARY_JOB_ID] = (hour, minute)
             if scheduler.get_job(DAILY_SUMMARY_JOB_ID):
                 scheduler.modify_job(id=DAILY_SUMMARY_JOB_ID, **job_args)
                 print(f"Trabajo '{DAILY_SUMMARY_JOB_ID}' actualizado.")
             else:
-                scheduler.add_job(id=DAILY_SUMMARY_JOB_ID, func=send_daily_summary_email_task, **job_args)
+                scheduler.add_job(id=DAILY_SUMMARY_JOB_ID, func=dispatch_daily_summary, **job_args)
                 print(f"Trabajo '{DAILY_SUMMARY_JOB_ID}' creado.")
         except (ValueError, TypeError) as e:
             print(f"Error al procesar horario para '{DAILY_SUMMARY_JOB_ID}': {e}")
     else:
         # Si está deshabilitado o no tiene hora, eliminar el job
+        _applied_schedules.pop(DAILY_SUMMARY_JOB_ID, None)
         if scheduler.get_job(DAILY_SUMMARY_JOB_ID):
             scheduler.remove_job(DAILY_SUMMARY_JOB_ID)
             print(f"Trabajo '{DAILY_SUMMARY_JOB_ID}' eliminado (deshabilitado o sin hora).")
 
+def _on_job_event(event):
+    """Oyente de APScheduler: misfires, errores y retraso respecto de la hora programada."""
+    from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_ERROR, EVENT_JOB_SUBMITTED
+    if event.code == EVENT_JOB_MISSED:
+        metrics.inc('hsp_scheduler_misfires_total')
+    elif event.code == EVENT_JOB_ERROR:
+        metrics.inc('hsp_scheduler_job_errors_total')
+    elif event.code == EVENT_JOB_SUBMITTED and event.scheduled_run_times:
+        scheduled = max(event.scheduled_run_times)
+        metrics.observe('hsp_scheduler_queue_lag_seconds', max(0.0, (datetime.now(scheduled.tzinfo) - scheduled).total_seconds()))
+
+def _scheduler_collector():
+    return [('hsp_scheduler_jobs', {}, len(scheduler.get_jobs()) if scheduler.running else 0),
+            ('hsp_scheduler_running_jobs', {}, job_gate.running),
+            ('hsp_scheduler_waiting_jobs', {}, job_gate.waiting),
+            ('hsp_scheduler_max_concurrent_jobs', {}, job_gate.capacity)]
+
+def register_scheduler_metrics():
+    """Publica el estado del programador en core.metrics (una vez por proceso)."""
+    global _metrics_registered
+    from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_ERROR, EVENT_JOB_SUBMITTED
+    if _metrics_registered:
+        return
+    _metrics_registered = True
+    scheduler.add_listener(_on_job_event, EVENT_JOB_MISSED | EVENT_JOB_ERROR | EVENT_JOB_SUBMITTED)
+    metrics.register_collector(_scheduler_collector)
+    if dispatches_to_queue():
+        from core.job_queue import queue_collector
+        metrics.register_collector(queue_collector)
+
 def schedule_all_jobs_on_startup(app):
     """Carga todos los diseños y el resumen diario al iniciar."""
     with app.app_context():
         print("Programando trabajos de reportes al iniciar...")
+        register_scheduler_metrics()
+        apply_concurrency_settings()
         designs_summary = get_all_designs()
         for design_summary in designs_summary:
             full_design = get_design_by_id(design_summary['id'])
@@ -92,4 +233,57 @@ def schedule_all_jobs_on_startup(app):
         
         # Añadir la programación del resumen diario
         print("Programando trabajo del resumen diario...")
-        update_daily_summary_job()
\ No newline at end of file
+        update_daily_summary_job()
+        schedule_log_maintenance_job()
+        # Resincroniza periódicamente: cambios desde otros procesos y nuevas estimaciones de duración
+        schedule_job_sync()
+
+def sync_jobs_from_db():
+    """Tarea periódica: refleja en el programador los cambios hechos desde la web y las nuevas estimaciones."""
+    with scheduler.app.app_context():
+        try:
+            # La caché de settings/conexiones solo se invalida en el proceso que escribe (la web):
+            # releerlas aquí aplica los cambios en el programador en la próxima sincronización
+            invalidate_cache()
+            apply_concurrency_settings()
+            design_ids = set()
+            for design_summary in get_all_designs():
+                design_ids.add(design_summary['id'])
+                full_design = get_design_by_id(design_summary['id'])
+                if full_design: update_job_for_design(full_design)
+            # Eliminar trabajos de diseños borrados
+            for job in scheduler.get_jobs():
+                if job.id.startswith('report_job_') and job.id[len('report_job_'):].isdigit() \
+                        and int(job.id[len('report_job_'):]) not in design_ids:
+                    scheduler.remove_job(job.id)
+                    _applied_schedules.pop(job.id, None)
+                    print(f"Trabajo '{job.id}' eliminado (diseño borrado).")
+            update_daily_summary_job()
+        except Exception as e:
+            print(f"Error sincronizando trabajos desde la BBDD: {e}")
+
+def schedule_job_sync():
+    """Programa la sincronización periódica de trabajos (cambios desde la web y duraciones estimadas)."""
+    if not scheduler.get_job(JOB_SYNC_JOB_ID):
+        scheduler.add_job(id=JOB_SYNC_JOB_ID, func=sync_jobs_from_db, trigger='interval',
+                          seconds=JOB_SYNC_INTERVAL_SECONDS)
+
+def run_log_maintenance():
+    """Tarea diaria: aplica la retención/archivado del historial de envíos."""
+    with scheduler.app.app_context():
+        try:
+            prune_email_logs()
+        except Exception as e:
+            print(f"Error en mantenimiento del historial de envíos: {e}")
+        if dispatches_to_queue():
+            try:
+                from core.job_queue import get_job_queue
+                get_job_queue().purge()
+            except Exception as e:
+                print(f"Error limpiando la cola de trabajos: {e}")
+
+def schedule_log_maintenance_job():
+    """Programa (una vez) la limpieza diaria del historial de envíos."""
+    if not scheduler.get_job(LOG_MAINTENANCE_JOB_ID):
+        scheduler.add_job(id=LOG_MAINTENANCE_JOB_ID, func=run_log_maintenance, trigger='cron', hour=3, minute=30)
+        print(f"Trabajo '{LOG_MAINTENANCE_JOB_ID}' creado.")
\ No newline at end of file
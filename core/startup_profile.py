@@ -0,0 +1,82 @@
+# core/startup_profile.py
+"""Medición del arranque: tiempo por fase/importación y tiempo hasta la primera petición.
+
+Uso en run_app.py:
+    with startup_profile.phase('import app.admin.routes'):
+        from app.admin.routes import admin_bp
+
+El informe se imprime al atender la primera petición y está disponible en
+/admin/startup-report. Para un desglose módulo a módulo más fino se puede
+arrancar con `python -X importtime run_app.py`.
+"""
+import importlib
+import threading
+import time
+from contextlib import contextmanager
+
+# Módulos pesados que se cargan en segundo plano una vez que el servidor escucha
+HEAVY_MODULES = [
+    'pandas',
+    'matplotlib.pyplot',
+    'app.reports.generator_service',
+    'app.reports.pdf_renderer', # WeasyPrint + GTK
+]
+
+class StartupProfile:
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.phases = []   # [(nombre, segundos)]
+        self.prewarm = []  # [(módulo, segundos o None si falló)]
+        self.first_request_at = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append((name, time.perf_counter() - start))
+
+    def mark_first_request(self):
+        """Registra el tiempo hasta la primera petición (solo la primera vez). Devuelve True si era la primera."""
+        with self._lock:
+            if self.first_request_at is not None:
+                return False
+            self.first_request_at = time.perf_counter()
+        return True
+
+    def prewarm_in_background(self, modules=None, delay=2.0):
+        """Importa los módulos pesados en un hilo aparte tras 'delay' segundos."""
+        def worker():
+            time.sleep(delay)
+            for module_name in modules or HEAVY_MODULES:
+                start = time.perf_counter()
+                try:
+                    importlib.import_module(module_name)
+                    elapsed = time.perf_counter() - start
+                except Exception as e: # p. ej. GTK no instalado: se cargará (y fallará) al usarse
+                    print(f"Precarga de '{module_name}' fallida: {e}")
+                    elapsed = None
+                with self._lock:
+                    self.prewarm.append((module_name, elapsed))
+            print("Precarga de librerías pesadas completada.")
+        thread = threading.Thread(target=worker, name='prewarm-heavy-imports', daemon=True)
+        thread.start()
+        return thread
+
+    def report(self):
+        lines = ["--- Informe de arranque ---"]
+        for name, seconds in self.phases:
+            lines.append(f"  {name:<45} {seconds * 1000:9.1f} ms")
+        if self.first_request_at is not None:
+            lines.append(f"  {'Tiempo hasta la primera petición':<45} {(self.first_request_at - self.t0) * 1000:9.1f} ms")
+        if self.prewarm:
+            lines.append("  Precarga en segundo plano:")
+            for module_name, seconds in self.prewarm:
+                value = f"{seconds * 1000:9.1f} ms" if seconds is not None else "    error"
+                lines.append(f"    {module_name:<43} {value}")
+        return "\n".join(lines)
+
+startup_profile = StartupProfile()
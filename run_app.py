@@ -1,16 +1,31 @@
+from core.startup_profile import startup_profile # Primero: marca el inicio del arranque
 import os
+import sys
 import json
-from flask import Flask, redirect, url_for
-from app.admin.routes import admin_bp
-from app.daily_summary.routes import daily_summary_bp # <-- 1. IMPORT THE BLUEPRINT
-from app.admin.services import init_db
-from core.scheduler_service import scheduler, schedule_all_jobs_on_startup
+import argparse
+import subprocess
+import multiprocessing
+if __name__ == '__main__':
+    # Primero: en el ejecutable de PyInstaller, un proceso de la granja de render termina aquí
+    multiprocessing.freeze_support()
+with startup_profile.phase('import flask'):
+    from flask import Flask, current_app, redirect, url_for, request, session, abort, Response
 
 def create_app():
+    with startup_profile.phase('import app.admin.routes'):
+        from app.admin.routes import admin_bp
+    with startup_profile.phase('import app.daily_summary.routes'):
+        from app.daily_summary.routes import daily_summary_bp # <-- 1. IMPORT THE BLUEPRINT
+    from app.admin.services import init_db
+
     app = Flask(__name__)
     app.config['SECRET_KEY'] = 'una-clave-secreta-muy-dificil-de-adivinar'
     project_root_path = os.path.dirname(os.path.abspath(__file__))
     app.config['PROJECT_ROOT'] = project_root_path
+    # Hilos de sobra para que los trabajos esperen su turno en core.job_gate (por prioridad)
+    # en lugar de perderse como 'misfire' si el pool de APScheduler está lleno
+    app.config['SCHEDULER_EXECUTORS'] = {'default': {'type': 'threadpool', 'max_workers': 20}}
+    app.config['SCHEDULER_JOB_DEFAULTS'] = {'coalesce': True, 'misfire_grace_time': 300}
 
     # Custom filter for Jinja
     def from_json_filter(value):
@@ -24,20 +39,161 @@ def create_app():
     app.register_blueprint(admin_bp)
     app.register_blueprint(daily_summary_bp) # <-- 2. REGISTER THE BLUEPRINT
 
-    with app.app_context():
+    with app.app_context(), startup_profile.phase('init_db'):
         init_db()
-        
-    return app
 
-app = create_app()
+    @app.before_request
+    def report_first_request():
+        if startup_profile.mark_first_request():
+            print(startup_profile.report())
+
+    app.add_url_rule('/', 'index', index)
+    app.add_url_rule('/metrics', 'metrics_endpoint', metrics_endpoint)
+    return app
 
-@app.route('/')
 def index():
     return redirect(url_for('admin.login'))
 
+def metrics_endpoint():
+    """Métricas en formato Prometheus: sesión iniciada o 'Authorization: Bearer <METRICS_TOKEN>'.
+
+    Sin token configurado, solo en modo desarrollo se acepta además localhost: detrás de un
+    proxy (modos web/prod, wsgi.py) todas las peticiones parecerían locales.
+    """
+    import hmac
+    from core import metrics
+    token = current_app.config.get('METRICS_TOKEN') or os.environ.get('HSP_METRICS_TOKEN')
+    provided = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if token:
+        allowed = hmac.compare_digest(provided.encode('utf-8'), token.encode('utf-8'))
+    else:
+        allowed = (current_app.config.get('SCHEDULER_MODE') != 'external'
+                   and request.remote_addr in ('127.0.0.1', '::1'))
+    if not (session.get('logged_in') or allowed):
+        abort(403)
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+# Con 'spawn' (Windows) los procesos de la granja de render re-importan este módulo como
+# '__mp_main__': no deben crear otra aplicación (blueprints, init_db, programador).
+if __name__ != '__mp_main__':
+    with startup_profile.phase('create_app'):
+        app = create_app()
+
+def start_embedded_scheduler():
+    """Programador dentro del mismo proceso (modo desarrollo)."""
+    with startup_profile.phase('import core.scheduler_service'):
+        from core.scheduler_service import scheduler, schedule_all_jobs_on_startup
+    with startup_profile.phase('scheduler start + jobs'):
+        scheduler.init_app(app)
+        scheduler.start()
+        print("Programador de tareas iniciado.")
+        schedule_all_jobs_on_startup(app)
+
+def run_scheduler_process(metrics_port=0, dispatch='local'):
+    """Proceso dedicado del programador: toma un bloqueo para no duplicar trabajos.
+
+    metrics_port: publica las métricas del programador en http://127.0.0.1:<puerto>/metrics (0 = no).
+    dispatch: 'queue' solo encola los trabajos para los procesos trabajadores (core.job_queue).
+    """
+    import time
+    from app.admin.services import PROJECT_ROOT
+    from core.process_lock import ProcessLock
+    from core.scheduler_service import scheduler
+
+    lock = ProcessLock(os.path.join(PROJECT_ROOT, 'scheduler.lock'))
+    if not lock.acquire():
+        print("Ya hay otro proceso del programador en ejecución. Saliendo.")
+        sys.exit(1)
+    app.config['SCHEDULER_MODE'] = 'process'
+    app.config['SCHEDULER_DISPATCH'] = dispatch
+    try:
+        if metrics_port:
+            from core import metrics
+            metrics.serve_in_background(metrics_port)
+        start_embedded_scheduler() # Incluye la sincronización periódica con los cambios hechos desde la web
+        while True:
+            time.sleep(3600)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        if scheduler.running: scheduler.shutdown()
+        lock.release()
+
+def run_worker_process(slots=0, metrics_port=0):
+    """Proceso trabajador: ejecuta los trabajos que encola el programador en modo --dispatch queue.
+
+    Se pueden lanzar varios, en este equipo o en otros que compartan la cola (HSP_JOB_QUEUE).
+    slots: trabajos simultáneos (0 = 'máximo de trabajos simultáneos' de la configuración).
+    """
+    from core.job_queue import QueueWorker, get_job_queue, queue_collector
+    from core.scheduler_service import scheduler, apply_concurrency_settings, run_queued_job
+    from core.job_gate import job_gate
+    from core import metrics
+
+    app.config['SCHEDULER_MODE'] = 'worker'
+    job_gate.shared = None # Cada trabajador aporta sus propios turnos (slots), fuera del límite compartido
+    scheduler.app = app # Las tareas usan scheduler.app para su contexto; aquí no se arranca el programador
+    with app.app_context():
+        apply_concurrency_settings()
+        queue = get_job_queue()
+    if metrics_port:
+        metrics.register_collector(queue_collector)
+        metrics.serve_in_background(metrics_port)
+    worker = QueueWorker(queue, run_queued_job, slots=slots or job_gate.capacity)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+
+def run_production_web(host, port, threads):
+    """Servidor WSGI multi-hilo (waitress); el programador corre en su propio proceso."""
+    try:
+        from waitress import serve
+    except ImportError:
+        print("El modo producción requiere 'waitress' (pip install waitress).")
+        sys.exit(1)
+    app.config['SCHEDULER_MODE'] = 'external'
+    startup_profile.prewarm_in_background()
+    serve(app, host=host, port=port, threads=threads)
+
+def scheduler_command(metrics_port=0, dispatch='local'):
+    """Comando para lanzar el proceso del programador (script o ejecutable empaquetado)."""
+    extra = ['--metrics-port', str(metrics_port)] if metrics_port else []
+    extra += ['--dispatch', dispatch] if dispatch != 'local' else []
+    if getattr(sys, 'frozen', False):
+        return [sys.executable, '--mode', 'scheduler'] + extra
+    return [sys.executable, os.path.abspath(__file__), '--mode', 'scheduler'] + extra
+
 if __name__ == '__main__':
-    scheduler.init_app(app)
-    scheduler.start()
-    print("Programador de tareas iniciado.")
-    schedule_all_jobs_on_startup(app)
-    app.run(debug=True, use_reloader=False)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Admin Reportes')
+    parser.add_argument('--mode', choices=['dev', 'web', 'scheduler', 'prod', 'worker'], default='dev',
+                        help="dev: servidor de desarrollo con programador integrado (por defecto); "
+                             "web: solo servidor WSGI; scheduler: solo programador; prod: web + programador en procesos separados; "
+                             "worker: ejecuta los trabajos encolados por un programador con --dispatch queue")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=8, help='Hilos del servidor WSGI (modos web/prod)')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='Puerto local para las métricas del proceso del programador o trabajador (modos scheduler/prod/worker; 0 = no publicar)')
+    parser.add_argument('--dispatch', choices=['local', 'queue'], default='local',
+                        help="Modos scheduler/prod: 'local' ejecuta los reportes en el programador; "
+                             "'queue' solo los encola para los procesos --mode worker")
+    parser.add_argument('--worker-slots', type=int, default=0,
+                        help='Modo worker: trabajos simultáneos (0 = máximo de trabajos simultáneos de la configuración)')
+    args = parser.parse_args()
+
+    if args.mode == 'scheduler':
+        run_scheduler_process(args.metrics_port, args.dispatch)
+    elif args.mode == 'worker':
+        run_worker_process(args.worker_slots, args.metrics_port)
+    elif args.mode in ('web', 'prod'):
+        scheduler_proc = subprocess.Popen(scheduler_command(args.metrics_port, args.dispatch)) if args.mode == 'prod' else None
+        try:
+            run_production_web(args.host, args.port, args.threads)
+        finally:
+            if scheduler_proc: scheduler_proc.terminate()
+    else:
+        start_embedded_scheduler()
+        # pandas/matplotlib/WeasyPrint se cargan en segundo plano mientras el servidor ya atiende
+        startup_profile.prewarm_in_background()
+        app.run(debug=True, use_reloader=False)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Validación de la configuración de un diseño (app.reports.design_plan.validate_config).
+
+Uso (desde la raíz del proyecto):
+    python -m pytest tests
+"""
+import unittest
+
+from app.reports.design_plan import validate_config
+
+def _config(**overrides):
+    config = {
+        'fields': {'order': ['fecha', 'cliente', 'monto'],
+                   'details': {'fecha': {'label': 'Fecha'}, 'cliente': {'label': 'Cliente'}, 'monto': {'label': 'Monto'}}},
+        'total_fields': ['monto'],
+        'group_by_field': 'cliente',
+        'filters': [{'name': 'desde', 'label': 'Desde', 'type': 'date'}, {'name': 'hasta', 'label': 'Hasta', 'type': 'date'}],
+        'chart': {'type': 'bar', 'x_axis': 'cliente', 'y_axis': 'monto'},
+    }
+    config.update(overrides)
+    return config
+
+class ValidateConfigTest(unittest.TestCase):
+    def test_valid_config_has_no_errors(self):
+        self.assertEqual(validate_config(_config(), schedule_days='1,2', schedule_time='08:00'), [])
+
+    def test_hidden_totals_group_and_repeated_labels(self):
+        config = _config(fields={'order': ['cliente', 'monto', 'otro'],
+                                 'details': {'cliente': {'label': 'X'}, 'monto': {'label': 'Monto', 'visible': False},
+                                             'otro': {'label': 'X'}}})
+        errors = ' '.join(validate_config(config))
+        self.assertIn('misma etiqueta: X', errors)
+        self.assertIn('totalizar deben ser visibles: monto', errors)
+        self.assertIn('gráfico necesita un eje X y un eje Y', errors)
+
+    def test_repeated_and_reserved_filter_names(self):
+        filters = [{'name': 'desde'}, {'name': 'desde'}, {'name': '_refresh'}]
+        errors = ' '.join(validate_config(_config(filters=filters)))
+        self.assertIn('mismo nombre: desde', errors)
+        self.assertIn("no pueden empezar con '_': _refresh", errors)
+
+    def test_chart_type_and_format(self):
+        errors = ' '.join(validate_config(_config(chart={'type': 'radar', 'x_axis': 'cliente', 'y_axis': 'monto', 'format': 'gif'})))
+        self.assertIn('Tipo de gráfico no soportado: radar', errors)
+        self.assertIn('Formato de gráfico no soportado: gif', errors)
+
+    def test_incremental_mode_requirements(self):
+        incremental = {'enabled': True, 'date_field': 'fecha', 'from_filter': 'desde', 'to_filter': 'hasta'}
+        errors = ' '.join(validate_config(_config(incremental=incremental)))
+        self.assertIn('solo pueden ser visibles el campo de agrupación y los campos a totalizar (ocultar: fecha)', errors)
+        ok = _config(incremental=incremental, fields={'order': ['cliente', 'monto'],
+                                                      'details': {'fecha': {'visible': False}, 'cliente': {}, 'monto': {}}})
+        self.assertEqual(validate_config(ok), [])
+        errors = ' '.join(validate_config(_config(incremental=dict(incremental, to_filter='fin'))))
+        self.assertIn("filtros 'desde' y 'hasta'", errors)
+
+    def test_schedule_time_is_required_for_scheduled_days(self):
+        self.assertIn("Indica la hora de envío (HH:MM) para los días programados.",
+                      validate_config(_config(), schedule_days='1', schedule_time='25:00'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Reducción de series para gráficos de línea (app.reports.downsample, LTTB).
+
+Uso (desde la raíz del proyecto):
+    python -m pytest tests
+"""
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from app.reports.downsample import lttb_indices, downsample_series
+
+class LttbIndicesTest(unittest.TestCase):
+    def test_short_series_or_small_threshold_keep_every_point(self):
+        self.assertEqual(lttb_indices([3, 1, 2], 10).tolist(), [0, 1, 2])
+        self.assertEqual(lttb_indices(list(range(50)), 2).tolist(), list(range(50)))
+
+    def test_keeps_first_last_and_threshold_points_in_order(self):
+        values = np.sin(np.linspace(0, 20, 5000))
+        indices = lttb_indices(values, 100)
+        self.assertEqual(len(indices), 100)
+        self.assertEqual((indices[0], indices[-1]), (0, 4999))
+        self.assertTrue((np.diff(indices) > 0).all())
+
+    def test_keeps_isolated_peaks(self):
+        values = np.zeros(1000)
+        values[[250, 731]] = [100, -100]
+        indices = lttb_indices(values, 20).tolist()
+        self.assertIn(250, indices)
+        self.assertIn(731, indices)
+
+class DownsampleSeriesTest(unittest.TestCase):
+    def test_keeps_index_labels_of_selected_points(self):
+        series = pd.Series(range(500), index=pd.date_range('2026-01-01', periods=500, freq='h'), dtype=float)
+        reduced = downsample_series(series, 50)
+        self.assertEqual(len(reduced), 50)
+        self.assertEqual(reduced.index[0], series.index[0])
+        self.assertEqual(reduced.index[-1], series.index[-1])
+        self.assertIs(downsample_series(series, 1000), series)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Adjuntos de los correos de reportes: nombre y contenido en el mensaje MIME enviado.
+
+Uso (desde la raíz del proyecto):
+    python -m pytest tests
+"""
+import email
+import unittest
+from unittest import mock
+
+from app.utils.email_sender import send_email, attachments_from_outputs
+
+SMTP_CONFIG = {'smtp_server': 'smtp.example.com', 'smtp_port': 587, 'smtp_user': 'reportes@example.com', 'smtp_password': ''}
+PDF_BYTES = b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n1 0 obj\n'
+
+class FakeSMTP:
+    """Servidor SMTP falso: guarda los mensajes enviados."""
+    sent = []
+    def __init__(self, host, port, timeout=None): pass
+    def ehlo(self): pass
+    def starttls(self): pass
+    def login(self, user, password): pass
+    def sendmail(self, from_addr, to_addrs, message): FakeSMTP.sent.append(message)
+    def quit(self): pass
+
+def _attachments(message_text):
+    message = email.message_from_string(message_text)
+    return [(part.get_filename(), part.get_content_type(), part.get_payload(decode=True))
+            for part in message.walk() if part.get_content_disposition() == 'attachment']
+
+class EmailAttachmentsTest(unittest.TestCase):
+    def setUp(self):
+        FakeSMTP.sent = []
+        patcher = mock.patch('smtplib.SMTP', FakeSMTP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_report_outputs_are_attached_with_their_filename(self):
+        outputs = [(PDF_BYTES, 'application/pdf', 'Ventas.pdf'),
+                   ('<html>completo</html>', 'text/html', 'Ventas_completo.html')]
+        send_email(SMTP_CONFIG, ['a@example.com'], [], 'Reporte', 'Adjunto.',
+                   attachments=attachments_from_outputs(outputs))
+        self.assertEqual(_attachments(FakeSMTP.sent[0]), [
+            ('Ventas.pdf', 'application/pdf', PDF_BYTES),
+            ('Ventas_completo.html', 'text/html', '<html>completo</html>'.encode('utf-8')),
+        ])
+
+    def test_manual_send_attaches_bundle(self):
+        from app.reports import manual_send
+        design = {'id': 7, 'name': 'Ventas', 'output_format': 'pdf', 'config': {}}
+        bundle = ([(PDF_BYTES, 'application/pdf', 'Ventas.pdf')], [])
+        with mock.patch.object(manual_send, 'get_settings', return_value=SMTP_CONFIG), \
+             mock.patch.object(manual_send, 'log_email_sent'), \
+             mock.patch('app.reports.generator_service.generate_report_bundle', return_value=bundle):
+            success, message = manual_send.send_manual_report(design, {}, 'a@example.com')
+        self.assertTrue(success, message)
+        self.assertEqual(_attachments(FakeSMTP.sent[0]), [('Ventas.pdf', 'application/pdf', PDF_BYTES)])
+
+if __name__ == '__main__':
+    unittest.main()
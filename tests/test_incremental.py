@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""Claves de grupo de los parciales del modo incremental (app.reports.incremental).
+
+Uso (desde la raíz del proyecto):
+    python -m pytest tests
+"""
+import unittest
+from datetime import date, datetime
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+from app.reports.incremental import encode_group_key, decode_group_key
+
+class GroupKeyTest(unittest.TestCase):
+    def test_round_trip_keeps_value_and_type(self):
+        for value in ('Cliente <A>', 7, 2.5, Decimal('10.50'), True, None):
+            with self.subTest(value=value):
+                decoded = decode_group_key(encode_group_key(value))
+                self.assertEqual(decoded, value)
+                self.assertIs(type(decoded), type(value))
+
+    def test_numpy_numbers_decode_as_python_numbers(self):
+        self.assertEqual(decode_group_key(encode_group_key(np.int64(3))), 3)
+        self.assertIs(type(decode_group_key(encode_group_key(np.float64(1.25)))), float)
+
+    def test_dates_decode_as_timestamps(self):
+        for value in (date(2026, 1, 2), datetime(2026, 1, 2, 8, 30), pd.Timestamp('2026-01-02')):
+            with self.subTest(value=value):
+                self.assertEqual(decode_group_key(encode_group_key(value)), pd.Timestamp(value))
+
+    def test_similar_values_of_different_types_do_not_collide(self):
+        keys = {encode_group_key(v) for v in (1, '1', Decimal('1'), True, None, 'None')}
+        self.assertEqual(len(keys), 6)
+
+if __name__ == '__main__':
+    unittest.main()
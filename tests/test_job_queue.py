@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Cola de trabajos con arriendo (core.job_queue) sobre un archivo SQLite temporal.
+
+Uso (desde la raíz del proyecto):
+    python -m pytest tests
+"""
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from core.job_queue import SQLiteJobQueue, JobLease, MAX_ATTEMPTS
+
+LEASE = 0.1 # Segundos: el arriendo vence dentro de la prueba
+
+class SQLiteJobQueueTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+        self.queue = SQLiteJobQueue(self.path)
+
+    def _expire(self):
+        time.sleep(LEASE * 2)
+
+    def test_enqueue_ignores_duplicate_keys(self):
+        self.assertTrue(self.queue.enqueue('report', 1, dedupe_key='report:1:2026-10-19 08:00'))
+        self.assertFalse(self.queue.enqueue('report', 1, dedupe_key='report:1:2026-10-19 08:00'))
+        self.assertTrue(self.queue.enqueue('report', 1, dedupe_key='report:1:2026-10-20 08:00'))
+        self.assertEqual(self.queue.counts(), {'queued': 2})
+
+    def test_claim_takes_highest_priority_first(self):
+        self.queue.enqueue('report', 1, priority=3)
+        self.queue.enqueue('report', 2, priority=1)
+        job = self.queue.claim('w1', lease_seconds=LEASE)
+        self.assertEqual((job['design_id'], job['attempts']), (2, 1))
+        self.assertEqual(self.queue.claim('w1', lease_seconds=LEASE)['design_id'], 1)
+        self.assertIsNone(self.queue.claim('w1', lease_seconds=LEASE))
+
+    def test_expired_lease_is_taken_by_another_worker(self):
+        self.queue.enqueue('report', 1)
+        job = self.queue.claim('w1', lease_seconds=LEASE)
+        self.assertIsNone(self.queue.claim('w2', lease_seconds=LEASE)) # Arriendo vigente
+        self._expire()
+        again = self.queue.claim('w2', lease_seconds=60)
+        self.assertEqual((again['id'], again['attempts']), (job['id'], 2))
+
+        # El primer trabajador ya no puede renovar ni cerrar el trabajo
+        lease = JobLease(self.queue, job['id'], 'w1')
+        self.assertFalse(lease.confirm())
+        self.assertTrue(lease.lost.is_set())
+        self.queue.complete(job['id'], 'w1', 'done')
+        self.assertEqual(self.queue.counts(), {'running': 1})
+        self.assertTrue(JobLease(self.queue, job['id'], 'w2').confirm())
+
+    def test_job_fails_after_max_attempts(self):
+        self.queue.enqueue('report', 1)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            job = self.queue.claim(f'w{attempt}', lease_seconds=LEASE)
+            self.assertEqual(job['attempts'], attempt)
+            self._expire()
+        self.assertIsNone(self.queue.claim('w-final', lease_seconds=LEASE))
+        self.assertEqual(self.queue.counts(), {'failed': 1})
+
+class LostLeaseSendTest(unittest.TestCase):
+    """Un trabajador que perdió el arriendo no debe enviar el reporte (lo envía el nuevo dueño)."""
+    def test_report_is_not_sent_after_losing_the_lease(self):
+        from app.reports import tasks
+        design = {'id': 1, 'name': 'Ventas', 'email_to': 'gerencia@example.com', 'email_cc': '',
+                  'output_format': 'pdf', 'config': {}}
+        lease = mock.Mock(spec=JobLease)
+        lease.confirm.return_value = False
+        with mock.patch.object(tasks, 'get_smtp_config', return_value={'smtp_server': 'smtp.example.com'}), \
+                mock.patch.object(tasks, 'log_email_sent') as log_email_sent, \
+                mock.patch.object(tasks, 'send_email') as send_email, \
+                mock.patch('app.reports.generator_service.generate_report_bundle',
+                           return_value=([(b'%PDF', 'application/pdf', 'Ventas.pdf')], [])):
+            status = tasks._run_scheduled_report(1, design, lease)
+        self.assertIsNone(status)
+        send_email.assert_not_called()
+        self.assertEqual(log_email_sent.call_args[0][2], "Omitido")
+
+class DailySummaryQueuedJobTest(unittest.TestCase):
+    """run_queued_job con un trabajo 'daily_summary' (modo --dispatch queue)."""
+    CONFIG = {'is_enabled': True, 'connection_id': 1, 'recipients': 'gerencia@example.com',
+              'sql_query': 'SELECT 1', 'subject': 'Cierre %empresa%'}
+
+    def _run(self, lease):
+        from flask import Flask
+        from app.daily_summary import tasks
+        from app.reports import tasks as report_tasks
+        from core import scheduler_service
+        from core.job_gate import job_gate
+        app = Flask(__name__)
+        app.config['PROJECT_ROOT'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        job = {'id': 1, 'kind': 'daily_summary', 'design_id': None, 'attempts': 1, 'lease': lease}
+        with mock.patch.object(scheduler_service.scheduler, 'app', app, create=True), \
+                mock.patch.object(job_gate, 'shared', None), \
+                mock.patch.object(tasks, 'get_daily_summary_config', return_value=self.CONFIG), \
+                mock.patch.object(tasks, 'get_smtp_config', return_value={'smtp_server': 'smtp.example.com', 'smtp_user': 'r'}), \
+                mock.patch.object(tasks, 'get_daily_summary_data', return_value=(True, {'nombre_empresa': 'HSP'})), \
+                mock.patch.object(tasks, 'log_email_sent') as log_email_sent, \
+                mock.patch.object(report_tasks, 'log_email_sent', log_email_sent), \
+                mock.patch.object(tasks, 'send_email') as send_email:
+            scheduler_service.run_queued_job(job)
+        return send_email, log_email_sent
+
+    def test_summary_is_sent_while_the_lease_is_held(self):
+        lease = mock.Mock(spec=JobLease)
+        lease.confirm.return_value = True
+        send_email, log_email_sent = self._run(lease)
+        send_email.assert_called_once()
+        self.assertEqual(send_email.call_args.kwargs['subject'], 'Cierre HSP')
+        self.assertEqual(log_email_sent.call_args[0][2], "Enviado")
+
+    def test_summary_is_not_sent_after_losing_the_lease(self):
+        lease = mock.Mock(spec=JobLease)
+        lease.confirm.return_value = False
+        send_email, log_email_sent = self._run(lease)
+        send_email.assert_not_called()
+        self.assertEqual(log_email_sent.call_args[0][2], "Omitido")
+
+if __name__ == '__main__':
+    unittest.main()
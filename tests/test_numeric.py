@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Totales exactos para columnas DECIMAL/MONEY (app.reports.numeric).
+
+Uso (desde la raíz del proyecto):
+    python -m pytest tests
+"""
+import unittest
+from decimal import Decimal
+
+import pandas as pd
+
+from app.reports import numeric
+
+class ExactTotalsTest(unittest.TestCase):
+    def setUp(self):
+        # 0.10 tres millones de veces como float no da 300000.00 exacto
+        self.df = pd.DataFrame({'Cliente': ['A', 'B', 'A'] * 1000,
+                                'Monto': [Decimal('0.10'), Decimal('0.20'), None] * 1000,
+                                'Cantidad': ['1', 'x', '2'] * 1000})
+
+    def test_decimal_columns_sum_exactly_and_others_as_float(self):
+        scales = numeric.infer_scales(self.df, ['Monto', 'Cantidad'])
+        self.assertEqual(scales, {'Monto': 2})
+        frame = numeric.totals_frame(self.df, ['Monto', 'Cantidad'], scales)
+        totals = numeric.exact_totals(frame, ['Monto', 'Cantidad'], scales)
+        self.assertEqual(totals['Monto'], Decimal('300.00'))
+        self.assertIsInstance(totals['Monto'], Decimal)
+        self.assertEqual(totals['Cantidad'], 3000.0) # 'x' no es numérico: cuenta como vacío
+
+    def test_subtotals_by_group_keep_decimal_even_when_empty(self):
+        df = pd.DataFrame({'Cliente': ['A', 'B', 'A'], 'Monto': [Decimal('1.10'), None, Decimal('2.25')]})
+        frame = numeric.totals_frame(df, ['Monto'], {'Monto': 2})
+        subtotals = numeric.exact_subtotals(frame, df['Cliente'], ['Monto'], {'Monto': 2})
+        self.assertEqual(subtotals, {'A': {'Monto': Decimal('3.35')}, 'B': {'Monto': Decimal('0')}})
+        self.assertIsInstance(subtotals['B']['Monto'], Decimal)
+
+class FormatNumberTest(unittest.TestCase):
+    def test_fixed_formats_round_half_up_without_float(self):
+        self.assertEqual(numeric.format_number(Decimal('2.675')), '2.68') # Como float sería 2.67
+        self.assertEqual(numeric.format_number(1234.5, '%.0f'), '1235')
+        self.assertEqual(numeric.format_number(None), '0.00')
+
+    def test_non_numeric_values_are_returned_as_is(self):
+        self.assertEqual(numeric.format_number('N/D'), 'N/D')
+        self.assertEqual(numeric.format_number(3, '%d'), '3')
+
+    def test_to_decimal(self):
+        self.assertEqual(numeric.to_decimal(0.1), Decimal('0.1'))
+        self.assertIsNone(numeric.to_decimal('abc'))
+        self.assertIsNone(numeric.to_decimal(float('nan')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Cuerpo de la tabla del reporte (app.reports.table_render): escape, formato y grupos.
+
+Uso (desde la raíz del proyecto):
+    python -m pytest tests
+"""
+import unittest
+from datetime import datetime
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+from app.reports import numeric, table_render
+
+def _template_data(df, group_by=None, total_fields=()):
+    """Datos de plantilla con la misma forma que build_report_context."""
+    total_fields = list(total_fields)
+    totals = numeric.totals_frame(df, total_fields, {}) if total_fields else None
+    data = {'columns': df.columns.tolist(), 'total_fields': total_fields, 'group_by_field': group_by,
+            'grouped_data': None, 'grand_totals': numeric.exact_totals(totals, total_fields, {}) if totals is not None else None}
+    positions = None
+    if group_by:
+        names, codes, positions = table_render.group_positions(df[group_by])
+        subtotals = numeric.exact_subtotals(totals, codes, total_fields, {}) if totals is not None else {}
+        data['grouped_data'] = {name: {'subtotals': subtotals.get(code)} for code, name in enumerate(names)}
+    return data, positions
+
+class FormatColumnTest(unittest.TestCase):
+    def test_text_is_escaped_and_nulls_are_blank(self):
+        texts = table_render.format_column(pd.Series(['<b>A & B</b>', None, "O'Neil"]))
+        self.assertEqual(texts, ['&lt;b&gt;A &amp; B&lt;/b&gt;', '', 'O&#x27;Neil'])
+
+    def test_dates_without_time_drop_midnight(self):
+        dates = pd.Series(pd.to_datetime(['2026-01-02', None]))
+        self.assertEqual(table_render.format_column(dates), ['2026-01-02', ''])
+        with_time = pd.Series([datetime(2026, 1, 2, 8, 30), datetime(2026, 1, 3)])
+        self.assertEqual(table_render.format_column(with_time), ['2026-01-02 08:30:00', '2026-01-03 00:00:00'])
+
+    def test_numbers_keep_str_format(self):
+        self.assertEqual(table_render.format_column(pd.Series([1.5, np.nan, 3.0])), ['1.5', '', '3.0'])
+
+class GroupPositionsTest(unittest.TestCase):
+    def test_groups_are_sorted_and_nulls_form_the_last_group(self):
+        names, codes, positions = table_render.group_positions(pd.Series(['b', None, 'a', 'b', np.nan]))
+        self.assertEqual(names[:2], ['a', 'b'])
+        self.assertTrue(pd.isna(names[2]))
+        self.assertEqual([p.tolist() for p in positions], [[2], [0, 3], [1, 4]])
+        self.assertEqual(codes.tolist(), [1, 2, 0, 1, 2])
+
+    def test_mixed_types_group_every_row_once(self):
+        column = pd.Series(['x', 1, 'x', Decimal('2.5')], dtype=object)
+        names, _, positions = table_render.group_positions(column)
+        self.assertEqual(sorted(i for p in positions for i in p.tolist()), [0, 1, 2, 3])
+        for name, rows in zip(names, positions):
+            self.assertTrue(all(column[i] == name for i in rows))
+
+class RenderTableBodyTest(unittest.TestCase):
+    def test_flat_rows_and_grand_total(self):
+        df = pd.DataFrame({'Cliente': ['<A>', 'B'], 'Monto': [1.5, 2.0]})
+        data, _ = _template_data(df, total_fields=['Monto'])
+        body = str(table_render.render_table_body(df, data))
+        self.assertIn('<tr><td>&lt;A&gt;</td><td class="text-right">1.5</td></tr>', body)
+        self.assertIn('<tr class="grand-total-row"><td class="text-right">TOTAL GENERAL:</td><td class="text-right">3.5</td></tr>', body)
+
+    def test_groups_with_null_keys_keep_all_rows_and_subtotals(self):
+        df = pd.DataFrame({'Cliente': ['B', None, 'A & Co', 'B'], 'Monto': [1.0, 2.0, 4.0, 8.0]})
+        data, positions = _template_data(df, group_by='Cliente', total_fields=['Monto'])
+        body = str(table_render.render_table_body(df, data, positions))
+        headers = [line for line in body.split('\n') if 'group-header' in line]
+        self.assertEqual(len(headers), 3)
+        self.assertIn('Cliente: A &amp; Co', headers[0])
+        self.assertEqual(body.count('<tr><td>'), 4) # Ninguna fila se pierde en el grupo de nulos
+        self.assertIn('<td class="text-right">9.0</td>', body) # Subtotal de 'B'
+        self.assertIn('<td class="text-right">2.0</td></tr>\n<tr class="subtotal-row">', body)
+        # Sin posiciones precalculadas se derivan igual
+        self.assertEqual(str(table_render.render_table_body(df, data)), body)
+
+    def test_empty_frame_renders_nothing(self):
+        df = pd.DataFrame({'Cliente': [], 'Monto': []})
+        data, _ = _template_data(df)
+        self.assertEqual(str(table_render.render_table_body(df, data)), '')
+
+if __name__ == '__main__':
+    unittest.main()
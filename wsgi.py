@@ -0,0 +1,9 @@
+# wsgi.py
+"""Punto de entrada WSGI para servidores externos (waitress-serve, gunicorn...).
+
+Ejemplo: waitress-serve --threads=8 --listen=0.0.0.0:5000 wsgi:app
+El programador NO corre aquí: lanzarlo aparte con `python run_app.py --mode scheduler`.
+"""
+from run_app import app
+
+app.config['SCHEDULER_MODE'] = 'external'